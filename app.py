@@ -1,13 +1,15 @@
+import argparse
+import collections
 import json
 import os
 import platform
+import threading
 import time
 import traceback
 
 import cairo
 import definitions
 import mido
-import numpy
 import push2_python
 
 from melodic_mode import MelodicMode
@@ -19,7 +21,29 @@ from main_controls_mode import MainControlsMode
 from midi_cc_mode import MIDICCMode
 from preset_selection_mode import PresetSelectionMode
 
-from display_utils import show_notification
+import display_widgets
+from display_utils import show_notification, notification_overlay, DisplayFrameBuffer, DisplayLayer
+from event_queue import EventQueue, EventCoalescer
+from event_recorder import EventRecorder, EventReplayer
+from fake_push2 import FakePush2
+from frame_encoder import Push2FrameEncoder, DISPLAY_RENDER_FORMAT_RGB565, DISPLAY_RENDER_FORMAT_ARGB32
+from frame_scheduler import FrameScheduler, FramePacer
+from midi_input import MIDIInputTransform, MIDIInputWorker, DROP
+from midi_port_watcher import MIDIPortWatcher
+from midi_output import MIDIOutput, MIDIBatch, MIDIOutputShaper, MIDIOutputSerializer, MIDIOutputPool, CHANNEL_STATUS_BYTES, NOTE_ON, NOTE_OFF
+from stats_utils import RollingStats, LatencyStats
+
+# Push2 events handled by modes (names of PyshaMode methods), and for events of named buttons/encoders, the PyshaMode
+# attribute which lists the names a mode handles
+PUSH2_EVENT_NAMES = ['on_encoder_rotated', 'on_button_pressed', 'on_button_released', 'on_pad_pressed', 'on_pad_released',
+                     'on_pad_aftertouch', 'on_touchstrip', 'on_sustain_pedal']
+PUSH2_CONTROL_EVENT_NAMES = {
+    'on_encoder_rotated': 'handled_encoder_names',
+    'on_button_pressed': 'handled_button_names',
+    'on_button_released': 'handled_button_names',
+}
+FAST_LANE_EVENT_NAMES = {'on_pad_pressed', 'on_pad_released', 'on_pad_aftertouch', 'on_touchstrip', 'on_sustain_pedal'}
+
 
 class PyshaApp(object):
 
@@ -27,54 +51,147 @@ class PyshaApp(object):
     midi_out = None
     available_midi_out_device_names = []
     midi_out_channel = 0  # 0-15
+    midi_out_status = CHANNEL_STATUS_BYTES[0]  # Status bytes for the output channel of the selected track (see send_midi_raw)
+    track_midi_out = None  # Output of the selected track if it is routed to its own device (else midi_out is used)
+    midi_output_pool = None  # Open MIDI output ports (see MIDIOutputPool)
+    midi_output_shaping = True  # Thin continuous controller messages sent to MIDI outputs (see MIDIOutputShaper)
+    midi_output_max_rate = definitions.MIDI_OUTPUT_MAX_RATE
+    midi_output_max_rates = {}
+    midi_output_drop_repeats = True
+    midi_output_link_rate = definitions.MIDI_OUTPUT_LINK_RATE  # Bandwidth of MIDI output links (see MIDIOutputSerializer), 0 to disable
+    midi_output_congestion_threshold = definitions.MIDI_OUTPUT_CONGESTION_THRESHOLD
     midi_out_tmp_device_idx = None  # This is to store device names while rotating encoders
+    midi_out_device_name = None  # Configured MIDI out device (kept when the device is unplugged so it can be reconnected)
 
     midi_in = None
     available_midi_in_device_names = []
     midi_in_channel = 0  # 0-15
     midi_in_tmp_device_idx = None  # This is to store device names while rotating encoders
+    midi_in_device_name = None  # Configured MIDI in device (kept when the device is unplugged so it can be reconnected)
+    midi_in_transform = None  # Transform applied to messages received from MIDI in before forwarding (see midi_input.py)
+    midi_in_worker = None  # Thread where messages received from MIDI in are forwarded to the MIDI out
+    midi_in_mode_messages = None  # Messages received from MIDI in waiting to be passed to the active modes (in the main loop)
+    n_midi_in_mode_messages_dropped = 0
+    midi_ports_lock = None  # Held while MIDI in/out devices are (re)configured
+    midi_port_watcher = None  # Reconnects MIDI devices that are plugged back in (see midi_port_watcher.py)
+    midi_port_watcher_interval = definitions.MIDI_PORT_WATCHER_INTERVAL
 
     # push
     push = None
     use_push2_display = None
     target_frame_rate = None
+    idle_frame_rate = None
+    frame_scheduler = None
+    display_frame_pacer = None
+    main_loop_frame_pacer = None
 
     # frame rate measurements
     actual_frame_rate = 0
     current_frame_rate_measurement = 0
     current_frame_rate_measurement_second = 0
+    display_timing_stats = {}  # Updated once per second, see get_display_timing_stats
 
     # other state vars
     active_modes = []
     previously_active_mode_for_xor_group = {}
     pads_need_update = True
     buttons_need_update = True
+    display_needs_update = True
+
+    # events (queued by push2_python callbacks and handled in the main loop) and event dispatch (rebuilt every
+    # time active modes change, see rebuild_event_dispatch_tables)
+    event_queue = None
+    event_coalescer = None
+    event_dispatch_tables = None
+    main_loop_wake_event = None  # Set when events or MIDI in messages arrive (see wake_up_main_loop)
+
+    # display (rendered in its own thread using a front and a back frame buffer). The display thread never reads modes'
+    # state, it draws from snapshots taken by the main loop (see update_display_state)
+    display_front_buffer = None
+    display_back_buffer = None
+    display_active_modes = ()  # Active modes when the last snapshot was taken
+    display_mode_states = None  # Mode -> display state snapshots not drawn yet by the display thread
+    display_state_changed = False
+    last_display_frame_sent_time = 0
+    display_thread = None
+    display_thread_stop = None
+    display_state_lock = None
+    use_pysha_frame_encoder = True  # If False, frames are converted and sent by push2_python
+    display_render_format = DISPLAY_RENDER_FORMAT_RGB565
+    display_frame_encoder = None
+    display_render_stats = None
+    latency_stats = None
+    event_recorder = None  # If set, incoming events are recorded (see event_recorder.py)
+    current_event_type = None  # Name of the event being dispatched (used to measure latencies)
+    current_event_arrival_time = None
+    current_event_midi_out_measured = False
 
     # notifications
     notification_text = None
     notification_time = 0
+    last_notification_drawn = None  # (notification time, alpha step) of the last notification frame drawn
+
+    def __init__(self, push2_backend=None):
+        self.display_state_lock = threading.RLock()
+        self.display_thread_stop = threading.Event()
+        self.display_mode_states = {}
+        self.midi_ports_lock = threading.RLock()
 
-    def __init__(self):
         if os.path.exists('settings.json'):
             settings = json.load(open('settings.json'))
         else:
             settings = {}
 
         self.set_midi_in_channel(settings.get('midi_in_default_channel', 0))
+        self.midi_in_transform = MIDIInputTransform(settings.get('midi_in_transform', {}))
+        self.midi_in_mode_messages = collections.deque()
+        self.midi_in_worker = MIDIInputWorker(self.handle_midi_in, max_queue_size=definitions.MIDI_IN_QUEUE_MAX_SIZE)
         self.set_midi_out_channel(settings.get('midi_out_default_channel', 0))
         self.target_frame_rate = settings.get('target_frame_rate', 60)
+        self.idle_frame_rate = settings.get('idle_frame_rate', 5)
+        self.frame_scheduler = FrameScheduler(target_frame_rate=self.target_frame_rate, idle_frame_rate=self.idle_frame_rate,
+                                              idle_timeout=definitions.IDLE_TIMEOUT)
+        self.display_frame_pacer = FramePacer(self.frame_scheduler)
+        self.main_loop_frame_pacer = FramePacer(self.frame_scheduler)
+        self.event_queue = EventQueue(fast_lane_max_size=definitions.EVENT_QUEUE_FAST_LANE_MAX_SIZE,
+                                      ui_lane_max_size=definitions.EVENT_QUEUE_UI_LANE_MAX_SIZE,
+                                      max_batch_size=definitions.EVENT_QUEUE_MAX_BATCH_SIZE)
+        self.main_loop_wake_event = threading.Event()
+        self.event_queue.on_event_added = self.wake_up_main_loop
+        self.event_coalescer = EventCoalescer(window=settings.get('event_coalescing_window', definitions.EVENT_COALESCING_WINDOW),
+                                              exempt=settings.get('event_coalescing_exempt', []))
+        self.midi_output_shaping = settings.get('midi_output_shaping', True)
+        self.midi_output_max_rate = settings.get('midi_output_max_rate', definitions.MIDI_OUTPUT_MAX_RATE)
+        self.midi_output_max_rates = settings.get('midi_output_max_rates', {})
+        self.midi_output_drop_repeats = settings.get('midi_output_drop_repeats', True)
+        self.midi_output_link_rate = settings.get('midi_output_link_rate', definitions.MIDI_OUTPUT_LINK_RATE)
+        self.midi_output_congestion_threshold = settings.get('midi_output_congestion_threshold', definitions.MIDI_OUTPUT_CONGESTION_THRESHOLD)
+        self.midi_output_pool = MIDIOutputPool(self.create_midi_output)
+        self.midi_port_watcher_interval = settings.get('midi_port_watcher_interval', definitions.MIDI_PORT_WATCHER_INTERVAL)
+        self.midi_port_watcher = MIDIPortWatcher(self.on_midi_ports_changed, poll_interval=self.midi_port_watcher_interval,
+                                                 ignored_names=['Ableton Push'])
         self.use_push2_display = settings.get('use_push2_display', True)
-
+        self.use_pysha_frame_encoder = settings.get('use_pysha_frame_encoder', True)
+        self.display_render_format = settings.get('display_render_format', DISPLAY_RENDER_FORMAT_RGB565)
+        if self.display_render_format == DISPLAY_RENDER_FORMAT_ARGB32 and not self.use_pysha_frame_encoder:
+            print('ARGB32 display render format requires Pysha frame encoder, using RGB565')
+            self.display_render_format = DISPLAY_RENDER_FORMAT_RGB565
+        self.display_frame_encoder = Push2FrameEncoder()
+        self.display_render_stats = RollingStats()
+        self.latency_stats = LatencyStats()
+
+        self.midi_in_worker.start()
         self.init_midi_in(device_name=settings.get('default_midi_in_device_name', None))
         self.init_midi_out(device_name=settings.get('default_midi_out_device_name', None))
-        self.init_push()
+        self.init_push(backend=push2_backend if push2_backend is not None else settings.get('push2_backend', 'hardware'))
 
         self.init_modes(settings)
+        self.open_track_midi_outputs()
         self.send_local_off_to_dominion()
         
     def init_modes(self, settings):
         self.main_controls_mode = MainControlsMode(self, settings=settings)
-        self.active_modes.append(self.main_controls_mode)
+        self.set_active_modes([self.main_controls_mode])
 
         self.melodic_mode = MelodicMode(self, settings=settings)
         self.rhyhtmic_mode = RhythmicMode(self, settings=settings)
@@ -84,7 +201,7 @@ class PyshaApp(object):
         self.pyramid_track_triggering_mode = PyramidTrackTriggeringMode(self, settings=settings)
         self.preset_selection_mode = PresetSelectionMode(self, settings=settings)
         self.midi_cc_mode = MIDICCMode(self, settings=settings)  # Must be initialized after track selection mode so it gets info about loaded tracks
-        self.active_modes += [self.track_selection_mode, self.midi_cc_mode]
+        self.set_active_modes(self.active_modes + [self.track_selection_mode, self.midi_cc_mode])
         self.track_selection_mode.select_track(self.track_selection_mode.selected_track)
 
         self.settings_mode = SettingsMode(self, settings=settings)
@@ -95,14 +212,48 @@ class PyshaApp(object):
     def is_mode_active(self, mode):
         return mode in self.active_modes
 
+    def set_active_modes(self, new_active_modes):
+        # Modes that become active redraw their display layer as their state might have changed while inactive
+        for mode in new_active_modes:
+            if mode not in self.active_modes:
+                mode.display_layer_needs_update = True
+        self.active_modes = new_active_modes
+        self.rebuild_event_dispatch_tables()
+        self.display_needs_update = True
+
+    def rebuild_event_dispatch_tables(self):
+        # For each Push2 event, list the handler methods of the active modes that implement it, in the order in which
+        # they get the event (last activated mode first). Lists per button/encoder name are filled in lazily by
+        # get_event_handlers and only include modes that handle that button/encoder.
+        handlers = {}
+        for event_name in PUSH2_EVENT_NAMES:
+            handlers[event_name] = [getattr(mode, event_name) for mode in reversed(self.active_modes)
+                                    if getattr(type(mode), event_name) is not getattr(definitions.PyshaMode, event_name)]
+        handlers_per_control = {event_name: {} for event_name in PUSH2_CONTROL_EVENT_NAMES}
+        self.event_dispatch_tables = (handlers, handlers_per_control)  # Replaced at once so other threads see a consistent state
+
+    def get_event_handlers(self, event_name, control_name=None):
+        handlers, handlers_per_control = self.event_dispatch_tables
+        if event_name not in handlers_per_control:
+            return handlers[event_name]
+        control_handlers = handlers_per_control[event_name].get(control_name, None)
+        if control_handlers is None:
+            handled_names_attribute = PUSH2_CONTROL_EVENT_NAMES[event_name]
+            control_handlers = [handler for handler in handlers[event_name]
+                                if getattr(handler.__self__, handled_names_attribute) is None or control_name in getattr(handler.__self__, handled_names_attribute)]
+            handlers_per_control[event_name][control_name] = control_handlers
+        return control_handlers
+
     def toggle_and_rotate_settings_mode(self):
+        self.display_needs_update = True
+        self.midi_cc_mode.invalidate_display()  # MIDI CC mode does not draw the parts of the display covered by settings
         if self.is_mode_active(self.settings_mode):
             rotation_finished = self.settings_mode.move_to_next_page()
             if rotation_finished:
-                self.active_modes = [mode for mode in self.active_modes if mode != self.settings_mode]
+                self.set_active_modes([mode for mode in self.active_modes if mode != self.settings_mode])
                 self.settings_mode.deactivate()
         else:
-            self.active_modes.append(self.settings_mode)
+            self.set_active_modes(self.active_modes + [self.settings_mode])
             self.settings_mode.activate()
 
     def set_mode_for_xor_group(self, mode_to_set):
@@ -112,7 +263,6 @@ class PyshaApp(object):
         automatically set'''
 
         if not self.is_mode_active(mode_to_set):
-        
             # First deactivate all existing modes for that xor group
             new_active_modes = []
             for mode in self.active_modes:
@@ -121,10 +271,10 @@ class PyshaApp(object):
                     self.previously_active_mode_for_xor_group[mode.xor_group] = mode  # Store last mode that was active for the group
                 else:
                     new_active_modes.append(mode)
-            self.active_modes = new_active_modes
             
             # Now add the mode to set to the active modes list and activate it
             new_active_modes.append(mode_to_set)
+            self.set_active_modes(new_active_modes)
             mode_to_set.activate()
 
     def unset_mode_for_xor_group(self, mode_to_unset):
@@ -134,7 +284,7 @@ class PyshaApp(object):
         if self.is_mode_active(mode_to_unset):
 
             # Deactivate the mode to unset
-            self.active_modes = [mode for mode in self.active_modes if mode != mode_to_unset]
+            self.set_active_modes([mode for mode in self.active_modes if mode != mode_to_unset])
             mode_to_unset.deactivate()
 
             # Activate the previous mode that was activated for the same xor_group. If none listed, activate a default one
@@ -193,17 +343,30 @@ class PyshaApp(object):
             previously_selected_track = self.track_selection_mode.selected_track
             self.track_selection_mode.select_track(dominion_track_number)
             local_off_message = mido.Message('control_change', control=122, value=0)
-            self.send_midi(local_off_message)
+            self.send_midi(local_off_message, shape=False)
             self.track_selection_mode.select_track(previously_selected_track)
 
     def save_current_settings_to_file(self):
         settings = {
             'midi_in_default_channel': self.midi_in_channel,
+            'midi_in_transform': self.midi_in_transform.settings,
             'midi_out_default_channel': self.midi_out_channel,
-            'default_midi_in_device_name': self.midi_in.name if self.midi_in is not None else None,
-            'default_midi_out_device_name': self.midi_out.name if self.midi_out is not None else None,
+            'default_midi_in_device_name': self.midi_in_device_name,
+            'default_midi_out_device_name': self.midi_out_device_name,
             'use_push2_display': self.use_push2_display,
             'target_frame_rate': self.target_frame_rate,
+            'idle_frame_rate': self.idle_frame_rate,
+            'use_pysha_frame_encoder': self.use_pysha_frame_encoder,
+            'display_render_format': self.display_render_format,
+            'event_coalescing_window': self.event_coalescer.window,
+            'event_coalescing_exempt': sorted(self.event_coalescer.exempt),
+            'midi_output_shaping': self.midi_output_shaping,
+            'midi_output_max_rate': self.midi_output_max_rate,
+            'midi_output_max_rates': self.midi_output_max_rates,
+            'midi_output_drop_repeats': self.midi_output_drop_repeats,
+            'midi_output_link_rate': self.midi_output_link_rate,
+            'midi_output_congestion_threshold': self.midi_output_congestion_threshold,
+            'midi_port_watcher_interval': self.midi_port_watcher_interval,
         }
         for mode in self.get_all_modes():
             mode_settings = mode.get_settings_to_save()
@@ -212,8 +375,13 @@ class PyshaApp(object):
         json.dump(settings, open('settings.json', 'w'))
 
     def init_midi_in(self, device_name=None):
+        with self.midi_ports_lock:  # MIDI port watcher can reconnect devices from its thread
+            self.configure_midi_in(device_name=device_name)
+
+    def configure_midi_in(self, device_name=None):
         print('Configuring MIDI in...')
-        self.available_midi_in_device_names = [name for name in mido.get_input_names() if 'Ableton Push' not in name]
+        self.midi_in_device_name = device_name
+        self.update_available_midi_in_device_names()
 
         if device_name is not None:
             if self.midi_in is not None:
@@ -236,29 +404,166 @@ class PyshaApp(object):
             print('Not receiving from any MIDI input')
 
     def init_midi_out(self, device_name=None):
+        with self.midi_ports_lock:
+            self.configure_midi_out(device_name=device_name)
+
+    def configure_midi_out(self, device_name=None):
         print('Configuring MIDI out...')
-        self.available_midi_out_device_names = [name for name in mido.get_output_names() if 'Ableton Push' not in name]
-        self.available_midi_out_device_names += ['Virtual']
+        self.midi_out_device_name = device_name
+        self.update_available_midi_out_device_names()
 
         if device_name is not None:
-            try:
-                if device_name == 'Virtual':
-                    self.midi_out = mido.open_output(device_name, virtual=True)
-                else:
-                    self.midi_out = mido.open_output(device_name)
+            output = self.midi_output_pool.get(device_name)
+            if output is not None:
+                self.midi_out = output
                 print('Will send MIDI to "{0}"'.format(device_name))
-            except IOError:
+            else:
                 print('Could not connect to MIDI output port "{0}"\nAvailable device names:'.format(device_name))
                 for name in self.available_midi_out_device_names:
                     print(' - {0}'.format(name))
         else:
-            if self.midi_out is not None:
-                self.midi_out.close()
-                self.midi_out = None
+            # Port is kept open in the output pool as tracks might be routed to it
+            self.midi_out = None
 
         if self.midi_out is None:
             print('Won\'t send MIDI to any device')
 
+    def update_available_midi_in_device_names(self):
+        self.available_midi_in_device_names = [name for name in mido.get_input_names() if 'Ableton Push' not in name]
+
+    def update_available_midi_out_device_names(self):
+        self.available_midi_out_device_names = [name for name in mido.get_output_names() if 'Ableton Push' not in name] + ['Virtual']
+
+    def get_midi_in_device_idx(self):
+        # Index of the current MIDI in device in available_midi_in_device_names (-1 if none or not in the list)
+        if self.midi_in is not None and self.midi_in.name in self.available_midi_in_device_names:
+            return self.available_midi_in_device_names.index(self.midi_in.name)
+        return -1
+
+    def get_midi_out_device_idx(self):
+        # Index of the current MIDI out device in available_midi_out_device_names (-1 if none or not in the list)
+        if self.midi_out is not None and self.midi_out.name in self.available_midi_out_device_names:
+            return self.available_midi_out_device_names.index(self.midi_out.name)
+        return -1
+
+    def on_midi_ports_changed(self, added_input_names, removed_input_names, added_output_names, removed_output_names):
+        # Called from the MIDI port watcher thread when MIDI devices are plugged or unplugged (or when a reconnect is
+        # requested, then all present ports are passed as added). Ports of devices that went away are closed and
+        # configured devices that are present but not open are opened here and handed over to the main loop and
+        # MIDI in worker, which never open ports themselves. Returns the names of the devices reconnected.
+        reconnected_names = []
+        with self.midi_ports_lock:
+            if added_input_names or removed_input_names:
+                self.update_available_midi_in_device_names()
+            if added_output_names or removed_output_names:
+                self.update_available_midi_out_device_names()
+            if self.midi_in is not None and self.midi_in.name in removed_input_names:
+                print('MIDI in device "{0}" went away'.format(self.midi_in.name))
+                self.midi_in.callback = None
+                self.midi_in.close()
+                self.midi_in = None
+            for name in removed_output_names:
+                self.midi_output_pool.discard(name)
+
+            if self.midi_in is None and self.midi_in_device_name in added_input_names:
+                self.configure_midi_in(self.midi_in_device_name)
+                if self.midi_in is not None:
+                    reconnected_names.append(self.midi_in_device_name)
+
+            track_device_names = self.get_track_midi_device_names()
+            track_selection_mode = getattr(self, 'track_selection_mode', None)
+            track_info = track_selection_mode.get_current_track_info() if track_selection_mode is not None else {}
+            for name in added_output_names:
+                if name != self.midi_out_device_name and name not in track_device_names:
+                    continue
+                output = self.midi_output_pool.get_open(name)
+                if output is None:
+                    output = self.midi_output_pool.get(name, retry_now=True)
+                    if output is None:
+                        continue
+                    reconnected_names.append(name)
+                # Outputs in use are replaced here (instead of the next time a message is sent to them)
+                if name == self.midi_out_device_name and self.midi_out is not output:
+                    self.midi_out = output
+                if name == track_info.get('midi_device_out', None) and self.track_midi_out is not output:
+                    self.track_midi_out = output
+        return reconnected_names
+
+    def get_track_midi_device_names(self):
+        track_selection_mode = getattr(self, 'track_selection_mode', None)
+        if track_selection_mode is None:
+            return set()
+        return set(track['midi_device_out'] for track in track_selection_mode.tracks_info if track.get('midi_device_out', None) is not None)
+
+    def open_track_midi_outputs(self):
+        # Opens the outputs of the devices tracks are routed to (at startup, so they are not opened from the main loop)
+        for device_name in sorted(self.get_track_midi_device_names()):
+            self.midi_output_pool.get(device_name)
+        self.update_track_midi_out()
+
+    def create_midi_output(self, device_name):
+        # Opens a MIDI output port with its own shaper and serializer (called by the MIDI output pool)
+        if device_name == 'Virtual':
+            port = mido.open_output(device_name, virtual=True)
+        else:
+            port = mido.open_output(device_name)
+        shaper = None
+        if self.midi_output_shaping:
+            shaper = MIDIOutputShaper(max_rate=self.midi_output_max_rate, max_rates=self.midi_output_max_rates,
+                                      drop_repeats=self.midi_output_drop_repeats)
+        serializer = None
+        if self.midi_output_link_rate:
+            serializer = MIDIOutputSerializer(bytes_per_second=self.midi_output_link_rate,
+                                              congestion_threshold=self.midi_output_congestion_threshold)
+        return MIDIOutput(port, shaper=shaper, serializer=serializer)
+
+    def update_track_midi_out(self):
+        # Routes the messages of the selected track to the output device and channel of the track (if it has them)
+        # or to the default MIDI out device and channel. Output ports come from the pool, so switching tracks never
+        # opens ports. If the device of the track is not open, messages go to the default MIDI out until the MIDI
+        # port watcher opens it.
+        track_selection_mode = getattr(self, 'track_selection_mode', None)  # Not created yet when MIDI is first configured
+        track_info = track_selection_mode.get_current_track_info() if track_selection_mode is not None else {}
+        previous_midi_out = self.get_current_midi_out()
+        device_name = track_info.get('midi_device_out', None)
+        self.track_midi_out = self.midi_output_pool.get_open(device_name) if device_name is not None else None
+        if device_name is not None and self.track_midi_out is None and self.midi_port_watcher is not None:
+            self.midi_port_watcher.request_reconnect()
+        channel = track_info.get('midi_channel_out', None)
+        self.midi_out_status = CHANNEL_STATUS_BYTES[channel if channel is not None else self.midi_out_channel]
+        for output in set([previous_midi_out, self.get_current_midi_out()]):
+            self.reset_midi_output_shaper(output)
+
+    def reset_midi_output_shaper(self, output):
+        # The MIDI output shaper drops values equal to the last ones sent to a device and channel, but tracks can
+        # share device and channel (e.g. Pyramid tracks), so a value sent to the previous track must not stop the
+        # same value from being sent to the new one. Rate limited values still pending are sent before forgetting them.
+        if output is None or output.closed or output.shaper is None:
+            return
+        with output.lock:
+            for message_bytes in output.shaper.pop_due_messages(time.monotonic(), flush=True):
+                self.write_midi_bytes(output, message_bytes)
+            output.shaper.reset()
+
+    def get_current_midi_out(self):
+        return self.track_midi_out if self.track_midi_out is not None else self.midi_out
+
+    def reopen_midi_out(self, output):
+        # Returns the output that replaced an output that was discarded, or None if the MIDI port watcher has not
+        # reopened the device yet (while the watcher thread runs, ports are never opened here as this is called from
+        # the main loop and the MIDI in worker)
+        new_output = self.midi_output_pool.get_open(output.name)
+        if new_output is None:
+            self.midi_port_watcher.request_reconnect()  # Reconnects here if the watcher thread is not running
+            new_output = self.midi_output_pool.get_open(output.name)
+            if new_output is None:
+                return None
+        if self.midi_out is output:
+            self.midi_out = new_output
+        if self.track_midi_out is output:
+            self.track_midi_out = new_output
+        return new_output
+
     def set_midi_in_channel(self, channel, wrap=False):
         self.midi_in_channel = channel
         if self.midi_in_channel < -1:  # Use "-1" for "all channels"
@@ -272,6 +577,7 @@ class PyshaApp(object):
             self.midi_out_channel = 0 if not wrap else 15
         elif self.midi_out_channel > 15:
             self.midi_out_channel = 15 if not wrap else 0
+        self.update_track_midi_out()
 
     def set_midi_in_device_by_index(self, device_idx):
         if device_idx >= 0 and device_idx < len(self.available_midi_in_device_names):
@@ -285,30 +591,192 @@ class PyshaApp(object):
         else:
             self.init_midi_out(None)
 
-    def send_midi(self, msg, force_channel=None):
-        if self.midi_out is not None:
-            if hasattr(msg, 'channel'):
-                channel = force_channel if force_channel is not None else self.midi_out_channel
-                msg = msg.copy(channel=channel)  # If message has a channel attribute, update it
-            self.midi_out.send(msg)
+    def send_midi(self, msg, force_channel=None, shape=True, output=None):
+        # Sends a mido.Message. Use send_midi_raw instead when sending messages from time-critical code.
+        message_bytes = msg.bytes()
+        if hasattr(msg, 'channel'):
+            # If message has a channel attribute, update it (in the status byte, so the message is not copied)
+            channel = force_channel if force_channel is not None else self.midi_out_status.channel
+            message_bytes[0] = (message_bytes[0] & 0xF0) | channel
+        self.send_midi_bytes(message_bytes, shape=shape, output=output)
+
+    def send_midi_raw(self, status, data1, data2=None, shape=True, output=None):
+        # Sends a channel message given its status and data bytes. Status bytes for the output channel of the selected
+        # track are precomputed in self.midi_out_status (e.g. self.app.send_midi_raw(self.app.midi_out_status.note_on, 60, 127)),
+        # status bytes for other channels are in midi_output.CHANNEL_STATUS_BYTES. Use shape=False for controller
+        # messages which should never be thinned by the MIDI output shaper or merged by the output serializer when
+        # the link is congested (e.g. messages that trigger actions). Messages go to the output of the selected track unless output is given (e.g. self.app.midi_out).
+        self.send_midi_bytes([status, data1] if data2 is None else [status, data1, data2], shape=shape, output=output)
+
+    def midi_batch(self, output=None):
+        # Returns a context manager which collects the MIDI messages sent inside it to output (by default the output
+        # of the selected track) and writes them back to back when it exits (other threads can't send to that output
+        # while the batch is open):
+        #     with self.app.midi_batch():
+        #         for ...: self.app.send_midi_raw(...)
+        return MIDIBatch(output if output is not None else self.get_current_midi_out(), on_error=self.on_midi_output_error)
+
+    def send_midi_bytes(self, message_bytes, shape=True, output=None):
+        if output is None:
+            output = self.track_midi_out if self.track_midi_out is not None else self.midi_out
+            if output is None:
+                return
+        if output.closed:
+            output = self.reopen_midi_out(output)
+            if output is None:
+                return
+        with output.lock:  # Messages are sent from the main loop and from the MIDI in worker thread
+            if shape and output.shaper is not None:
+                now = time.monotonic()
+                if output.shaper.add(message_bytes, now):
+                    return  # Message dropped or held until controller can send again (see process_events)
+                for pending_message_bytes in output.shaper.pop_messages_to_flush_before(message_bytes, now):
+                    self.write_midi_bytes(output, pending_message_bytes)
+            self.write_midi_bytes(output, message_bytes, mergeable=shape)
+
+    def get_midi_out_link_utilization(self):
+        # Estimated fraction of the MIDI out link bandwidth in use (None if the output serializer is disabled)
+        if self.midi_out is None or self.midi_out.serializer is None:
+            return None
+        return self.midi_out.serializer.get_utilization(time.monotonic())
+
+    def write_midi_bytes(self, output, message_bytes, mergeable=True):
+        if output.serializer is not None:
+            if output.batch is not None:
+                # Explicit batches are written as a whole
+                output.serializer.account(message_bytes, time.monotonic())
+            elif output.serializer.add(message_bytes, time.monotonic(), mergeable=mergeable):
+                return  # MIDI out link is congested, message will be written later (see process_events)
+        try:
+            output.send_bytes(message_bytes)
+        except (IOError, OSError) as e:
+            self.on_midi_output_error(output, e)
+            return
+        if self.current_event_arrival_time is not None and not self.current_event_midi_out_measured \
+                and not self.midi_in_worker.is_worker_thread():
+            # Only the first MIDI message sent while handling an event is measured
+            self.current_event_midi_out_measured = True
+            self.latency_stats.add(self.current_event_type, 'midi_out', time.perf_counter() - self.current_event_arrival_time)
+
+    def on_midi_output_error(self, output, error):
+        # Device probably went away, it will be reopened (if available) next time a message is sent to it. Invalid
+        # messages are skipped by MIDIOutput and don't get here.
+        print('Error sending MIDI to "{0}": {1}'.format(output.name, error))
+        self.midi_output_pool.discard(output.name)
+        self.midi_port_watcher.request_reconnect()
 
     def midi_in_handler(self, msg):
+        # Called from mido's thread, messages are handled in the MIDI in worker thread (see handle_midi_in)
         if hasattr(msg, 'channel'):  # This will rule out sysex and other "strange" messages that don't have channel info
-            if self.midi_in_channel == -1 or msg.channel == self.midi_in_channel:   # If midi input channel is set to -1 (all) or a specific channel
-                
-                # Forward message to the MIDI out
-                self.send_midi(msg)  
-
-                # Forward the midi message to the active modes
-                for mode in self.active_modes:
+            if self.event_recorder is not None:
+                self.event_recorder.record_midi_in(msg)
+            self.midi_in_worker.put(msg)
+
+    def handle_midi_in(self, msg, arrival_time=None):
+        # Called from the MIDI in worker thread. Messages are forwarded to the MIDI out right away, but modes get them
+        # in the main loop (see process_midi_in_mode_messages) so UI state is only changed from there. Messages are
+        # handled as raw bytes, a mido.Message for the transformed message is only created if a mode needs it.
+        if not hasattr(msg, 'channel'):
+            return
+        message_bytes = msg.bytes()
+        if self.midi_in_channel != -1 and message_bytes[0] & 0x0F != self.midi_in_channel:
+            return  # Not from the MIDI in channel (-1 means all channels)
+
+        if self.midi_in_transform.enabled:
+            # Apply input transform (splits, transposition, velocity curve...), the transformed message is the one
+            # forwarded to the MIDI out and to the active modes
+            channel = self.midi_in_transform.apply(message_bytes)
+            if channel == DROP:
+                return
+            if channel is None:
+                channel = self.midi_out_status.channel
+            msg = None  # Created from message_bytes if a mode needs it
+        else:
+            # Forward message to the MIDI out
+            channel = self.midi_out_status.channel
+        message_bytes[0] = (message_bytes[0] & 0xF0) | channel
+        self.send_midi_bytes(message_bytes)
+        if arrival_time is not None:
+            self.latency_stats.add('midi_in', 'midi_out', time.perf_counter() - arrival_time)
+
+        # Queue the midi message for the active modes (when the queue is full, notes are still queued so modes don't
+        # miss note offs)
+        message_type = message_bytes[0] & 0xF0
+        if len(self.midi_in_mode_messages) >= definitions.MIDI_IN_MODE_MESSAGES_MAX_SIZE \
+                and message_type != NOTE_ON and message_type != NOTE_OFF:
+            self.n_midi_in_mode_messages_dropped += 1
+        else:
+            self.midi_in_mode_messages.append((msg, message_bytes))
+            self.wake_up_main_loop()
+
+    def process_midi_in_mode_messages(self):
+        # Passes the messages received from MIDI in since the last call to the active modes that handle MIDI in,
+        # returns the number of messages passed
+        n_messages = len(self.midi_in_mode_messages)
+        modes = [mode for mode in self.active_modes if type(mode).on_midi_in is not definitions.PyshaMode.on_midi_in]
+        for _ in range(0, n_messages):
+            msg, message_bytes = self.midi_in_mode_messages.popleft()
+            if not modes:
+                continue
+            if msg is None:
+                msg = mido.Message.from_bytes(message_bytes)
+            for mode in modes:
+                try:
                     mode.on_midi_in(msg)
+                except Exception as e:
+                    print('Error handling MIDI in message {0}: {1}'.format(msg, str(e)))
+                    traceback.print_exc()
+        return n_messages
+
+    def get_midi_in_stats(self):
+        stats = self.midi_in_worker.get_stats()
+        stats['mode_messages_depth'] = len(self.midi_in_mode_messages)
+        stats['mode_messages_dropped'] = self.n_midi_in_mode_messages_dropped
+        stats['transform'] = self.midi_in_transform.get_stats()
+        return stats
 
     def add_display_notification(self, text):
-        self.notification_text = text
-        self.notification_time = time.time()
-
-    def init_push(self):
+        with self.display_state_lock:
+            self.notification_text = text
+            self.notification_time = time.time()
+        self.display_needs_update = True
+        self.frame_scheduler.request_full_rate_for(definitions.NOTIFICATION_TIME)
+
+    def update_display_state(self):
+        # Called from the main loop (the only thread that changes modes' state). If something shown in the display
+        # changed, takes an immutable snapshot of what the modes that need to be redrawn show (see
+        # PyshaMode.get_display_state) and of the active modes, and hands it over to the display thread. Snapshots of
+        # modes not drawn yet by the display thread are replaced by newer ones.
+        if not self.display_needs_update:
+            return
+        self.display_needs_update = False
+        mode_states = {}
+        for mode in self.active_modes:
+            if mode.display_layer_needs_update and self.mode_draws_display(mode):
+                mode.display_layer_needs_update = False
+                mode_states[mode] = mode.get_display_state()
+        with self.display_state_lock:
+            self.display_active_modes = tuple(self.active_modes)
+            self.display_mode_states.update(mode_states)
+            self.display_state_changed = True
+
+    def get_display_state_snapshot(self):
+        # Called from the display thread. Returns the last active modes snapshot, the mode display states not drawn yet,
+        # whether the snapshot changed since last call and the current notification
+        with self.display_state_lock:
+            mode_states = self.display_mode_states
+            self.display_mode_states = {}
+            state_changed = self.display_state_changed
+            self.display_state_changed = False
+            return self.display_active_modes, mode_states, state_changed, self.notification_text, self.notification_time
+
+    def init_push(self, backend='hardware'):
         print('Configuring Push...')
+        if backend == 'fake':
+            # Use in-process stand-in for Push2 (useful for benchmarking or running without the hardware)
+            print('Using fake Push2 backend')
+            self.push = FakePush2(event_handler=self.on_push2_event)
+            return
         self.push = push2_python.Push2()
         if platform.system() == "Linux":
             # When this app runs in Linux is because it is running on the Raspberrypi
@@ -326,28 +794,156 @@ class PyshaApp(object):
             mode.update_buttons()
 
     def update_push2_display(self):
+        # Draws and sends a new frame (in the display thread) if the display state snapshot changed or a notification
+        # is fading out. If the display thread is not running (e.g. when benchmarking with the fake Push2), the
+        # snapshot is taken here.
         if self.use_push2_display:
-            # Prepare cairo canvas
+            if self.display_thread is None:
+                self.update_display_state()
+            active_modes, mode_states, needs_update, notification_text, notification_time = self.get_display_state_snapshot()
+
+            # Notifications fade out, so the display needs to be redrawn while one is shown. The notification overlay
+            # uses a limited number of opacity steps so only redraw when the fade reaches a new step (or ends)
+            notification_opacity = 0.0
+            if notification_text is not None:
+                notification_opacity = 1 - (time.time() - notification_time) / definitions.NOTIFICATION_TIME
+                notification_drawn = (notification_time, notification_overlay.get_alpha_step(notification_opacity))
+                if notification_drawn != self.last_notification_drawn or notification_opacity <= 0:
+                    needs_update = True
+
+            if not needs_update:
+                # Nothing changed since last frame, skip drawing. Only re-send the last frame from time to time
+                # because Push2 turns the display off if it does not receive new frames for a while
+                if self.display_front_buffer is not None and time.time() - self.last_display_frame_sent_time > definitions.DISPLAY_FRAME_KEEP_ALIVE_TIME:
+                    self.send_display_frame(encode=False)
+                return
+
+            # Prepare cairo canvas (clear the back buffer from previous frame)
             w, h = push2_python.constants.DISPLAY_LINE_PIXELS, push2_python.constants.DISPLAY_N_LINES
-            surface = cairo.ImageSurface(cairo.FORMAT_RGB16_565, w, h)
-            ctx = cairo.Context(surface)
+            if self.display_back_buffer is None:
+                surface_format = cairo.FORMAT_ARGB32 if self.display_render_format == DISPLAY_RENDER_FORMAT_ARGB32 else cairo.FORMAT_RGB16_565
+                self.display_front_buffer = DisplayFrameBuffer(w, h, surface_format=surface_format)
+                self.display_back_buffer = DisplayFrameBuffer(w, h, surface_format=surface_format)
+            render_start_time = time.perf_counter()
+            ctx = self.display_back_buffer.ctx
+            ctx.save()  # Save initial state so that state set by modes does not leak into next frame
+            ctx.new_path()
+            ctx.set_source_rgb(0, 0, 0)
+            ctx.paint()
             
-            # Call all active modes to write to context
-            for mode in self.active_modes:
-                mode.update_display(ctx, w, h)
+            # Composite the display layers of active modes (layers are only redrawn if their mode invalidated them)
+            for mode in active_modes:
+                layer = self.render_display_layer(mode, mode_states, w, h)
+                if layer is not None:
+                    layer.composite(ctx)
 
             # Show any notifications that should be shown
-            if self.notification_text is not None:
-                time_since_notification_started = time.time() - self.notification_time
-                if time_since_notification_started < definitions.NOTIFICATION_TIME:
-                    show_notification(ctx, self.notification_text, opacity=1 - time_since_notification_started/definitions.NOTIFICATION_TIME)
+            if notification_text is not None:
+                if notification_opacity > 0:
+                    show_notification(ctx, notification_text, opacity=notification_opacity)
+                    self.last_notification_drawn = (notification_time, notification_overlay.get_alpha_step(notification_opacity))
                 else:
-                    self.notification_text = None
-            
-            # Convert cairo data to numpy array and send to push
-            buf = surface.get_data()
-            frame = numpy.ndarray(shape=(h, w), dtype=numpy.uint16, buffer=buf).transpose()
-            self.push.display.display_frame(frame, input_format=push2_python.constants.FRAME_FORMAT_RGB565)
+                    with self.display_state_lock:
+                        if self.notification_time == notification_time:  # Don't remove notifications added while drawing
+                            self.notification_text = None
+
+            ctx.restore()
+            self.display_back_buffer.surface.flush()
+            self.display_render_stats.add(time.perf_counter() - render_start_time)
+
+            # Swap buffers and send the new front buffer to push (frame is a view over the surface data)
+            self.display_front_buffer, self.display_back_buffer = self.display_back_buffer, self.display_front_buffer
+            self.send_display_frame()
+
+    def mode_draws_display(self, mode):
+        return type(mode).update_display is not definitions.PyshaMode.update_display
+
+    def render_display_layer(self, mode, mode_states, w, h):
+        # Returns the display layer of the mode, redrawing it first if there is a new display state snapshot for it.
+        # Returns None for modes that don't draw (or have not been drawn yet)
+        if not self.mode_draws_display(mode):
+            return None
+        if mode in mode_states:
+            if mode.display_layer is None:
+                mode.display_layer = DisplayLayer(w, h)
+            layer = mode.display_layer
+            if not mode.retains_display_layer:
+                layer.clear()
+            layer.ctx.save()
+            mode.update_display(layer.ctx, w, h, mode_states[mode])
+            layer.ctx.restore()
+            layer.ctx.new_path()
+            layer.surface.flush()
+            layer.n_redraws += 1
+        return mode.display_layer
+
+    def send_display_frame(self, encode=True):
+        # Sends the front buffer to Push2. With Pysha's frame encoder, the frame is only encoded when it changed,
+        # keep-alive re-sends reuse the last encoded frame
+        if self.use_pysha_frame_encoder:
+            if encode:
+                self.display_frame_encoder.encode(self.display_front_buffer.pixels)
+            self.display_frame_encoder.send(self.push)
+        else:
+            self.push.display.display_frame(self.display_front_buffer.frame, input_format=push2_python.constants.FRAME_FORMAT_RGB565)
+        self.last_display_frame_sent_time = time.time()
+
+    def display_loop(self):
+        # Runs in its own thread so that slow frames don't delay handling of delayed actions, pads/buttons updates and MIDI
+        while not self.display_thread_stop.is_set():
+            self.display_frame_pacer.begin_frame()
+
+            # Draw ui
+            try:
+                self.update_push2_display()
+            except Exception as e:
+                print('Error drawing display frame: {}'.format(str(e)))
+                traceback.print_exc()
+
+            # Frame rate measurement
+            now = time.monotonic()
+            self.current_frame_rate_measurement += 1
+            if now - self.current_frame_rate_measurement_second > 1.0:
+                self.actual_frame_rate = self.current_frame_rate_measurement
+                self.current_frame_rate_measurement = 0
+                self.current_frame_rate_measurement_second = now
+                self.display_timing_stats = self.get_display_timing_stats()
+                print('{0} fps ({1} fps target), frame time p50/p95/p99 {2}/{3}/{4} ms, {5} missed deadlines, render/encode/transfer p95 {6}/{7}/{8} ms'.format(
+                    self.actual_frame_rate, self.display_timing_stats['target_frame_rate'],
+                    *['{0:.1f}'.format(self.display_timing_stats[key]) if self.display_timing_stats[key] is not None else '-'
+                      for key in ['frame_time_p50_ms', 'frame_time_p95_ms', 'frame_time_p99_ms']],
+                    self.display_timing_stats['missed_deadlines'],
+                    *['{0:.2f}'.format(self.display_timing_stats[key]) if self.display_timing_stats[key] is not None else '-'
+                      for key in ['render_p95_ms', 'encode_p95_ms', 'transfer_p95_ms']]))
+
+            # Wait until next frame, frame rate is lowered when there is no activity
+            self.frame_scheduler.account_time_at_rate()
+            self.display_frame_pacer.end_frame_and_wait(stop_event=self.display_thread_stop)
+
+    def get_display_timing_stats(self):
+        # Returns display loop frame rate and (rolling) frame timing statistics, times in milliseconds
+        stats = self.display_frame_pacer.get_stats()
+        stats['actual_frame_rate'] = self.actual_frame_rate
+        stats['target_frame_rate'] = self.frame_scheduler.get_current_frame_rate()
+        stats['time_spent_at_rate'] = self.frame_scheduler.get_stats()['time_spent_at_rate']
+        render_p50, render_p95 = self.display_render_stats.get_percentiles((50, 95))
+        stats['render_p50_ms'] = render_p50 * 1000 if render_p50 is not None else None
+        stats['render_p95_ms'] = render_p95 * 1000 if render_p95 is not None else None
+        stats.update(self.display_frame_encoder.get_stats())  # Encode and transfer times (only with Pysha frame encoder)
+        stats['widget_render_stats'] = display_widgets.get_render_stats()  # Widgets and pixels drawn (to measure overdraw)
+        return stats
+
+    def start_display_thread(self):
+        self.display_thread_stop.clear()
+        self.display_thread = threading.Thread(target=self.display_loop, name='PyshaDisplay', daemon=True)
+        self.display_thread.start()
+
+    def stop_display_thread(self):
+        self.display_thread_stop.set()
+        self.frame_scheduler.wake_up()
+        if self.display_thread is not None:
+            self.display_thread.join()
+            self.display_thread = None
 
     def check_for_delayed_actions(self):
         # If MIDI not configured, make sure we try sending messages so it gets configured
@@ -368,34 +964,31 @@ class PyshaApp(object):
 
     def run_loop(self):
         print('Pysha is runnnig...')
+        self.start_display_thread()
+        if self.midi_port_watcher_interval > 0:
+            self.midi_port_watcher.start()
         try:
-            while True:
-                before_draw_time = time.time()
+            while not self.push.f_stop.is_set():
+                self.main_loop_frame_pacer.begin_frame()
 
-                # Draw ui
-                self.update_push2_display()
-
-                # Frame rate measurement
-                now = time.time()
-                self.current_frame_rate_measurement += 1
-                if time.time() - self.current_frame_rate_measurement_second > 1.0:
-                    self.actual_frame_rate = self.current_frame_rate_measurement
-                    self.current_frame_rate_measurement = 0
-                    self.current_frame_rate_measurement_second = now
-                    print('{0} fps'.format(self.actual_frame_rate))
+                # Handle events that arrived from Push2 and MIDI in
+                self.process_events()
 
                 # Check if any delayed actions need to be applied
                 self.check_for_delayed_actions()
 
-                after_draw_time = time.time()
+                # Hand what the display shows over to the display thread (drawing happens there)
+                self.update_display_state()
 
-                # Calculate sleep time to aproximate the target frame rate
-                sleep_time = (1.0 / self.target_frame_rate) - (after_draw_time - before_draw_time)
-                if sleep_time > 0:
-                    time.sleep(sleep_time)
+                # Wait until next iteration (same adaptive rate as the display), events are handled as soon as they arrive
+                self.main_loop_frame_pacer.end_frame_and_wait(process_events=self.process_events,
+                                                              wake_event=self.main_loop_wake_event)
 
         except KeyboardInterrupt:
             print('Exiting Pysha...')
+        finally:
+            self.stop_display_thread()
+            self.midi_port_watcher.stop()
             self.push.f_stop.set()
 
     def on_midi_push_connection_established(self):
@@ -403,32 +996,140 @@ class PyshaApp(object):
         print('Doing initial Push config...')
 
         # Configure custom color palette
-        app.push.color_palette = {}
+        self.push.color_palette = {}
         for count, color_name in enumerate(definitions.COLORS_NAMES):
-            app.push.set_color_palette_entry(count, [color_name, color_name], rgb=definitions.get_color_rgb(color_name), allow_overwrite=True)
-        app.push.reapply_color_palette()
+            self.push.set_color_palette_entry(count, [color_name, color_name], rgb=definitions.get_color_rgb(color_name), allow_overwrite=True)
+        self.push.reapply_color_palette()
 
         # Initialize all buttons to black, initialize all pads to off
-        app.push.buttons.set_all_buttons_color(color=definitions.BLACK)
-        app.push.pads.set_all_pads_to_color(color=definitions.BLACK)
+        self.push.buttons.set_all_buttons_color(color=definitions.BLACK)
+        self.push.pads.set_all_pads_to_color(color=definitions.BLACK)
 
-        # Iterate over modes and (re-)activate them
-        for mode in self.active_modes:
-            mode.activate()
+        # Iterate over modes and (re-)activate them (MIDI messages sent by the modes are written together)
+        with self.midi_batch():
+            for mode in self.active_modes:
+                mode.activate()
 
         # Update buttons and pads (just in case something was missing!)
-        app.update_push2_buttons()
-        app.update_push2_pads()
+        self.update_push2_buttons()
+        self.update_push2_pads()
+
+    def on_push2_event(self, event_name, *args):
+        # Called from push2_python action handlers (or from the fake Push2 backend) in push2_python's threads. Events
+        # are queued and handled in the main loop (note related events go in the event queue fast lane).
+        if self.event_recorder is not None:
+            self.event_recorder.record(event_name, args)
+        self.event_queue.put(event_name, args, fast=event_name in FAST_LANE_EVENT_NAMES)
+
+    def wake_up_main_loop(self):
+        # Called from the threads where events arrive (push2_python, MIDI in worker) after queueing them. Producers
+        # don't take the frame scheduler lock (which the display thread also uses), and only take the lock of the
+        # wake up event when the main loop has not been woken up yet since it last processed events
+        if not self.main_loop_wake_event.is_set():
+            self.main_loop_wake_event.set()
+
+    def process_events(self, flush=False):
+        # Handles a batch of queued events and coalesced events that are due (or all coalesced events if flush is True).
+        # Returns the (monotonic) time at which this should be called again even if no new events arrive, or None
+        n_handled = self.event_queue.process(self.handle_event)
+        n_handled += self.process_midi_in_mode_messages()
+        if n_handled:
+            # Frame rate goes to full rate while there is activity (notified once per batch, from the main loop)
+            self.frame_scheduler.notify_activity()
+        for event_name, args, arrival_time in self.event_coalescer.pop_due_events(time.monotonic() if not flush else float('inf')):
+            self.dispatch_event(event_name, args, arrival_time)
+        next_process_time = self.event_coalescer.get_next_flush_time()
+        for output in self.midi_output_pool.get_outputs():
+            next_flush_time = self.process_midi_output(output, flush=flush)
+            if next_flush_time is not None and (next_process_time is None or next_flush_time < next_process_time):
+                next_process_time = next_flush_time
+        if not self.event_queue.is_empty():
+            return time.monotonic()
+        return next_process_time
+
+    def process_midi_output(self, output, flush=False):
+        # Sends messages held by the shaper and serializer of a MIDI output once they can be sent (or right away if
+        # flush is True). Returns the (monotonic) time at which this needs to be called again, or None
+        with output.lock:
+            return self.process_midi_output_pending_messages(output, flush=flush)
+
+    def process_midi_output_pending_messages(self, output, flush=False):
+        now = time.monotonic()
+        next_flush_time = None
+        if output.shaper is not None and output.shaper.pending:
+            # Send the last value of rate limited controllers once they can send again
+            for message_bytes in output.shaper.pop_due_messages(now, flush=flush):
+                self.write_midi_bytes(output, message_bytes)
+            next_flush_time = output.shaper.get_next_flush_time()
+        if output.serializer is not None and output.serializer.get_next_flush_time() is not None:
+            # Write messages queued while the MIDI out link was congested once it has room for them
+            messages = output.serializer.pop_due_messages(now) if not flush else output.serializer.pop_all_messages(now)
+            for message_bytes in messages:
+                try:
+                    output.send_bytes(message_bytes)
+                except (IOError, OSError) as e:
+                    self.on_midi_output_error(output, e)
+                    return None
+            serializer_next_flush_time = output.serializer.get_next_flush_time()
+            if serializer_next_flush_time is not None and (next_flush_time is None or serializer_next_flush_time < next_flush_time):
+                next_flush_time = serializer_next_flush_time
+        return next_flush_time
+
+    def handle_event(self, event_name, args, arrival_time=None):
+        # The first encoder or aftertouch event of a burst is dispatched right away, the ones that follow are merged by
+        # the event coalescer and dispatched when their window ends (except for encoders an active mode needs to get
+        # increments from one by one)
+        coalesce = event_name != 'on_encoder_rotated' or not self.is_encoder_uncoalesced(args[0])
+        if coalesce and self.event_coalescer.add(event_name, args, arrival_time, time.monotonic()):
+            return
+        for pending_event in self.event_coalescer.pop_events_to_flush_before(event_name, args):
+            self.dispatch_event(*pending_event)
+        self.dispatch_event(event_name, args, arrival_time)
+
+    def is_encoder_uncoalesced(self, encoder_name):
+        for mode in self.active_modes:
+            if encoder_name in mode.get_uncoalesced_encoder_names():
+                return True
+        return False
+
+    def dispatch_event(self, event_name, args, arrival_time=None):
+        # Latencies are measured from the arrival of the event (see EventQueue) to the start of its dispatch ('queued'),
+        # to the end of its dispatch ('dispatched') and to the first MIDI message sent because of it ('midi_out')
+        if arrival_time is not None:
+            self.latency_stats.add(event_name, 'queued', time.perf_counter() - arrival_time)
+        self.current_event_type = event_name
+        self.current_event_arrival_time = arrival_time
+        self.current_event_midi_out_measured = False
+        try:
+            self.handle_push2_event(event_name, *args)
+        except Exception as e:
+            print('Error handling event {0}: {1}'.format(event_name, str(e)))
+            traceback.print_exc()
+        finally:
+            self.current_event_type = None
+            self.current_event_arrival_time = None
+        if arrival_time is not None:
+            self.latency_stats.add(event_name, 'dispatched', time.perf_counter() - arrival_time)
+
+    def handle_push2_event(self, event_name, *args):
+        # event_name is the name of the PyshaMode method that handles the event. Active modes get the event in
+        # reverse order until one of them takes action.
+        if event_name == 'on_midi_connected':
+            self.on_midi_push_connection_established()
+            return
+
+        control_name = args[0] if event_name in PUSH2_CONTROL_EVENT_NAMES else None
+        for handler in self.get_event_handlers(event_name, control_name):
+            action_performed = handler(*args)
+            if action_performed:
+                break  # If mode took action, stop event propagation
 
 
 # Bind push action handlers with class methods
 @push2_python.on_encoder_rotated()
 def on_encoder_rotated(_, encoder_name, increment):
     try:
-        for mode in app.active_modes[::-1]:
-            action_performed = mode.on_encoder_rotated(encoder_name, increment)
-            if action_performed:
-                break  # If mode took action, stop event propagation
+        app.on_push2_event('on_encoder_rotated', encoder_name, increment)
     except NameError as e:
        print('Error:  {}'.format(str(e)))
        traceback.print_exc()
@@ -437,10 +1138,7 @@ def on_encoder_rotated(_, encoder_name, increment):
 @push2_python.on_pad_pressed()
 def on_pad_pressed(_, pad_n, pad_ij, velocity):
     try:
-        for mode in app.active_modes[::-1]:
-            action_performed = mode.on_pad_pressed(pad_n, pad_ij, velocity)
-            if action_performed:
-                break  # If mode took action, stop event propagation
+        app.on_push2_event('on_pad_pressed', pad_n, pad_ij, velocity)
     except NameError as e:
        print('Error:  {}'.format(str(e)))
        traceback.print_exc()
@@ -449,10 +1147,7 @@ def on_pad_pressed(_, pad_n, pad_ij, velocity):
 @push2_python.on_pad_released()
 def on_pad_released(_, pad_n, pad_ij, velocity):
     try:
-        for mode in app.active_modes[::-1]:
-            action_performed = mode.on_pad_released(pad_n, pad_ij, velocity)
-            if action_performed:
-                break  # If mode took action, stop event propagation
+        app.on_push2_event('on_pad_released', pad_n, pad_ij, velocity)
     except NameError as e:
        print('Error:  {}'.format(str(e)))
        traceback.print_exc()
@@ -461,10 +1156,7 @@ def on_pad_released(_, pad_n, pad_ij, velocity):
 @push2_python.on_pad_aftertouch()
 def on_pad_aftertouch(_, pad_n, pad_ij, velocity):
     try:
-        for mode in app.active_modes[::-1]:
-            action_performed = mode.on_pad_aftertouch(pad_n, pad_ij, velocity)
-            if action_performed:
-                break  # If mode took action, stop event propagation
+        app.on_push2_event('on_pad_aftertouch', pad_n, pad_ij, velocity)
     except NameError as e:
        print('Error:  {}'.format(str(e)))
        traceback.print_exc()
@@ -473,10 +1165,7 @@ def on_pad_aftertouch(_, pad_n, pad_ij, velocity):
 @push2_python.on_button_pressed()
 def on_button_pressed(_, name):
     try:
-        for mode in app.active_modes[::-1]:
-            action_performed = mode.on_button_pressed(name)
-            if action_performed:
-                break  # If mode took action, stop event propagation
+        app.on_push2_event('on_button_pressed', name)
     except NameError as e:
        print('Error:  {}'.format(str(e)))
        traceback.print_exc()
@@ -485,10 +1174,7 @@ def on_button_pressed(_, name):
 @push2_python.on_button_released()
 def on_button_released(_, name):
     try:
-        for mode in app.active_modes[::-1]:
-            action_performed = mode.on_button_released(name)
-            if action_performed:
-                break  # If mode took action, stop event propagation
+        app.on_push2_event('on_button_released', name)
     except NameError as e:
        print('Error:  {}'.format(str(e)))
        traceback.print_exc()
@@ -497,10 +1183,7 @@ def on_button_released(_, name):
 @push2_python.on_touchstrip()
 def on_touchstrip(_, value):
     try:
-        for mode in app.active_modes[::-1]:
-            action_performed = mode.on_touchstrip(value)
-            if action_performed:
-                break  # If mode took action, stop event propagation
+        app.on_push2_event('on_touchstrip', value)
     except NameError as e:
        print('Error:  {}'.format(str(e)))
        traceback.print_exc()
@@ -509,10 +1192,7 @@ def on_touchstrip(_, value):
 @push2_python.on_sustain_pedal()
 def on_sustain_pedal(_, sustain_on):
     try:
-        for mode in app.active_modes[::-1]:
-            action_performed = mode.on_sustain_pedal(sustain_on)
-            if action_performed:
-                break  # If mode took action, stop event propagation
+        app.on_push2_event('on_sustain_pedal', sustain_on)
     except NameError as e:
        print('Error:  {}'.format(str(e)))
        traceback.print_exc()
@@ -521,7 +1201,7 @@ def on_sustain_pedal(_, sustain_on):
 @push2_python.on_midi_connected()
 def on_midi_connected(_):
     try:
-        app.on_midi_push_connection_established()
+        app.on_push2_event('on_midi_connected')
     except NameError as e:
        print('Error:  {}'.format(str(e)))
        traceback.print_exc()
@@ -529,5 +1209,28 @@ def on_midi_connected(_):
 
 # Run app main loop
 if __name__ == "__main__":
-    app = PyshaApp()
-    app.run_loop()
+    parser = argparse.ArgumentParser(description='Pysha: use Push2 as a standalone MIDI controller')
+    parser.add_argument('--record', metavar='PATH', help='record incoming Push2 and MIDI in events to an event log file')
+    parser.add_argument('--replay', metavar='PATH', help='replay events from an event log file')
+    parser.add_argument('--replay-speed', type=float, default=1.0, help='replay speed relative to real time (0 to replay as fast as possible)')
+    parser.add_argument('--replay-on-push2', action='store_true', help='use the connected Push2 when replaying (by default Push2 is replaced by the fake backend)')
+    args = parser.parse_args()
+
+    app = PyshaApp(push2_backend='fake' if args.replay and not args.replay_on_push2 else None)
+    if args.record:
+        app.event_recorder = EventRecorder(args.record)
+    if args.replay:
+        if isinstance(app.push, FakePush2):
+            app.push.connect()
+        replay_stop = threading.Event()
+        replayer = EventReplayer(app, args.replay, speed=args.replay_speed)
+        replayer.start(stop_event=replay_stop)
+    try:
+        app.run_loop()
+    finally:
+        if args.replay:
+            replay_stop.set()
+        app.midi_port_watcher.stop()
+        app.midi_in_worker.stop()
+        if app.event_recorder is not None:
+            app.event_recorder.close()
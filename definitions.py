@@ -9,6 +9,27 @@ LAYOUT_MELODIC = 'lmelodic'
 LAYOUT_RHYTHMIC = 'lrhytmic'
 
 NOTIFICATION_TIME = 3
+NOTIFICATION_ALPHA_STEPS = 32  # Notifications fade out in this number of steps (display is only redrawn when step changes)
+
+TEXT_CACHE_MAX_SIZE = 512  # Max number of pre-rendered text surfaces kept in display_utils text cache
+KNOB_SPRITE_CACHE_MAX_SIZE = 1024  # Max number of pre-rendered knob sprites kept in display_utils knob cache
+KNOB_SPRITE_VALUE_BUCKETS = 128  # Number of different knob positions that are rendered
+
+IDLE_TIMEOUT = 5.0  # Frame rate drops to idle frame rate if no activity happened in this time
+
+EVENT_QUEUE_FAST_LANE_MAX_SIZE = 4096  # Max number of queued pad/aftertouch/touchstrip events (new events are dropped if full)
+EVENT_QUEUE_UI_LANE_MAX_SIZE = 512  # Max number of queued button/encoder events
+EVENT_QUEUE_MAX_BATCH_SIZE = 64  # Max number of events handled in one go before checking frame deadlines
+EVENT_COALESCING_WINDOW = 0.01  # Encoder increments and aftertouch values arriving within this time (seconds) after one is handled are merged (0 to disable)
+MIDI_OUTPUT_MAX_RATE = 200  # Max messages per second sent for each continuous controller (CC, aftertouch, pitch bend), 0 for no limit
+MIDI_OUTPUT_LINK_RATE = 3125  # Bytes per second of the MIDI out link (3125 for DIN MIDI), 0 to disable output serializer
+MIDI_OUTPUT_CONGESTION_THRESHOLD = 0.003  # MIDI out link is congested when it needs more than this time (seconds) to send pending bytes
+MIDI_IN_QUEUE_MAX_SIZE = 4096  # Max number of MIDI in messages waiting to be forwarded (new messages are dropped if full)
+MIDI_IN_MODE_MESSAGES_MAX_SIZE = 1024  # Max number of MIDI in messages waiting to be passed to the active modes
+MIDI_PORT_WATCHER_INTERVAL = 1.0  # Seconds between checks for MIDI devices being plugged/unplugged (0 to disable)
+LATENCY_STATS_EXPORT_PATH = 'latency_stats.json'  # File where latency statistics are exported from the settings mode
+
+DISPLAY_FRAME_KEEP_ALIVE_TIME = 1.0  # Re-send last frame after this time if display did not change (Push2 turns display off if no frames arrive)
 
 BLACK_RGB = [0, 0, 0]
 GRAY_DARK_RGB = [30, 30, 30]
@@ -94,6 +115,22 @@ class PyshaMode(object):
     name = ''
     xor_group = None
 
+    # Each mode draws into its own display layer, which is only redrawn after the mode calls invalidate_display
+    display_layer = None
+    display_layer_needs_update = True
+    retains_display_layer = False  # If True, the layer is not cleared before update_display (e.g. modes using a WidgetLayout)
+
+    # The display is drawn in its own thread, which never reads the state of the modes. Instead, when the display layer
+    # of a mode needs to be redrawn, the main loop calls get_display_state, which returns an immutable snapshot of
+    # everything the mode shows (e.g. nested tuples of strings, numbers and colors), and the display thread then calls
+    # update_display with that snapshot. update_display can only use the snapshot and objects only used for drawing
+    # (e.g. the mode's WidgetLayout).
+
+    # Names of the buttons and encoders handled in on_button_pressed/released and on_encoder_rotated. These are used to
+    # build the app's event dispatch tables so events for other buttons/encoders don't reach the mode (None means any)
+    handled_button_names = None
+    handled_encoder_names = None
+
     def __init__(self, app, settings=None):
         self.app = app
         self.initialize(settings=settings)
@@ -127,6 +164,11 @@ class PyshaMode(object):
     def on_midi_in(self, msg):
         pass
 
+    # Names of the encoders whose increments must reach the mode one by one while it is active (e.g. because the mode
+    # reacts to the size of single increments), the event coalescer won't add their increments together
+    def get_uncoalesced_encoder_names(self):
+        return ()
+
     # Push2 update methods
     def update_pads(self):
         pass
@@ -134,9 +176,17 @@ class PyshaMode(object):
     def update_buttons(self):
         pass
 
-    def update_display(self, ctx, w, h):
+    def get_display_state(self):
+        return None
+
+    def update_display(self, ctx, w, h, state):
         pass
 
+    # Method to call when something shown by the mode in the display changed so its display layer gets redrawn
+    def invalidate_display(self):
+        self.display_layer_needs_update = True
+        self.app.display_needs_update = True
+
     # Push2 action callbacks (these methods should return True if some action was carried out, otherwise return None)
     def on_encoder_rotated(self, encoder_name, increment):
         pass
@@ -1,35 +1,234 @@
 import cairo
+import collections
 import definitions
+import math
+import numpy
 import push2_python
 
 
+class DisplayFrameBuffer(object):
+    """Cairo surface and context that are created once and reused for every frame. The numpy arrays are views over the
+    surface data so no buffers need to be allocated or copied when sending frames: pixels is a (h, w) view with one
+    element per pixel, and frame is its transposed (w, h) version as used by push2_python (RGB16_565 surfaces only).
+    """
+
+    surface = None
+    ctx = None
+    pixels = None
+    frame = None
+
+    def __init__(self, w, h, surface_format=cairo.FORMAT_RGB16_565):
+        self.surface = cairo.ImageSurface(surface_format, w, h)
+        self.ctx = cairo.Context(self.surface)
+        dtype = numpy.uint16 if surface_format == cairo.FORMAT_RGB16_565 else numpy.uint32
+        stride_pixels = self.surface.get_stride() // numpy.dtype(dtype).itemsize
+        buf = numpy.ndarray(shape=(h, stride_pixels), dtype=dtype, buffer=self.surface.get_data())
+        self.pixels = buf[:, :w]
+        if surface_format == cairo.FORMAT_RGB16_565:
+            self.frame = self.pixels.transpose()
+
+
+class DisplayLayer(object):
+    """Transparent ARGB32 surface where a mode draws its part of the display. Layers are composited over the frame
+    in the order modes are active, so a layer only needs to be redrawn when the mode that owns it changes.
+    """
+
+    surface = None
+    ctx = None
+
+    def __init__(self, w, h):
+        self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        self.ctx = cairo.Context(self.surface)
+        self.n_redraws = 0
+
+    def clear(self):
+        self.ctx.save()
+        self.ctx.set_operator(cairo.OPERATOR_CLEAR)
+        self.ctx.paint()
+        self.ctx.restore()
+
+    def composite(self, ctx):
+        ctx.set_source_surface(self.surface, 0, 0)
+        ctx.paint()
+
+
+class SurfaceCache(object):
+    """LRU cache of pre-rendered cairo surfaces. Surfaces missing from the cache are created by calling
+    render(*render_args) with the arguments given to get_cached. Hit/miss/eviction counters are kept so cache sizes
+    can be tuned.
+    """
+
+    def __init__(self, max_size, render):
+        self.max_size = max_size
+        self.render_surface = render
+        self.surfaces = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.surfaces),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total > 0 else 0.0,
+        }
+
+    def clear(self):
+        self.surfaces.clear()
+
+    def get_cached(self, key, *render_args):
+        cached = self.surfaces.get(key, None)
+        if cached is not None:
+            self.surfaces.move_to_end(key)
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        cached = self.render_surface(*render_args)
+        self.surfaces[key] = cached
+        if len(self.surfaces) > self.max_size:
+            self.surfaces.popitem(last=False)
+            self.evictions += 1
+        return cached
+
+
+class TextSurfaceCache(SurfaceCache):
+    """Cache of pre-rendered text surfaces keyed by (text, font size, color, background color). Text layout
+    and rasterization is the most expensive part of drawing a frame, and most of the strings shown in the display are
+    the same every frame, so drawing text from the cache is just a surface blit.
+    Text rendered with a background color is stored in an opaque surface which is cheaper to blit.
+    """
+
+    padding = 2  # Extra pixels at each side of the text in case glyphs draw a bit outside of the text extents
+
+    def __init__(self, max_size=definitions.TEXT_CACHE_MAX_SIZE):
+        super().__init__(max_size, self.render)
+        self.measure_ctx = cairo.Context(cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1))
+        self.measure_ctx.select_font_face("Arial", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+
+    def get_text_surface(self, text, font_size, color, background_color=None):
+        # Returns a tuple with the surface and the offset of the text origin (baseline start) inside the surface
+        color = tuple(color)
+        if background_color is not None:
+            background_color = tuple(background_color)
+        key = (text, font_size, color, background_color)
+        return self.get_cached(key, text, font_size, color, background_color)
+
+    def render(self, text, font_size, color, background_color):
+        self.measure_ctx.set_font_size(font_size)
+        ascent, descent, _, _, _ = self.measure_ctx.font_extents()
+        x_bearing, _, text_width, _, x_advance, _ = self.measure_ctx.text_extents(text)
+        origin_x = self.padding
+        origin_y = int(math.ceil(ascent))  # Keep baseline on an integer pixel so blits don't need resampling
+        w = max(1, int(math.ceil(max(x_advance, x_bearing + text_width))) + 2 * self.padding)
+        h = max(1, origin_y + int(math.ceil(descent)))
+
+        if background_color is not None:
+            surface = cairo.ImageSurface(cairo.FORMAT_RGB24, w, h)
+        else:
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        ctx = cairo.Context(surface)
+        if background_color is not None:
+            ctx.set_source_rgb(*background_color)
+            ctx.paint()
+        ctx.set_source_rgb(*color)
+        ctx.select_font_face("Arial", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+        ctx.set_font_size(font_size)
+        ctx.move_to(origin_x, origin_y)
+        ctx.show_text(text)
+        surface.flush()
+        return surface, origin_x, origin_y
+
+
+class KnobSpriteCache(SurfaceCache):
+    """Cache of pre-rendered knob sprites keyed by (value bucket, color, radius). Sprites are created lazily the first
+    time a given value/color combination is drawn, so memory is bounded by the values that are actually used.
+    """
+
+    circle_break_degrees = 80
+    margin = 2  # Extra pixels around the circle so the (thicker) value arc is not clipped
+
+    def __init__(self, max_size=definitions.KNOB_SPRITE_CACHE_MAX_SIZE, n_value_buckets=definitions.KNOB_SPRITE_VALUE_BUCKETS):
+        super().__init__(max_size, self.render)
+        self.n_value_buckets = n_value_buckets
+
+    def get_knob_sprite(self, value_fraction, color, radius):
+        # Returns a tuple with the sprite and the position of the knob center inside the sprite
+        value_bucket = int(round(max(0.0, min(1.0, value_fraction)) * (self.n_value_buckets - 1)))
+        color = tuple(color)
+        key = (value_bucket, color, radius)
+        return self.get_cached(key, value_bucket, color, radius)
+
+    def render(self, value_bucket, color, radius):
+        size = int(math.ceil(2 * radius)) + 2 * self.margin
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+        ctx = cairo.Context(surface)
+        xc = yc = radius + self.margin
+
+        start_rad = (90 + self.circle_break_degrees // 2) * (math.pi / 180)
+        end_rad = (90 - self.circle_break_degrees // 2) * (math.pi / 180)
+        total_degrees = 360 - self.circle_break_degrees
+        value_rad = start_rad + total_degrees * (value_bucket / (self.n_value_buckets - 1)) * (math.pi / 180)
+
+        # Inner circle
+        ctx.arc(xc, yc, radius, start_rad, end_rad)
+        ctx.set_source_rgb(*definitions.get_color_rgb_float(definitions.GRAY_LIGHT))
+        ctx.set_line_width(1)
+        ctx.stroke()
+
+        # Outer circle
+        ctx.arc(xc, yc, radius, start_rad, value_rad)
+        ctx.set_source_rgb(*color)
+        ctx.set_line_width(3)
+        ctx.stroke()
+
+        surface.flush()
+        return surface, xc, yc
+
+
+text_surface_cache = TextSurfaceCache()
+knob_sprite_cache = KnobSpriteCache()
+
+
+def paint_surface_at(ctx, surface, x, y):
+    ctx.save()
+    ctx.set_source_surface(surface, x, y)
+    ctx.rectangle(x, y, surface.get_width(), surface.get_height())
+    ctx.fill()
+    ctx.restore()
+
+
+def draw_cached_text(ctx, x, y, text, font_size, color, background_color=None):
+    # Draws text with its origin (baseline start) at x, y using the text surface cache
+    surface, origin_x, origin_y = text_surface_cache.get_text_surface(text, font_size, color, background_color=background_color)
+    paint_surface_at(ctx, surface, int(round(x)) - origin_x, int(round(y)) - origin_y)
+
+
+def draw_knob(ctx, xc, yc, radius, value_fraction, color):
+    # Draws a knob centered at xc, yc using the knob sprite cache. value_fraction is in range [0, 1]
+    surface, sprite_xc, sprite_yc = knob_sprite_cache.get_knob_sprite(value_fraction, color, radius)
+    paint_surface_at(ctx, surface, xc - sprite_xc, yc - sprite_yc)
+
+
 def show_title(ctx, x, h, text, color=[1, 1, 1]):
     text = str(text)
-    ctx.set_source_rgb(*color)
-    ctx.select_font_face("Arial", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
     font_size = h//12
-    ctx.set_font_size(font_size)
-    ctx.move_to(x + 3, 20)
-    ctx.show_text(text)
+    draw_cached_text(ctx, x + 3, 20, text, font_size, color)
 
 
 def show_value(ctx, x, h, text, color=[1, 1, 1]):
     text = str(text)
-    ctx.set_source_rgb(*color)
-    ctx.select_font_face("Arial", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
     font_size = h//8
-    ctx.set_font_size(font_size)
-    ctx.move_to(x + 3, 45)
-    ctx.show_text(text)
+    draw_cached_text(ctx, x + 3, 45, text, font_size, color)
 
 
 def draw_text_at(ctx, x, y, text, font_size = 12, color=[1, 1, 1]):
     text = str(text)
-    ctx.set_source_rgb(*color)
-    ctx.select_font_face("Arial", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
-    ctx.set_font_size(font_size)
-    ctx.move_to(x, y)
-    ctx.show_text(text)
+    draw_cached_text(ctx, x, y, text, font_size, color)
 
 
 def show_text(ctx, x_part, pixels_from_top, text, height=20, font_color=definitions.WHITE, background_color=None, margin_left=4, font_size_percentage=0.8):
@@ -44,38 +243,72 @@ def show_text(ctx, x_part, pixels_from_top, text, height=20, font_color=definiti
 
     ctx.save()
 
+    background_color_rgb = None
     if background_color is not None:
-        ctx.set_source_rgb(*definitions.get_color_rgb_float(background_color))
+        background_color_rgb = definitions.get_color_rgb_float(background_color)
+        ctx.set_source_rgb(*background_color_rgb)
         ctx.rectangle(x1, y1, part_w, y1 + height)
         ctx.fill()
-    ctx.set_source_rgb(*definitions.get_color_rgb_float(font_color))
-    ctx.select_font_face("Arial", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
     font_size = round(int(height * font_size_percentage))
     margin_top = (height - font_size) // 2
-    ctx.set_font_size(font_size)
-    ctx.move_to(x1 + margin_left, y1 + font_size + margin_top - 2)
-    ctx.show_text(text)
+    draw_cached_text(ctx, x1 + margin_left, y1 + font_size + margin_top - 2, str(text),
+                     font_size, definitions.get_color_rgb_float(font_color), background_color=background_color_rgb)
 
     ctx.restore()
 
-def show_notification(ctx, text, opacity=1.0):
-    ctx.save()
+class NotificationOverlay(object):
+    """Notification layer which is rendered once per notification text (translucent background plus text) and then
+    composited over the display with a precomputed alpha at every frame of the fade out. Opacity is quantized to
+    n_alpha_steps so the display only needs redrawing when the fade reaches a new step.
+    """
 
-    # Background
-    display_w = push2_python.constants.DISPLAY_LINE_PIXELS
-    display_h = push2_python.constants.DISPLAY_N_LINES
     initial_bg_opacity = 0.8
-    ctx.set_source_rgba(0.0, 0.0, 0.0, initial_bg_opacity * opacity)
-    ctx.rectangle(0, 0, display_w, display_h)
-    ctx.fill()
-
-    # Text
-    initial_text_opacity = 1.0
-    ctx.set_source_rgba(1.0, 1.0, 1.0, initial_text_opacity * opacity)
-    font_size = display_h // 4
-    ctx.set_font_size(font_size)
     margin_left = 8
-    ctx.move_to(margin_left, 2.2 * font_size)
-    ctx.show_text(text)
 
-    ctx.restore()
+    def __init__(self, n_alpha_steps=definitions.NOTIFICATION_ALPHA_STEPS):
+        self.n_alpha_steps = n_alpha_steps
+        self.alphas = [step / (n_alpha_steps - 1) for step in range(0, n_alpha_steps)]
+        self.surface = None
+        self.text = None
+        self.n_renders = 0
+
+    def get_alpha_step(self, opacity):
+        return int(round(max(0.0, min(1.0, opacity)) * (self.n_alpha_steps - 1)))
+
+    def render(self, text):
+        display_w = push2_python.constants.DISPLAY_LINE_PIXELS
+        display_h = push2_python.constants.DISPLAY_N_LINES
+        if self.surface is None:
+            self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, display_w, display_h)
+        ctx = cairo.Context(self.surface)
+        ctx.set_operator(cairo.OPERATOR_SOURCE)
+        ctx.set_source_rgba(0.0, 0.0, 0.0, self.initial_bg_opacity)
+        ctx.paint()
+        ctx.set_operator(cairo.OPERATOR_OVER)
+        ctx.set_source_rgb(1.0, 1.0, 1.0)
+        ctx.select_font_face("Arial", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+        font_size = display_h // 4
+        ctx.set_font_size(font_size)
+        ctx.move_to(self.margin_left, 2.2 * font_size)
+        ctx.show_text(text)
+        self.surface.flush()
+        self.text = text
+        self.n_renders += 1
+
+    def draw(self, ctx, text, opacity=1.0):
+        alpha_step = self.get_alpha_step(opacity)
+        if alpha_step == 0:
+            return
+        if text != self.text:
+            self.render(text)
+        ctx.save()
+        ctx.set_source_surface(self.surface, 0, 0)
+        ctx.paint_with_alpha(self.alphas[alpha_step])
+        ctx.restore()
+
+
+notification_overlay = NotificationOverlay()
+
+
+def show_notification(ctx, text, opacity=1.0):
+    notification_overlay.draw(ctx, text, opacity=opacity)
@@ -0,0 +1,231 @@
+import cairo
+import collections
+import definitions
+import push2_python
+
+from display_utils import draw_cached_text, draw_knob
+
+
+# Counters of what widget layouts draw (summed for all layouts), used to measure overdraw
+render_stats = collections.Counter()
+
+
+def get_render_stats():
+    return dict(render_stats)
+
+
+def to_rgb(color):
+    # Widgets accept color names (see definitions) or rgb float lists, and store colors as tuples so they can be compared
+    if color is None:
+        return None
+    if isinstance(color, str):
+        color = definitions.get_color_rgb_float(color)
+    return tuple(color)
+
+
+class Widget(object):
+    """Element of a WidgetLayout that occupies a fixed rectangle of the display. Widgets keep the properties they
+    were last drawn with, and are only marked as dirty (and redrawn) when set() is called with different values.
+    When redrawn, the widget's rectangle is cleared and drawing is clipped to it, so widgets never overdraw each other.
+    """
+
+    background_color = None
+    visible = True
+
+    def __init__(self, x, y, w, h, **properties):
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.layout = None
+        self.dirty = True
+        self.set(**properties)
+
+    def set(self, **properties):
+        for name, value in properties.items():
+            if name.endswith('color'):
+                value = to_rgb(value)
+            elif isinstance(value, list):
+                value = tuple(value)
+            if getattr(self, name) != value:
+                setattr(self, name, value)
+                self.dirty = True
+
+    def render(self, ctx):
+        ctx.save()
+        ctx.rectangle(self.x, self.y, self.w, self.h)
+        ctx.clip()
+        layout_background_color = self.layout.background_color if self.layout is not None else None
+        background_color = self.background_color if self.visible else None
+        if background_color is None:
+            background_color = layout_background_color
+        if background_color is not None:
+            ctx.set_source_rgb(*background_color)
+            ctx.paint()
+        else:
+            ctx.set_operator(cairo.OPERATOR_CLEAR)
+            ctx.paint()
+            ctx.set_operator(cairo.OPERATOR_OVER)
+        if self.visible:
+            self.draw(ctx)
+        ctx.restore()
+        self.dirty = False
+
+    def draw(self, ctx):
+        # Draw widget contents, background has already been painted
+        pass
+
+
+class Label(Widget):
+    """Single line of text. Text is drawn with its baseline at text_y pixels from the top of the widget."""
+
+    text = ''
+    font_size = 12
+    font_color = (1.0, 1.0, 1.0)
+    text_x = 3
+    text_y = 10
+
+    def draw(self, ctx):
+        if self.text:
+            draw_cached_text(ctx, self.x + self.text_x, self.y + self.text_y, self.text, self.font_size, self.font_color,
+                             background_color=self.background_color)
+
+
+class Value(Label):
+    """Label for values, drawn with a bigger font below the titles of the column"""
+
+    font_size = 20
+
+
+class Knob(Widget):
+    """Knob showing value_fraction (in range [0, 1]), drawn from the knob sprite cache"""
+
+    value_fraction = 0.0
+    color = (1.0, 1.0, 1.0)
+    radius = 27.5
+    knob_x = 3  # Left side of the knob relative to the widget
+    knob_y = 2  # Top side of the knob relative to the widget
+
+    def draw(self, ctx):
+        draw_knob(ctx, self.x + self.knob_x + self.radius, self.y + self.knob_y + self.radius, self.radius,
+                  self.value_fraction, self.color)
+
+
+class Curve(Widget):
+    """Filled curve of the values in data (in range [0, vmax]) scaled to the widget size"""
+
+    data = ()
+    vmax = 127
+    color = (0.6, 0.6, 0.6)
+    margin = 3
+
+    def draw(self, ctx):
+        if not self.data:
+            return
+        n = len(self.data)
+        curve_x = self.x + self.margin
+        curve_y = self.y + self.h - 2
+        curve_height = self.h - 4
+        curve_length = self.w - 2 * self.margin
+        ctx.set_source_rgb(*self.color)
+        ctx.move_to(curve_x, curve_y)
+        for i, value in enumerate(self.data):
+            x = curve_x + i * curve_length / n
+            ctx.line_to(x, curve_y - curve_height * value / self.vmax)
+        ctx.line_to(x, curve_y)
+        ctx.fill()
+
+
+class Bar(Widget):
+    """Horizontal bar filled up to value_fraction (in range [0, 1])"""
+
+    value_fraction = 0.0
+    color = (1.0, 1.0, 1.0)
+    track_color = (0.2, 0.2, 0.2)
+    margin = 3
+
+    def draw(self, ctx):
+        bar_w = self.w - 2 * self.margin
+        ctx.set_source_rgb(*self.track_color)
+        ctx.rectangle(self.x + self.margin, self.y, bar_w, self.h)
+        ctx.fill()
+        ctx.set_source_rgb(*self.color)
+        ctx.rectangle(self.x + self.margin, self.y, bar_w * max(0.0, min(1.0, self.value_fraction)), self.h)
+        ctx.fill()
+
+
+class WidgetLayout(object):
+    """Retained set of widgets placed on a fixed 8 column grid (one column per encoder/upper row button). Modes set
+    the properties of the widgets in their update_display method and then call render, which only redraws the
+    widgets that changed (the rest of the display layer keeps what was drawn before). If background_color is set the
+    whole layout area is painted with it on full redraws, and widgets are cleared to that color instead of being
+    cleared to transparent.
+    """
+
+    n_columns = 8
+
+    def __init__(self, w=push2_python.constants.DISPLAY_LINE_PIXELS, h=push2_python.constants.DISPLAY_N_LINES, background_color=None):
+        self.w = w
+        self.h = h
+        self.column_w = w // self.n_columns
+        self.background_color = to_rgb(background_color)
+        self.widgets = []
+        self.needs_full_redraw = True
+
+    def add(self, widget):
+        widget.layout = self
+        self.widgets.append(widget)
+        return widget
+
+    def column_rect(self, column, y, height, n_columns=1):
+        return column * self.column_w, y, n_columns * self.column_w, height
+
+    # Factories for the widgets used by modes, with the same geometry as the display_utils show_* functions
+
+    def add_text(self, column, y, height=20, n_columns=1, font_size_percentage=0.8, margin_left=4):
+        # Equivalent to display_utils.show_text
+        font_size = round(int(height * font_size_percentage))
+        margin_top = (height - font_size) // 2
+        return self.add(Label(*self.column_rect(column, y, height, n_columns=n_columns), font_size=font_size,
+                              text_x=margin_left, text_y=font_size + margin_top - 2))
+
+    def add_title(self, column):
+        # Equivalent to display_utils.show_title
+        return self.add(Label(*self.column_rect(column, 0, 25), font_size=self.h // 12, text_y=20))
+
+    def add_value(self, column):
+        # Equivalent to display_utils.show_value
+        return self.add(Value(*self.column_rect(column, 25, 30), font_size=self.h // 8, text_y=20))
+
+    def add_knob(self, column, y, radius):
+        return self.add(Knob(*self.column_rect(column, y, int(2 * radius) + 5), radius=radius))
+
+    def invalidate_all(self):
+        self.needs_full_redraw = True
+
+    def render(self, ctx):
+        # Draws the widgets that changed since last render. Returns the number of widgets drawn
+        if self.needs_full_redraw:
+            self.needs_full_redraw = False
+            ctx.save()
+            ctx.rectangle(0, 0, self.w, self.h)
+            if self.background_color is not None:
+                ctx.set_source_rgb(*self.background_color)
+            else:
+                ctx.set_operator(cairo.OPERATOR_CLEAR)
+            ctx.fill()
+            ctx.restore()
+            render_stats['pixels_drawn'] += self.w * self.h
+            for widget in self.widgets:
+                widget.dirty = True
+
+        n_drawn = 0
+        for widget in self.widgets:
+            if widget.dirty:
+                widget.render(ctx)
+                n_drawn += 1
+                render_stats['pixels_drawn'] += widget.w * widget.h
+        render_stats['renders'] += 1
+        render_stats['widgets_drawn'] += n_drawn
+        render_stats['widgets_skipped'] += len(self.widgets) - n_drawn
+        return n_drawn
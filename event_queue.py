@@ -0,0 +1,167 @@
+import collections
+import time
+
+
+class EventQueue(object):
+    """Queue between the threads where events arrive (push2_python callbacks) and the main loop, which is the
+    only thread that handles them (so modes' state, active modes, pad/button LEDs, etc. are only changed from one
+    thread). Events are stored in two bounded lanes: a fast lane for note-related events (pads, aftertouch, touchstrip,
+    sustain pedal) and a UI lane for everything else (buttons, encoders...). Fast lane events are always
+    handled before UI events.
+
+    Lanes are deques, whose append and popleft methods are atomic, so adding events needs no lock of its own.
+    on_event_added is called after an event is added and must be cheap (PyshaApp sets an Event only if it is not
+    already set, so producers only take that Event's lock once per main loop wake up). If a lane is full, new events
+    for that lane are dropped (and counted), except pad presses/releases and sustain pedal events, which are always
+    queued so notes never get stuck.
+
+    Each event is a tuple (event_name, args, arrival_time), arrival_time is taken from time.perf_counter when the event
+    is added and is used to measure latencies.
+    """
+
+    never_dropped_event_names = frozenset(['on_pad_pressed', 'on_pad_released', 'on_sustain_pedal'])
+
+    def __init__(self, fast_lane_max_size=4096, ui_lane_max_size=512, max_batch_size=64):
+        self.fast_lane = collections.deque()
+        self.ui_lane = collections.deque()
+        self.fast_lane_max_size = fast_lane_max_size
+        self.ui_lane_max_size = ui_lane_max_size
+        self.max_batch_size = max_batch_size
+        self.on_event_added = None  # Called after an event is added (e.g. to wake up the main loop)
+        self.n_events_added = collections.Counter()
+        self.n_events_dropped = collections.Counter()
+        self.n_events_handled = 0
+        self.max_depth = collections.Counter()
+
+    def put(self, event_name, args, fast=False):
+        if fast:
+            lane, lane_name, max_size = self.fast_lane, 'fast', self.fast_lane_max_size
+        else:
+            lane, lane_name, max_size = self.ui_lane, 'ui', self.ui_lane_max_size
+        depth = len(lane)
+        if depth >= max_size and event_name not in self.never_dropped_event_names:
+            self.n_events_dropped[lane_name] += 1
+            return False
+        lane.append((event_name, args, time.perf_counter()))
+        self.n_events_added[lane_name] += 1
+        if depth + 1 > self.max_depth[lane_name]:
+            self.max_depth[lane_name] = depth + 1
+        if self.on_event_added is not None:
+            self.on_event_added()
+        return True
+
+    def is_empty(self):
+        return not self.fast_lane and not self.ui_lane
+
+    def get_depth(self):
+        return len(self.fast_lane) + len(self.ui_lane)
+
+    def process(self, handler):
+        # Handles a batch of up to max_batch_size events by calling handler(event_name, args, arrival_time). The fast
+        # lane is checked before every event, so note events arriving while UI events are handled go first. Returns the
+        # number of events handled.
+        n_handled = 0
+        while n_handled < self.max_batch_size:
+            try:
+                event_name, args, arrival_time = self.fast_lane.popleft()
+            except IndexError:
+                try:
+                    event_name, args, arrival_time = self.ui_lane.popleft()
+                except IndexError:
+                    break
+            handler(event_name, args, arrival_time)
+            n_handled += 1
+        self.n_events_handled += n_handled
+        return n_handled
+
+    def get_stats(self):
+        return {
+            'fast_lane_depth': len(self.fast_lane),
+            'ui_lane_depth': len(self.ui_lane),
+            'fast_lane_max_depth': self.max_depth['fast'],
+            'ui_lane_max_depth': self.max_depth['ui'],
+            'events_added': dict(self.n_events_added),
+            'events_dropped': dict(self.n_events_dropped),
+            'events_handled': self.n_events_handled,
+        }
+
+
+class EventCoalescer(object):
+    """Merges bursts of events which only matter for their final result before they are handled: encoder increments
+    of the same encoder are added together, and only the latest aftertouch value of each pad (or the latest channel
+    aftertouch value) is kept. The first event of a burst is handled right away and opens a window of window seconds,
+    events arriving within the window are merged and handled when it ends (which opens a new window), so a burst is
+    handled at most once per window after its first event. Events from sources listed in exempt (event names or
+    encoder names) are never merged.
+
+    To keep event order consistent, pending aftertouch events of a pad are flushed before other events of that pad
+    (e.g. the pad being released), and pending encoder events are flushed before other UI events.
+    """
+
+    def __init__(self, window=0.01, exempt=None):
+        self.window = window
+        self.exempt = set(exempt) if exempt is not None else set()
+        self.pending = collections.OrderedDict()  # key -> [flush time, event_name, args, arrival time of first event]
+        self.window_end_times = {}  # key -> time at which the window opened by the last event handled ends
+        self.n_events_coalesced = 0
+
+    def get_key(self, event_name, args):
+        if self.window <= 0 or event_name in self.exempt:
+            return None
+        if event_name == 'on_encoder_rotated':
+            if args[0] in self.exempt:
+                return None
+            return event_name, args[0]
+        elif event_name == 'on_pad_aftertouch':
+            return event_name, args[0]  # Pad number (None for channel aftertouch)
+        return None
+
+    def add(self, event_name, args, arrival_time, now):
+        # Returns True if the event was merged or kept pending, False if the event should be handled now
+        key = self.get_key(event_name, args)
+        if key is None:
+            return False
+        pending_event = self.pending.get(key, None)
+        if pending_event is None:
+            window_end_time = self.window_end_times.get(key, None)
+            if window_end_time is None or window_end_time <= now:
+                # First event of a burst
+                self.window_end_times[key] = now + self.window
+                return False
+            self.pending[key] = [window_end_time, event_name, args, arrival_time]
+        else:
+            if event_name == 'on_encoder_rotated':
+                args = (args[0], pending_event[2][1] + args[1])
+            pending_event[2] = args
+            self.n_events_coalesced += 1
+        return True
+
+    def pop_events_to_flush_before(self, event_name, args):
+        # Returns pending events (as (event_name, args, arrival_time) tuples) that need to be handled before the given
+        # (not coalesced) event
+        if not self.pending:
+            return []
+        if event_name in ('on_pad_pressed', 'on_pad_released'):
+            keys = [('on_pad_aftertouch', args[0]), ('on_pad_aftertouch', None)]
+        elif event_name in ('on_button_pressed', 'on_button_released', 'on_encoder_rotated'):
+            keys = [key for key in self.pending if key[0] == 'on_encoder_rotated']
+        else:
+            return []
+        return [self.pending.pop(key)[1:] for key in keys if key in self.pending]
+
+    def pop_due_events(self, now):
+        # Returns pending events whose window is over, in the order they started. Handling them opens a new window.
+        due_keys = [key for key, (flush_time, _, _, _) in self.pending.items() if flush_time <= now]
+        for key in [key for key, window_end_time in self.window_end_times.items() if window_end_time <= now and key not in self.pending]:
+            del self.window_end_times[key]  # Bursts that ended
+        due_events = []
+        for key in due_keys:
+            pending_event = self.pending.pop(key)
+            self.window_end_times[key] = pending_event[0] + self.window
+            due_events.append(pending_event[1:])
+        return due_events
+
+    def get_next_flush_time(self):
+        if not self.pending:
+            return None
+        return min(flush_time for flush_time, _, _, _ in self.pending.values())
@@ -0,0 +1,232 @@
+"""
+Recording and replay of the events Pysha receives from Push2 and from the MIDI in device. Events are written to a
+compact binary log as they arrive (before being queued), so a session (e.g. a whole gig) can later be replayed into
+PyshaApp to get a realistic and repeatable load for profiling or for checking regressions.
+
+Log format: a header (LOG_MAGIC) followed by records. Each record starts with a RECORD_HEADER struct with the time of
+the event in seconds from the start of the recording and the event code, followed by the payload of that event type
+(see EVENT_PAYLOAD_FORMATS). Encoder and button names are stored once in "name" records and referenced by index in
+the following events. MIDI in messages are stored as raw MIDI bytes.
+
+Recording:
+
+    python app.py --record session.pyshalog
+
+Replay (at real time, or as fast as possible with --replay-speed 0), Push2 is replaced by the fake backend unless
+--replay-on-push2 is given:
+
+    python app.py --replay session.pyshalog
+"""
+
+import struct
+import threading
+import time
+
+import mido
+
+
+LOG_MAGIC = b'PYSHALOG\x01'
+RECORD_HEADER = struct.Struct('<dB')  # Event time (seconds since start of recording), event code
+
+NAME_RECORD_CODE = 0  # Payload: name index (H), name length (B), name bytes (utf-8)
+NAME_RECORD = struct.Struct('<HB')
+MIDI_IN_RECORD_CODE = 1  # Payload: number of bytes (H), raw MIDI bytes
+MIDI_IN_RECORD = struct.Struct('<H')
+
+PAD_NONE = 255  # Used as pad number/coordinates for channel aftertouch events (which have no pad)
+
+EVENT_CODES = {
+    'on_midi_connected': 2,
+    'on_pad_pressed': 3,
+    'on_pad_released': 4,
+    'on_pad_aftertouch': 5,
+    'on_encoder_rotated': 6,
+    'on_button_pressed': 7,
+    'on_button_released': 8,
+    'on_touchstrip': 9,
+    'on_sustain_pedal': 10,
+}
+EVENT_NAMES = {code: event_name for event_name, code in EVENT_CODES.items()}
+
+EVENT_PAYLOAD_FORMATS = {
+    'on_midi_connected': struct.Struct('<'),
+    'on_pad_pressed': struct.Struct('<BBBB'),  # Pad number, pad i, pad j, velocity
+    'on_pad_released': struct.Struct('<BBBB'),
+    'on_pad_aftertouch': struct.Struct('<BBBB'),
+    'on_encoder_rotated': struct.Struct('<Hb'),  # Encoder name index, increment
+    'on_button_pressed': struct.Struct('<H'),  # Button name index
+    'on_button_released': struct.Struct('<H'),
+    'on_touchstrip': struct.Struct('<h'),  # Touchstrip value (pitch bend or modulation wheel)
+    'on_sustain_pedal': struct.Struct('<B'),
+}
+
+
+class EventRecorder(object):
+    """Writes events to a binary log file. record and record_midi_in can be called from any thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(LOG_MAGIC)
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.name_indexes = {}
+        self.n_events_recorded = 0
+
+    def get_name_index(self, name):
+        # Must be called with the lock acquired
+        index = self.name_indexes.get(name, None)
+        if index is None:
+            index = len(self.name_indexes)
+            self.name_indexes[name] = index
+            encoded_name = name.encode('utf-8')
+            self.file.write(RECORD_HEADER.pack(time.perf_counter() - self.start_time, NAME_RECORD_CODE))
+            self.file.write(NAME_RECORD.pack(index, len(encoded_name)) + encoded_name)
+        return index
+
+    def record(self, event_name, args):
+        code = EVENT_CODES.get(event_name, None)
+        if code is None or self.file is None:
+            return
+        event_time = time.perf_counter() - self.start_time
+        with self.lock:
+            if self.file is None:
+                return
+            if event_name in ('on_pad_pressed', 'on_pad_released', 'on_pad_aftertouch'):
+                pad_n, pad_ij, velocity = args
+                if pad_n is None:
+                    payload_args = (PAD_NONE, PAD_NONE, PAD_NONE, velocity)
+                else:
+                    payload_args = (pad_n, pad_ij[0], pad_ij[1], velocity)
+            elif event_name == 'on_encoder_rotated':
+                payload_args = (self.get_name_index(args[0]), max(-128, min(127, args[1])))
+            elif event_name in ('on_button_pressed', 'on_button_released'):
+                payload_args = (self.get_name_index(args[0]), )
+            elif event_name == 'on_sustain_pedal':
+                payload_args = (1 if args[0] else 0, )
+            else:
+                payload_args = args
+            self.file.write(RECORD_HEADER.pack(event_time, code))
+            self.file.write(EVENT_PAYLOAD_FORMATS[event_name].pack(*payload_args))
+            self.n_events_recorded += 1
+
+    def record_midi_in(self, msg):
+        if self.file is None:
+            return
+        event_time = time.perf_counter() - self.start_time
+        msg_bytes = bytes(msg.bytes())
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(RECORD_HEADER.pack(event_time, MIDI_IN_RECORD_CODE))
+            self.file.write(MIDI_IN_RECORD.pack(len(msg_bytes)) + msg_bytes)
+            self.n_events_recorded += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        print('Recorded {0} events to {1}'.format(self.n_events_recorded, self.path))
+
+
+def read_event_log(path):
+    """Generator of (event time, event name, args) tuples for the events in a log file. MIDI in events have
+    event name 'midi_in' and a mido message as single argument.
+    """
+    data = open(path, 'rb').read()
+    if not data.startswith(LOG_MAGIC):
+        raise ValueError('{0} is not a Pysha event log'.format(path))
+    names = {}
+    offset = len(LOG_MAGIC)
+    while offset + RECORD_HEADER.size <= len(data):
+        event_time, code = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if code == NAME_RECORD_CODE:
+            index, length = NAME_RECORD.unpack_from(data, offset)
+            offset += NAME_RECORD.size
+            names[index] = data[offset:offset + length].decode('utf-8')
+            offset += length
+        elif code == MIDI_IN_RECORD_CODE:
+            length, = MIDI_IN_RECORD.unpack_from(data, offset)
+            offset += MIDI_IN_RECORD.size
+            msg_bytes = data[offset:offset + length]
+            offset += length
+            if len(msg_bytes) < length:
+                break  # Truncated log (e.g. recording process was killed)
+            yield event_time, 'midi_in', (mido.Message.from_bytes(msg_bytes), )
+        else:
+            event_name = EVENT_NAMES[code]
+            payload_format = EVENT_PAYLOAD_FORMATS[event_name]
+            if offset + payload_format.size > len(data):
+                break  # Truncated log
+            values = payload_format.unpack_from(data, offset)
+            offset += payload_format.size
+            if event_name in ('on_pad_pressed', 'on_pad_released', 'on_pad_aftertouch'):
+                pad_n, pad_i, pad_j, velocity = values
+                if pad_n == PAD_NONE:
+                    args = (None, None, velocity)
+                else:
+                    args = (pad_n, (pad_i, pad_j), velocity)
+            elif event_name == 'on_encoder_rotated':
+                args = (names[values[0]], values[1])
+            elif event_name in ('on_button_pressed', 'on_button_released'):
+                args = (names[values[0]], )
+            elif event_name == 'on_sustain_pedal':
+                args = (values[0] == 1, )
+            else:
+                args = values
+            yield event_time, event_name, args
+
+
+class EventReplayer(object):
+    """Replays an event log into a PyshaApp, passing events to the app the same way push2_python and mido do (so
+    they go through the event queue). speed is the replay speed relative to real time (0 replays events as fast as
+    possible). When replaying as fast as possible and the app main loop is not running, pass process_events=True so
+    that the app handles events as they are replayed.
+    """
+
+    def __init__(self, app, path, speed=1.0, process_events=False):
+        self.app = app
+        self.path = path
+        self.speed = speed
+        self.process_events = process_events
+        self.n_events_replayed = 0
+        self.replay_time = None
+        self.thread = None
+
+    def replay(self, stop_event=None):
+        # Returns the time it took to replay the log
+        start_time = time.perf_counter()
+        for event_time, event_name, args in read_event_log(self.path):
+            if stop_event is not None and stop_event.is_set():
+                break
+            if self.speed > 0:
+                wait_time = start_time + event_time / self.speed - time.perf_counter()
+                if wait_time > 0:
+                    time.sleep(wait_time)
+            elif not self.process_events:
+                # Don't get ahead of the main loop (or the MIDI in worker) when replaying as fast as possible,
+                # otherwise events would be dropped by the event queue
+                while self.app.event_queue.get_depth() >= self.app.event_queue.max_batch_size \
+                        or len(self.app.midi_in_worker.queue) >= self.app.event_queue.max_batch_size:
+                    time.sleep(0.0005)
+            if event_name == 'midi_in':
+                self.app.midi_in_handler(*args)
+            else:
+                self.app.on_push2_event(event_name, *args)
+            self.n_events_replayed += 1
+            if self.process_events:
+                self.app.midi_in_worker.wait_until_idle()
+                while not self.app.event_queue.is_empty():
+                    self.app.process_events()
+        if self.process_events:
+            self.app.process_events(flush=True)
+        self.replay_time = time.perf_counter() - start_time
+        print('Replayed {0} events from {1} in {2:.2f} seconds'.format(self.n_events_replayed, self.path, self.replay_time))
+        return self.replay_time
+
+    def start(self, stop_event=None):
+        # Replays the log in a background thread (while the app main loop runs)
+        self.thread = threading.Thread(target=self.replay, kwargs={'stop_event': stop_event}, daemon=True)
+        self.thread.start()
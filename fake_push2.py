@@ -0,0 +1,241 @@
+"""
+In-process stand-in for push2_python.Push2 which can be used to run Pysha without a Push2 connected (e.g. for
+benchmarking or in CI). It implements the parts of the push2_python API used by Pysha, records pad and button LED
+writes and display frames, and can be fed with scripted pad, encoder, button, touchstrip and pedal events, which are
+passed to the event handler given on creation (the same events push2_python would trigger). Pysha queues these events
+and handles them in its main loop, so call app.process_events(flush=True) to handle them when not running the main
+loop (flush makes encoder and aftertouch events merged by the event coalescer to be handled right away).
+
+Use it by creating the app with the fake backend (or by setting "push2_backend": "fake" in settings.json):
+
+    app = PyshaApp(push2_backend='fake')
+    app.push.connect()  # Triggers the "MIDI connected" event, like when a real Push2 is connected
+    app.push.pad_pressed((7, 0), velocity=100)
+    app.push.encoder_rotated(push2_python.constants.ENCODER_TRACK1_ENCODER, 3)
+    app.process_events(flush=True)
+    app.update_push2_display()
+    print(app.push.display.n_frames, app.push.pads.n_led_writes)
+"""
+
+import collections
+import numpy
+import threading
+import time
+
+import push2_python.constants
+
+
+def get_constant_names(prefix):
+    return [getattr(push2_python.constants, name) for name in dir(push2_python.constants)
+            if name.startswith(prefix) and isinstance(getattr(push2_python.constants, name), str)]
+
+
+class FakePush2Pads(object):
+
+    def __init__(self, push):
+        self.push = push
+        self.pad_colors = {}
+        self.n_led_writes = 0  # Number of pad colors actually changed (what would be sent to Push2)
+        self.n_led_write_requests = 0  # Number of pad colors requested (including colors that did not change)
+        self.use_poly_at = False
+        self.channel_at_range = None
+        self.velocity_curve = None
+
+    def set_pad_color(self, pad_ij, color='white', animation=None, **kwargs):
+        self.n_led_write_requests += 1
+        pad_ij = tuple(pad_ij)
+        if self.pad_colors.get(pad_ij, None) != (color, animation):
+            self.pad_colors[pad_ij] = (color, animation)
+            self.n_led_writes += 1
+            self.push.log_led_write('pad', pad_ij, color, animation)
+
+    def set_pads_color(self, color_matrix, animation=None, **kwargs):
+        for i, row_colors in enumerate(color_matrix):
+            for j, color in enumerate(row_colors):
+                self.set_pad_color((i, j), color=color, animation=animation)
+
+    def set_all_pads_to_color(self, color='white', animation=None, **kwargs):
+        self.set_pads_color([[color for _ in range(0, 8)] for _ in range(0, 8)], animation=animation)
+
+    def get_pad_color(self, pad_ij):
+        return self.pad_colors.get(tuple(pad_ij), (None, None))[0]
+
+    def set_polyphonic_aftertouch(self):
+        self.use_poly_at = True
+
+    def set_channel_aftertouch(self):
+        self.use_poly_at = False
+
+    def set_channel_aftertouch_range(self, range_start=401, range_end=2048):
+        self.channel_at_range = (range_start, range_end)
+
+    def set_velocity_curve(self, velocities):
+        self.velocity_curve = list(velocities)
+
+
+class FakePush2Buttons(object):
+
+    def __init__(self, push):
+        self.push = push
+        self.available_names = get_constant_names('BUTTON_')
+        self.button_colors = {}
+        self.n_led_writes = 0
+        self.n_led_write_requests = 0
+
+    def set_button_color(self, button_name, color='white', animation=None, **kwargs):
+        self.n_led_write_requests += 1
+        if self.button_colors.get(button_name, None) != (color, animation):
+            self.button_colors[button_name] = (color, animation)
+            self.n_led_writes += 1
+            self.push.log_led_write('button', button_name, color, animation)
+
+    def set_all_buttons_color(self, color='white', animation=None, **kwargs):
+        for button_name in self.available_names:
+            self.set_button_color(button_name, color=color, animation=animation)
+
+    def get_button_color(self, button_name):
+        return self.button_colors.get(button_name, (None, None))[0]
+
+
+class FakePush2Encoders(object):
+
+    def __init__(self, push):
+        self.push = push
+        self.available_names = get_constant_names('ENCODER_')
+
+
+class FakePush2Touchstrip(object):
+
+    def __init__(self, push):
+        self.push = push
+        self.modulation_wheel_mode = False
+
+    def set_modulation_wheel_mode(self):
+        self.modulation_wheel_mode = True
+
+    def set_pitch_bend_mode(self):
+        self.modulation_wheel_mode = False
+
+
+class FakePush2Display(object):
+
+    def __init__(self, push, n_frames_to_keep=10):
+        self.push = push
+        self.n_frames = 0
+        self.last_frame_time = None
+        self.frames = collections.deque(maxlen=n_frames_to_keep)  # Copies of the last sent (prepared) frames
+
+    def make_black_frame(self):
+        return numpy.zeros((push2_python.constants.DISPLAY_LINE_PIXELS, push2_python.constants.DISPLAY_N_LINES), dtype=numpy.uint16)
+
+    def prepare_frame(self, frame, input_format=None):
+        return frame
+
+    def send_to_display(self, prepared_frame):
+        self.n_frames += 1
+        self.last_frame_time = time.monotonic()
+        if self.frames.maxlen:
+            self.frames.append(prepared_frame.copy() if hasattr(prepared_frame, 'copy') else bytes(prepared_frame))
+
+    def display_frame(self, frame, input_format=None):
+        self.send_to_display(self.prepare_frame(frame, input_format=input_format))
+
+
+class FakePush2(object):
+    """Stand-in for push2_python.Push2, see module docstring"""
+
+    def __init__(self, event_handler=None, n_led_writes_to_log=1000, n_frames_to_keep=10):
+        self.event_handler = event_handler
+        self.f_stop = threading.Event()
+        self.color_palette = {}
+        self.led_writes_log = collections.deque(maxlen=n_led_writes_to_log)
+        self.pads = FakePush2Pads(self)
+        self.buttons = FakePush2Buttons(self)
+        self.encoders = FakePush2Encoders(self)
+        self.touchstrip = FakePush2Touchstrip(self)
+        self.display = FakePush2Display(self, n_frames_to_keep=n_frames_to_keep)
+
+    # Methods from push2_python.Push2 API
+
+    def midi_is_configured(self):
+        return True
+
+    def configure_midi(self):
+        pass
+
+    def set_push2_reconnect_call_interval(self, new_reconnect_call_interval):
+        pass
+
+    def set_color_palette_entry(self, color_idx, color_name, rgb=None, bw=None, allow_overwrite=False):
+        self.color_palette[color_idx] = (color_name, rgb, bw)
+
+    def reapply_color_palette(self):
+        pass
+
+    # Recording
+
+    def log_led_write(self, element_type, element_id, color, animation):
+        self.led_writes_log.append((time.monotonic(), element_type, element_id, color, animation))
+
+    def reset_counters(self):
+        self.pads.n_led_writes = self.pads.n_led_write_requests = 0
+        self.buttons.n_led_writes = self.buttons.n_led_write_requests = 0
+        self.display.n_frames = 0
+        self.led_writes_log.clear()
+        self.display.frames.clear()
+
+    # Scripted events
+
+    def trigger_event(self, event_name, *args):
+        if self.event_handler is not None:
+            self.event_handler(event_name, *args)
+
+    def connect(self):
+        self.trigger_event('on_midi_connected')
+
+    def pad_ij_to_pad_n(self, pad_ij):
+        # Pad notes go from 36 (bottom left pad) to 99 (top right pad), pad_ij (0, 0) is the top left pad
+        return 36 + (7 - pad_ij[0]) * 8 + pad_ij[1]
+
+    def pad_pressed(self, pad_ij, velocity=127):
+        self.trigger_event('on_pad_pressed', self.pad_ij_to_pad_n(pad_ij), tuple(pad_ij), velocity)
+
+    def pad_released(self, pad_ij, velocity=0):
+        self.trigger_event('on_pad_released', self.pad_ij_to_pad_n(pad_ij), tuple(pad_ij), velocity)
+
+    def pad_aftertouch(self, pad_ij, value):
+        # Use pad_ij=None for channel aftertouch
+        if pad_ij is None:
+            self.trigger_event('on_pad_aftertouch', None, None, value)
+        else:
+            self.trigger_event('on_pad_aftertouch', self.pad_ij_to_pad_n(pad_ij), tuple(pad_ij), value)
+
+    def encoder_rotated(self, encoder_name, increment):
+        self.trigger_event('on_encoder_rotated', encoder_name, increment)
+
+    def button_pressed(self, button_name):
+        self.trigger_event('on_button_pressed', button_name)
+
+    def button_released(self, button_name):
+        self.trigger_event('on_button_released', button_name)
+
+    def touchstrip_moved(self, value):
+        self.trigger_event('on_touchstrip', value)
+
+    def sustain_pedal(self, sustain_on):
+        self.trigger_event('on_sustain_pedal', sustain_on)
+
+    def run_script(self, script, realtime=True):
+        """Runs a list of scripted events. Each event is a tuple (time, method_name, args) where time is in seconds
+        from the start of the script, method_name is one of the scripted event methods above (e.g. 'pad_pressed')
+        and args is a list of arguments for that method. If realtime is False, events are triggered as fast as
+        possible. Returns the time it took to run the script.
+        """
+        start_time = time.monotonic()
+        for event_time, method_name, args in script:
+            if realtime:
+                wait_time = start_time + event_time - time.monotonic()
+                if wait_time > 0:
+                    time.sleep(wait_time)
+            getattr(self, method_name)(*args)
+        return time.monotonic() - start_time
@@ -0,0 +1,94 @@
+import time
+
+import numpy
+import push2_python
+
+from stats_utils import RollingStats
+
+
+DISPLAY_RENDER_FORMAT_RGB565 = 'rgb565'
+DISPLAY_RENDER_FORMAT_ARGB32 = 'argb32'
+
+
+class Push2FrameEncoder(object):
+    """Converts frames rendered by cairo directly into the format that Push2 expects to receive over USB: lines of
+    960 BGR565 little-endian pixels followed by 128 filler bytes, with the whole buffer XORed with a fixed pattern.
+    The output buffer and all temporary buffers are allocated once, conversion is done with vectorized numpy operations
+    writing into these buffers, and the filler bytes (which never change) are masked only once.
+
+    Frames can be rendered in cairo's RGB16_565 format (pixels only need red and blue swapped) or in ARGB32 (pixels
+    are down-converted to 16 bits). Timings of the encode and transfer stages are kept in rolling statistics.
+    """
+
+    xor_pattern = [0xF3E7, 0xFFE7]  # Pattern 0xFFE7F3E7 as little-endian 16 bit words
+
+    def __init__(self, w=push2_python.constants.DISPLAY_LINE_PIXELS, h=push2_python.constants.DISPLAY_N_LINES,
+                 filler_bytes=128, stats_window_size=600):
+        self.w = w
+        self.h = h
+        line_words = w + filler_bytes // 2
+        self.xor_mask = numpy.tile(numpy.array(self.xor_pattern, dtype='<u2'), h * line_words // len(self.xor_pattern)).reshape(h, line_words)
+        self.xor_mask_pixels = self.xor_mask[:, :w]
+        self.encoded = self.xor_mask.copy()  # Filler words are zero, so they already hold their masked value
+        self.encoded_pixels = self.encoded[:, :w]  # View over the pixel part of each line
+        self.encoded_bytes = self.encoded.reshape(-1).view(numpy.uint8)  # What is sent to Push2
+        self.tmp16 = numpy.empty((h, w), dtype=numpy.uint16)
+        self.tmp32_a = numpy.empty((h, w), dtype=numpy.uint32)
+        self.tmp32_b = numpy.empty((h, w), dtype=numpy.uint32)
+        self.encode_stats = RollingStats(window_size=stats_window_size)
+        self.transfer_stats = RollingStats(window_size=stats_window_size)
+        self.n_frames_encoded = 0
+        self.n_frames_sent = 0
+
+    def encode_rgb565(self, pixels):
+        # pixels is a (h, w) uint16 array with cairo RGB16_565 pixels: swap red and blue and apply the XOR mask
+        out = self.encoded_pixels
+        numpy.left_shift(pixels, 11, out=out)  # Red bits (top 5 bits) are shifted out of the 16 bits
+        numpy.bitwise_and(pixels, 0x07E0, out=self.tmp16)
+        numpy.bitwise_or(out, self.tmp16, out=out)
+        numpy.right_shift(pixels, 11, out=self.tmp16)
+        numpy.bitwise_or(out, self.tmp16, out=out)
+        numpy.bitwise_xor(out, self.xor_mask_pixels, out=out)
+
+    def encode_argb32(self, pixels):
+        # pixels is a (h, w) uint32 array with cairo ARGB32 pixels (alpha is ignored, frames are opaque)
+        a, b = self.tmp32_a, self.tmp32_b
+        numpy.bitwise_and(pixels, 0xF8, out=a)  # Blue
+        numpy.left_shift(a, 8, out=a)
+        numpy.right_shift(pixels, 5, out=b)  # Green
+        numpy.bitwise_and(b, 0x07E0, out=b)
+        numpy.bitwise_or(a, b, out=a)
+        numpy.right_shift(pixels, 19, out=b)  # Red
+        numpy.bitwise_and(b, 0x1F, out=b)
+        numpy.bitwise_or(a, b, out=a)
+        numpy.bitwise_xor(a, self.xor_mask_pixels, out=self.encoded_pixels, casting='unsafe')
+
+    def encode(self, pixels):
+        start_time = time.perf_counter()
+        if pixels.dtype == numpy.uint32:
+            self.encode_argb32(pixels)
+        else:
+            self.encode_rgb565(pixels)
+        self.encode_stats.add(time.perf_counter() - start_time)
+        self.n_frames_encoded += 1
+
+    def send(self, push):
+        # Sends the last encoded frame (can be called again to re-send the same frame)
+        start_time = time.perf_counter()
+        push.display.send_to_display(self.encoded_bytes)
+        self.transfer_stats.add(time.perf_counter() - start_time)
+        self.n_frames_sent += 1
+
+    def get_stats(self):
+        # Times in milliseconds
+        to_ms = lambda value: value * 1000 if value is not None else None
+        encode_p50, encode_p95 = self.encode_stats.get_percentiles((50, 95))
+        transfer_p50, transfer_p95 = self.transfer_stats.get_percentiles((50, 95))
+        return {
+            'n_frames_encoded': self.n_frames_encoded,
+            'n_frames_sent': self.n_frames_sent,
+            'encode_p50_ms': to_ms(encode_p50),
+            'encode_p95_ms': to_ms(encode_p95),
+            'transfer_p50_ms': to_ms(transfer_p50),
+            'transfer_p95_ms': to_ms(transfer_p95),
+        }
@@ -0,0 +1,211 @@
+import collections
+import threading
+import time
+
+from stats_utils import RollingStats
+
+
+class FrameScheduler(object):
+    """Decides at which rate the display and main loops run. Loops run at the full target frame rate while there is
+    user activity (pads, encoders, buttons, MIDI in...) or while an animation is running (e.g. a notification fading
+    out), and drop to a low idle frame rate when nothing happened for a while. Loops waiting for their next frame are
+    woken up as soon as new activity is notified so the display responds immediately when leaving idle mode.
+
+    All times used by the scheduler come from the monotonic clock. Each loop paces itself using a FramePacer:
+
+        pacer = FramePacer(scheduler)
+        while True:
+            pacer.begin_frame()
+            ...do frame work...
+            pacer.end_frame_and_wait()
+    """
+
+    target_frame_rate = 60
+    idle_frame_rate = 5
+    idle_timeout = 5.0
+
+    def __init__(self, target_frame_rate=60, idle_frame_rate=5, idle_timeout=5.0):
+        self.target_frame_rate = target_frame_rate
+        self.idle_frame_rate = idle_frame_rate
+        self.idle_timeout = idle_timeout
+        self.condition = threading.Condition()
+        self.activity_count = 0
+        self.last_activity_time = time.monotonic()
+        self.full_rate_deadline = 0
+        self.time_spent_at_rate = collections.defaultdict(float)
+        self.last_time_accounted = time.monotonic()
+        self.last_frame_rate = target_frame_rate
+
+    def notify_activity(self):
+        # Call this whenever an input event arrives, loops will move (immediately) to the full frame rate
+        with self.condition:
+            self.last_activity_time = time.monotonic()
+            self.activity_count += 1
+            self.condition.notify_all()
+
+    def request_full_rate_for(self, duration):
+        # Keep running at full frame rate during the given time (e.g. until a notification finishes fading out)
+        with self.condition:
+            self.full_rate_deadline = max(self.full_rate_deadline, time.monotonic() + duration)
+            self.activity_count += 1
+            self.condition.notify_all()
+
+    def wake_up(self):
+        # Wakes up waiting loops without changing the frame rate (e.g. to let them exit)
+        with self.condition:
+            self.activity_count += 1
+            self.condition.notify_all()
+
+    def is_idle(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        return now - self.last_activity_time > self.idle_timeout and now > self.full_rate_deadline
+
+    def get_current_frame_rate(self, now=None):
+        if self.is_idle(now):
+            return min(self.idle_frame_rate, self.target_frame_rate)
+        return self.target_frame_rate
+
+    def get_activity_token(self):
+        # Returns a token that identifies the activity seen at a given moment. If new activity is notified
+        # after that, wait_until re-evaluates the frame rate (so waits at idle rate are cut short).
+        return self.activity_count
+
+    def wait_until(self, deadline, activity_token, frame_start_time, stop_event=None, process_events=None, wake_event=None):
+        # Waits until the given (monotonic) deadline. If activity is notified while waiting, the deadline is brought
+        # forward to what it would be at the current frame rate. Returns the deadline that was finally used.
+        # If process_events is given, it is called (without holding the lock) every time activity is notified so that
+        # the waiting loop can handle incoming events right away instead of at its next frame. process_events should
+        # handle a bounded batch of events and return the (monotonic) time at which it needs to be called again even
+        # if there is no new activity (e.g. because more events are pending), or None.
+        # If wake_event (a threading.Event) is given, the loop waits on it instead of on the scheduler lock and
+        # process_events is called every time it is set, so threads where events arrive only need to set wake_event
+        # and never take the scheduler lock (see wait_for_events_until).
+        if wake_event is not None:
+            return self.wait_for_events_until(deadline, activity_token, frame_start_time, wake_event, process_events,
+                                              stop_event=stop_event)
+        processed_activity_count = None
+        next_process_time = None
+        while stop_event is None or not stop_event.is_set():
+            if process_events is not None and (processed_activity_count != self.activity_count or
+                                               (next_process_time is not None and time.monotonic() >= next_process_time)):
+                processed_activity_count = self.activity_count
+                next_process_time = process_events()
+            with self.condition:
+                if self.activity_count != activity_token:
+                    activity_token = self.activity_count
+                    deadline = min(deadline, frame_start_time + 1.0 / self.get_current_frame_rate())
+                now = time.monotonic()
+                remaining = deadline - now
+                if remaining <= 0:
+                    break
+                if process_events is not None:
+                    if processed_activity_count != self.activity_count:
+                        continue  # Activity notified while processing events, process again before waiting
+                    if next_process_time is not None:
+                        if next_process_time <= now:
+                            continue
+                        remaining = min(remaining, next_process_time - now)
+                self.condition.wait(remaining)
+        return deadline
+
+    def wait_for_events_until(self, deadline, activity_token, frame_start_time, wake_event, process_events, stop_event=None):
+        # Like wait_until, but woken up by wake_event. wake_event is cleared before calling process_events, so events
+        # that arrive while processing set it again. Activity notified by other means (e.g. by process_events) only
+        # brings the deadline forward, it is checked every time the loop wakes up.
+        process = True
+        next_process_time = None
+        while stop_event is None or not stop_event.is_set():
+            if process or (next_process_time is not None and time.monotonic() >= next_process_time):
+                wake_event.clear()
+                next_process_time = process_events()
+            if self.activity_count != activity_token:
+                activity_token = self.activity_count
+                deadline = min(deadline, frame_start_time + 1.0 / self.get_current_frame_rate())
+            now = time.monotonic()
+            remaining = deadline - now
+            if remaining <= 0:
+                break
+            if next_process_time is not None:
+                if next_process_time <= now:
+                    process = True
+                    continue
+                remaining = min(remaining, next_process_time - now)
+            process = wake_event.wait(remaining)
+        return deadline
+
+    def account_time_at_rate(self):
+        # Adds the time since last call to the frame rate that was active. Should only be called from one loop.
+        now = time.monotonic()
+        self.time_spent_at_rate[self.last_frame_rate] += now - self.last_time_accounted
+        self.last_time_accounted = now
+        self.last_frame_rate = self.get_current_frame_rate(now)
+
+    def get_stats(self):
+        return {
+            'current_frame_rate': self.get_current_frame_rate(),
+            'is_idle': self.is_idle(),
+            'time_spent_at_rate': dict(self.time_spent_at_rate),
+        }
+
+
+class FramePacer(object):
+    """Paces one loop using absolute (monotonic) frame deadlines so that timing errors don't accumulate over time,
+    and keeps rolling statistics of frame times, of how late frames start with respect to their deadline (jitter),
+    and of missed deadlines. When a frame takes longer than its slot, the deadline is re-synchronized to the current
+    time instead of trying to catch up with a burst of frames.
+    """
+
+    def __init__(self, scheduler, stats_window_size=600):
+        self.scheduler = scheduler
+        self.frame_time_stats = RollingStats(window_size=stats_window_size)
+        self.lateness_stats = RollingStats(window_size=stats_window_size)
+        self.missed_deadlines = 0
+        self.n_frames = 0
+        self.next_deadline = None
+        self.frame_start_time = None
+        self.activity_token = None
+
+    def begin_frame(self):
+        now = time.monotonic()
+        if self.next_deadline is not None:
+            self.lateness_stats.add(max(0.0, now - self.next_deadline))
+        else:
+            self.next_deadline = now
+        self.frame_start_time = now
+        self.activity_token = self.scheduler.get_activity_token()
+
+    def end_frame_and_wait(self, stop_event=None, process_events=None, wake_event=None):
+        now = time.monotonic()
+        self.frame_time_stats.add(now - self.frame_start_time)
+        self.n_frames += 1
+
+        period = 1.0 / self.scheduler.get_current_frame_rate(now)
+        self.next_deadline += period
+        if self.next_deadline < self.frame_start_time:
+            # Deadline was set at a lower rate (e.g. idle) or wait was cut short, start counting from this frame
+            self.next_deadline = self.frame_start_time + period
+        if now > self.next_deadline:
+            # Frame took longer than its slot
+            self.missed_deadlines += int((now - self.next_deadline) / period) + 1
+            self.next_deadline = now
+            return
+        self.next_deadline = self.scheduler.wait_until(self.next_deadline, self.activity_token, self.frame_start_time,
+                                                       stop_event=stop_event, process_events=process_events,
+                                                       wake_event=wake_event)
+
+    def get_stats(self):
+        # Times in milliseconds
+        frame_time_p50, frame_time_p95, frame_time_p99 = self.frame_time_stats.get_percentiles((50, 95, 99))
+        lateness_p50, lateness_p95, lateness_p99 = self.lateness_stats.get_percentiles((50, 95, 99))
+        to_ms = lambda value: value * 1000 if value is not None else None
+        return {
+            'n_frames': self.n_frames,
+            'missed_deadlines': self.missed_deadlines,
+            'frame_time_p50_ms': to_ms(frame_time_p50),
+            'frame_time_p95_ms': to_ms(frame_time_p95),
+            'frame_time_p99_ms': to_ms(frame_time_p99),
+            'lateness_p50_ms': to_ms(lateness_p50),
+            'lateness_p95_ms': to_ms(lateness_p95),
+            'lateness_p99_ms': to_ms(lateness_p99),
+        }
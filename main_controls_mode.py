@@ -14,6 +14,8 @@ class MainControlsMode(definitions.PyshaMode):
     pyramid_track_triggering_button_pressing_time = None
     preset_selection_button_pressing_time = None
     button_quick_press_time = 0.400
+    handled_button_names = {MELODIC_RHYTHMIC_TOGGLE_BUTTON, SETTINGS_BUTTON, TOGGLE_DISPLAY_BUTTON,
+                            PYRAMID_TRACK_TRIGGERING_BUTTON, PRESET_SELECTION_MODE_BUTTON}
 
     def activate(self):
         self.update_buttons()
@@ -70,6 +72,8 @@ class MainControlsMode(definitions.PyshaMode):
             self.app.use_push2_display = not self.app.use_push2_display
             if not self.app.use_push2_display:
                 self.push.display.send_to_display(self.push.display.prepare_frame(self.push.display.make_black_frame()))
+            else:
+                self.app.display_needs_update = True
             self.app.buttons_need_update = True
             return True
         elif button_name == PYRAMID_TRACK_TRIGGERING_BUTTON:
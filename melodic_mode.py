@@ -3,6 +3,8 @@ import mido
 import push2_python.constants
 import time
 
+from midi_output import pitchwheel_data_bytes
+
 
 class MelodicMode(definitions.PyshaMode):
 
@@ -22,6 +24,8 @@ class MelodicMode(definitions.PyshaMode):
     latest_velocity_value = (0, 0)
     last_time_at_params_edited = None
     modulation_wheel_mode = False
+    handled_button_names = {push2_python.constants.BUTTON_OCTAVE_UP, push2_python.constants.BUTTON_OCTAVE_DOWN,
+                            push2_python.constants.BUTTON_ACCENT, push2_python.constants.BUTTON_SHIFT}
 
     def initialize(self, settings=None):
         if settings is not None:
@@ -155,13 +159,15 @@ class MelodicMode(definitions.PyshaMode):
 
     def on_midi_in(self, msg):
         # Update the list of notes being currently played so push2 pads can be updated accordingly
+        # (midi_in can be None when MIDI in events are replayed from an event log)
+        source = self.app.midi_in.name if self.app.midi_in is not None else 'midi_in'
         if msg.type == "note_on":
             if msg.velocity == 0:
-                self.remove_note_being_played(msg.note, self.app.midi_in.name)
+                self.remove_note_being_played(msg.note, source)
             else:
-                self.add_note_being_played(msg.note, self.app.midi_in.name)
+                self.add_note_being_played(msg.note, source)
         elif msg.type == "note_off":
-            self.remove_note_being_played(msg.note, self.app.midi_in.name)
+            self.remove_note_being_played(msg.note, source)
         self.app.pads_need_update = True 
 
     def update_accent_button(self):
@@ -209,8 +215,7 @@ class MelodicMode(definitions.PyshaMode):
         if midi_note is not None:
             self.latest_velocity_value = (time.time(), velocity)
             self.add_note_being_played(midi_note, 'push')
-            msg = mido.Message('note_on', note=midi_note, velocity=velocity if not self.fixed_velocity_mode else 127)
-            self.app.send_midi(msg)
+            self.app.send_midi_raw(self.app.midi_out_status.note_on, midi_note, velocity if not self.fixed_velocity_mode else 127)
             self.update_pads()  # Directly calling update pads method because we want user to feel feedback as quick as possible
             return True
 
@@ -218,8 +223,7 @@ class MelodicMode(definitions.PyshaMode):
         midi_note = self.pad_ij_to_midi_note(pad_ij)
         if midi_note is not None:
             self.remove_note_being_played(midi_note, 'push')
-            msg = mido.Message('note_off', note=midi_note, velocity=velocity)
-            self.app.send_midi(msg)
+            self.app.send_midi_raw(self.app.midi_out_status.note_off, midi_note, velocity)
             self.update_pads()  # Directly calling update pads method because we want user to feel feedback as quick as possible
             return True
 
@@ -229,25 +233,22 @@ class MelodicMode(definitions.PyshaMode):
             self.latest_poly_at_value = (time.time(), velocity)
             midi_note = self.pad_ij_to_midi_note(pad_ij)
             if midi_note is not None:
-                msg = mido.Message('polytouch', note=midi_note, value=velocity)
+                self.app.send_midi_raw(self.app.midi_out_status.polytouch, midi_note, velocity)
         else:
             # channel AT mode
             self.latest_channel_at_value = (time.time(), velocity)
-            msg = mido.Message('aftertouch', value=velocity)
-        self.app.send_midi(msg)
+            self.app.send_midi_raw(self.app.midi_out_status.aftertouch, velocity)
         return True
 
     def on_touchstrip(self, value):
         if self.modulation_wheel_mode:
-            msg = mido.Message('control_change', control=1, value=value)
+            self.app.send_midi_raw(self.app.midi_out_status.control_change, 1, value)
         else:
-            msg = mido.Message('pitchwheel', pitch=value)
-        self.app.send_midi(msg)
+            self.app.send_midi_raw(self.app.midi_out_status.pitchwheel, *pitchwheel_data_bytes(value))
         return True
 
     def on_sustain_pedal(self, sustain_on):
-        msg = mido.Message('control_change', control=64, value=127 if sustain_on else 0)
-        self.app.send_midi(msg)
+        self.app.send_midi_raw(self.app.midi_out_status.control_change, 64, 127 if sustain_on else 0)
         return True
 
     def on_button_pressed(self, button_name):
@@ -7,7 +7,7 @@ import json
 import os
 
 from definitions import PyshaMode, OFF_BTN_COLOR
-from display_utils import show_text
+from display_widgets import WidgetLayout
 
 
 class MIDICCControl(object):
@@ -21,65 +21,25 @@ class MIDICCControl(object):
     vmin = 0
     vmax = 127
     get_color_func = None
-    send_midi_func = None
+    send_cc_func = None
 
-    def __init__(self, cc_number, name, section_name, get_color_func, send_midi_func):
+    def __init__(self, cc_number, name, section_name, get_color_func, send_cc_func):
         self.cc_number = cc_number
         self.name = name
         self.section = section_name
         self.get_color_func = get_color_func
-        self.send_midi_func = send_midi_func
-
-    def draw(self, ctx, x_part):
-        margin_top = 25
-        
-        # Param name
-        name_height = 20
-        show_text(ctx, x_part, margin_top, self.name, height=name_height, font_color=definitions.WHITE)
-
-        # Param value
-        val_height = 30
-        color = self.get_color_func()
-        show_text(ctx, x_part, margin_top + name_height, str(self.value), height=val_height, font_color=color)
-
-        # Knob
-        ctx.save()
-
-        circle_break_degrees = 80
-        height = 55
-        radius = height/2
-
-        display_w = push2_python.constants.DISPLAY_LINE_PIXELS
-        x = (display_w // 8) * x_part
-        y = margin_top + name_height + val_height + radius + 5
-        
-        start_rad = (90 + circle_break_degrees // 2) * (math.pi / 180)
-        end_rad = (90 - circle_break_degrees // 2) * (math.pi / 180)
-        xc = x + radius + 3
-        yc = y
-
-        def get_rad_for_value(value):
-            total_degrees = 360 - circle_break_degrees
-            return start_rad + total_degrees * ((value - self.vmin)/(self.vmax - self.vmin)) * (math.pi / 180)
-
-        # This is needed to prevent showing line from previous position
-        ctx.set_source_rgb(0, 0, 0)
-        ctx.move_to(xc, yc)
-        ctx.stroke()
-
-        # Inner circle
-        ctx.arc(xc, yc, radius, start_rad, end_rad)
-        ctx.set_source_rgb(*definitions.get_color_rgb_float(definitions.GRAY_LIGHT))
-        ctx.set_line_width(1)
-        ctx.stroke()
-
-        # Outer circle
-        ctx.arc(xc, yc, radius, start_rad, get_rad_for_value(self.value))
-        ctx.set_source_rgb(* definitions.get_color_rgb_float(color))
-        ctx.set_line_width(3)
-        ctx.stroke()
-
-        ctx.restore()
+        self.send_cc_func = send_cc_func
+
+    def get_display_state(self):
+        return self.name, self.value, (self.value - self.vmin)/(self.vmax - self.vmin), self.get_color_func()
+
+    @staticmethod
+    def update_widgets(name_label, value_label, knob, state):
+        # Param name, value and knob (see MIDICCMode.create_widgets for the layout) from a get_display_state snapshot
+        name, value, value_fraction, color = state
+        name_label.set(visible=True, text=name, font_color=definitions.WHITE)
+        value_label.set(visible=True, text=str(value), font_color=color)
+        knob.set(visible=True, value_fraction=value_fraction, color=color)
     
     def update_value(self, increment): 
         if self.value + increment > self.vmax:
@@ -90,8 +50,7 @@ class MIDICCControl(object):
             self.value += increment
 
         # Send cc message, subtract 1 to number because MIDO works from 0 - 127
-        msg = mido.Message('control_change', control=self.cc_number, value=self.value)
-        self.send_midi_func(msg)
+        self.send_cc_func(self.cc_number, self.value)
 
 
 class MIDICCMode(PyshaMode):
@@ -106,11 +65,29 @@ class MIDICCMode(PyshaMode):
         push2_python.constants.BUTTON_UPPER_ROW_7,
         push2_python.constants.BUTTON_UPPER_ROW_8
     ]
+    midi_cc_button_columns = {button_name: column for column, button_name in enumerate(midi_cc_button_names)}
+    page_button_names = {push2_python.constants.BUTTON_PAGE_LEFT, push2_python.constants.BUTTON_PAGE_RIGHT}
+    handled_button_names = set(midi_cc_button_names) | page_button_names
+    encoder_columns = {encoder_name: column for column, encoder_name in enumerate([
+        push2_python.constants.ENCODER_TRACK1_ENCODER,
+        push2_python.constants.ENCODER_TRACK2_ENCODER,
+        push2_python.constants.ENCODER_TRACK3_ENCODER,
+        push2_python.constants.ENCODER_TRACK4_ENCODER,
+        push2_python.constants.ENCODER_TRACK5_ENCODER,
+        push2_python.constants.ENCODER_TRACK6_ENCODER,
+        push2_python.constants.ENCODER_TRACK7_ENCODER,
+        push2_python.constants.ENCODER_TRACK8_ENCODER,
+    ])}
     instrument_midi_control_ccs = {}
     active_midi_control_ccs = []
     current_selected_section_and_page = {}
+    retains_display_layer = True
+    widgets = None
+    section_labels = []
+    control_widgets = []
 
     def initialize(self, settings=None):
+        self.create_widgets()
         for instrument_short_name in self.get_all_distinct_instrument_short_names_helper():
             try:
                 midi_cc = json.load(open(os.path.join(definitions.INSTRUMENT_DEFINITION_FOLDER, '{}.json'.format(instrument_short_name)))).get('midi_cc', None)
@@ -123,7 +100,7 @@ class MIDICCMode(PyshaMode):
                 for section in midi_cc:
                     section_name = section['section']
                     for name, cc_number in section['controls']:
-                        control = MIDICCControl(cc_number, name, section_name, self.get_current_track_color_helper, self.app.send_midi)
+                        control = MIDICCControl(cc_number, name, section_name, self.get_current_track_color_helper, self.send_cc)
                         self.instrument_midi_control_ccs[instrument_short_name].append(control)
                 print('Loaded {0} MIDI cc mappings for instrument {1}'.format(len(self.instrument_midi_control_ccs[instrument_short_name]), instrument_short_name))
             else:
@@ -132,7 +109,7 @@ class MIDICCMode(PyshaMode):
                 for i in range(0, 128):
                     section_s = (i // 16) * 16
                     section_e = section_s + 15
-                    control = MIDICCControl(i, 'CC {0}'.format(i), '{0} to {1}'.format(section_s, section_e), self.get_current_track_color_helper, self.app.send_midi)
+                    control = MIDICCControl(i, 'CC {0}'.format(i), '{0} to {1}'.format(section_s, section_e), self.get_current_track_color_helper, self.send_cc)
                     self.instrument_midi_control_ccs[instrument_short_name].append(control)
                 print('Loaded default MIDI cc mappings for instrument {0}'.format(instrument_short_name))
       
@@ -140,12 +117,28 @@ class MIDICCMode(PyshaMode):
         for instrument_short_name in self.instrument_midi_control_ccs:
             self.current_selected_section_and_page[instrument_short_name] = (self.instrument_midi_control_ccs[instrument_short_name][0].section, 0)
 
+    def create_widgets(self):
+        self.widgets = WidgetLayout()
+        self.section_labels = [self.widgets.add_text(i, 0, height=20) for i in range(0, 8)]
+        margin_top = 25
+        name_height = 20
+        val_height = 30
+        knob_radius = 55/2
+        self.control_widgets = [(
+            self.widgets.add_text(i, margin_top, height=name_height),
+            self.widgets.add_text(i, margin_top + name_height, height=val_height),
+            self.widgets.add_knob(i, margin_top + name_height + val_height + 3, knob_radius),
+        ) for i in range(0, 8)]
+
     def get_all_distinct_instrument_short_names_helper(self):
         return self.app.track_selection_mode.get_all_distinct_instrument_short_names()
 
     def get_current_track_color_helper(self):
         return self.app.track_selection_mode.get_current_track_color()
 
+    def send_cc(self, cc_number, value):
+        self.app.send_midi_raw(self.app.midi_out_status.control_change, cc_number, value)
+
     def get_current_track_instrument_short_name_helper(self):
         return self.app.track_selection_mode.get_current_track_instrument_short_name()
 
@@ -182,6 +175,7 @@ class MIDICCMode(PyshaMode):
         self.current_selected_section_and_page[self.get_current_track_instrument_short_name_helper()] = result
         self.active_midi_control_ccs = self.get_midi_cc_controls_for_current_track_section_and_page()
         self.app.buttons_need_update = True
+        self.invalidate_display()
 
     def get_should_show_midi_cc_next_prev_pages_for_section(self):
         all_section_controls = self.get_midi_cc_controls_for_current_track_and_section()
@@ -196,6 +190,7 @@ class MIDICCMode(PyshaMode):
 
     def new_track_selected(self):
         self.active_midi_control_ccs = self.get_midi_cc_controls_for_current_track_section_and_page()
+        self.invalidate_display()
 
     def activate(self):
         self.update_buttons()
@@ -223,54 +218,53 @@ class MIDICCMode(PyshaMode):
         else:
             self.push.buttons.set_button_color(push2_python.constants.BUTTON_PAGE_RIGHT, definitions.BLACK)
 
-    def update_display(self, ctx, w, h):
-
-        if not self.app.is_mode_active(self.app.settings_mode):
-            # If settings mode is active, don't draw the upper parts of the screen because settings page will
-            # "cover them"
-
-            # Draw MIDI CCs section names
-            section_names = self.get_current_track_midi_cc_sections()[0:8]
-            if section_names:
-                height = 20
-                for i, section_name in enumerate(section_names):
-                    show_text(ctx, i, 0, section_name, background_color=definitions.RED)
-                    
-                    is_selected = False
-                    selected_section, _ = self.get_currently_selected_midi_cc_section_and_page()
-                    if selected_section == section_name:
-                        is_selected = True
-
-                    current_track_color = self.get_current_track_color_helper()
-                    if is_selected:
-                        background_color = current_track_color
-                        font_color = definitions.BLACK
-                    else:
-                        background_color = definitions.BLACK
-                        font_color = current_track_color
-                    show_text(ctx, i, 0, section_name, height=height,
-                            font_color=font_color, background_color=background_color)
-
-            # Draw MIDI CC controls
-            if self.active_midi_control_ccs:
-                for i in range(0, min(len(self.active_midi_control_ccs), 8)):
-                    try:
-                        self.active_midi_control_ccs[i].draw(ctx, i)
-                    except IndexError:
-                        continue
+    def get_display_state(self):
+        # If settings mode is active, don't draw the upper parts of the screen because settings page will "cover them"
+        visible = not self.app.is_mode_active(self.app.settings_mode)
+        section_names = tuple(self.get_current_track_midi_cc_sections()[0:8]) if visible else ()
+        selected_section, _ = self.get_currently_selected_midi_cc_section_and_page()
+        controls = tuple(control.get_display_state() for control in self.active_midi_control_ccs[0:8]) if visible else ()
+        return section_names, selected_section, self.get_current_track_color_helper(), controls
+
+    def update_display(self, ctx, w, h, state):
+
+        # Update MIDI CCs section names
+        section_names, selected_section, current_track_color, controls = state
+        for i, label in enumerate(self.section_labels):
+            if i < len(section_names):
+                if section_names[i] == selected_section:
+                    background_color = current_track_color
+                    font_color = definitions.BLACK
+                else:
+                    background_color = definitions.BLACK
+                    font_color = current_track_color
+                label.set(visible=True, text=section_names[i], font_color=font_color, background_color=background_color)
+            else:
+                label.set(visible=False)
+
+        # Update MIDI CC controls
+        for i, (name_label, value_label, knob) in enumerate(self.control_widgets):
+            if i < len(controls):
+                MIDICCControl.update_widgets(name_label, value_label, knob, controls[i])
+            else:
+                name_label.set(visible=False)
+                value_label.set(visible=False)
+                knob.set(visible=False)
+
+        self.widgets.render(ctx)
  
     
     def on_button_pressed(self, button_name):
-        if  button_name in self.midi_cc_button_names:
+        idx = self.midi_cc_button_columns.get(button_name, None)
+        if idx is not None:
             current_track_sections = self.get_current_track_midi_cc_sections()
             n_sections = len(current_track_sections)
-            idx = self.midi_cc_button_names.index(button_name)
             if idx < n_sections:
                 new_section = current_track_sections[idx]
                 self.update_current_section_page(new_section=new_section, new_page=0)
             return True
 
-        elif button_name in [push2_python.constants.BUTTON_PAGE_LEFT, push2_python.constants.BUTTON_PAGE_RIGHT]:
+        elif button_name in self.page_button_names:
             show_prev, show_next = self.get_should_show_midi_cc_next_prev_pages_for_section()
             _, current_page = self.get_currently_selected_midi_cc_section_and_page()
             if button_name == push2_python.constants.BUTTON_PAGE_LEFT and show_prev:
@@ -281,19 +275,8 @@ class MIDICCMode(PyshaMode):
 
 
     def on_encoder_rotated(self, encoder_name, increment):
-        try:
-            encoder_num = [
-                push2_python.constants.ENCODER_TRACK1_ENCODER,
-                push2_python.constants.ENCODER_TRACK2_ENCODER,
-                push2_python.constants.ENCODER_TRACK3_ENCODER,
-                push2_python.constants.ENCODER_TRACK4_ENCODER,
-                push2_python.constants.ENCODER_TRACK5_ENCODER,
-                push2_python.constants.ENCODER_TRACK6_ENCODER,
-                push2_python.constants.ENCODER_TRACK7_ENCODER,
-                push2_python.constants.ENCODER_TRACK8_ENCODER,
-            ].index(encoder_name)
-            if self.active_midi_control_ccs:
-                self.active_midi_control_ccs[encoder_num].update_value(increment)
-        except ValueError: 
-            pass  # Encoder not in list 
+        encoder_num = self.encoder_columns.get(encoder_name, None)
+        if encoder_num is not None and encoder_num < len(self.active_midi_control_ccs):
+            self.active_midi_control_ccs[encoder_num].update_value(increment)
+            self.invalidate_display()
         return True  # Always return True because encoder should not be used in any other mode if this is first active
@@ -0,0 +1,226 @@
+import collections
+import threading
+import time
+import traceback
+
+from midi_output import NOTE_OFF, NOTE_ON, POLYTOUCH
+
+
+# Names of the message types that can be filtered, indexed by the upper 4 bits of the status byte
+MESSAGE_TYPE_NAMES = {
+    0x8: 'note_off',
+    0x9: 'note_on',
+    0xA: 'polytouch',
+    0xB: 'control_change',
+    0xC: 'program_change',
+    0xD: 'aftertouch',
+    0xE: 'pitchwheel',
+}
+
+KEEP_CHANNEL = None  # Returned by MIDIInputTransform.apply when the message goes to the selected track channel
+DROP = -1  # Returned by MIDIInputTransform.apply when the message is filtered out
+
+
+class MIDIInputTransform(object):
+    """Transforms the channel messages received from the MIDI in device before they are forwarded to the MIDI out
+    and to the active modes. The transform is configured with the "midi_in_transform" entry of settings.json:
+
+        "midi_in_transform": {
+            "filter": ["polytouch", "program_change"],  # Message types to drop
+            "channel_map": {"0": 2, "1": 3},  # Input channel -> output channel (other channels go to the track channel)
+            "transpose": 12,  # Semitones added to all notes
+            "splits": [  # Note ranges (inclusive) with their own output channel and/or transposition
+                {"low": 0, "high": 59, "channel": 1, "transpose": -12},
+                {"low": 60, "high": 127}
+            ],
+            "velocity_curve": 0.6  # Exponent of the velocity curve (<1 makes it softer) or list of 128 velocities
+        }
+
+    When compiled, everything is turned into lookup tables indexed by status nibble, channel, note number or velocity,
+    so applying the transform to a message only takes a few list lookups. Transposed notes out of the MIDI range are
+    dropped.
+    """
+
+    def __init__(self, settings=None):
+        self.settings = settings if settings is not None else {}
+        self.enabled = False
+        self.type_filter = [False] * 16  # Status nibble -> drop message
+        self.channel_table = [KEEP_CHANNEL] * 16  # Input channel -> output channel
+        self.note_table = list(range(0, 128))  # Input note -> output note (DROP if out of range)
+        self.note_channel_table = [KEEP_CHANNEL] * 128  # Input note -> output channel (set by splits)
+        self.velocity_table = list(range(0, 128))
+        self.n_messages_transformed = 0
+        self.n_messages_dropped = 0
+        self.compile()
+
+    def compile(self):
+        settings = self.settings
+        self.type_filter = [False] * 16
+        for type_name in settings.get('filter', []):
+            for nibble, name in MESSAGE_TYPE_NAMES.items():
+                if name == type_name:
+                    self.type_filter[nibble] = True
+
+        self.channel_table = [KEEP_CHANNEL] * 16
+        for input_channel, output_channel in settings.get('channel_map', {}).items():
+            self.channel_table[int(input_channel)] = output_channel
+
+        transpose = settings.get('transpose', 0)
+        self.note_table = [note + transpose for note in range(0, 128)]
+        self.note_channel_table = [KEEP_CHANNEL] * 128
+        for split in settings.get('splits', []):
+            for note in range(max(0, split.get('low', 0)), min(127, split.get('high', 127)) + 1):
+                self.note_table[note] = note + transpose + split.get('transpose', 0)
+                self.note_channel_table[note] = split.get('channel', KEEP_CHANNEL)
+        self.note_table = [note if 0 <= note <= 127 else DROP for note in self.note_table]
+
+        velocity_curve = settings.get('velocity_curve', None)
+        if velocity_curve is None:
+            self.velocity_table = list(range(0, 128))
+        elif isinstance(velocity_curve, list):
+            if len(velocity_curve) != 128:
+                print('Velocity curve must have 128 values, ignoring it')
+                self.velocity_table = list(range(0, 128))
+            else:
+                self.velocity_table = [max(0, min(127, int(velocity))) for velocity in velocity_curve]
+        else:
+            self.velocity_table = [max(1, min(127, int(round(127 * (velocity / 127) ** velocity_curve))))
+                                   for velocity in range(0, 128)]
+        self.velocity_table[0] = 0  # Note on with velocity 0 is a note off
+
+        self.enabled = any(self.type_filter) or any(channel is not None for channel in self.channel_table) \
+            or self.note_table != list(range(0, 128)) or any(channel is not None for channel in self.note_channel_table) \
+            or self.velocity_table != list(range(0, 128))
+
+    def apply(self, message_bytes):
+        # Transforms a channel message (list of bytes) in place. Returns the output channel for the message, KEEP_CHANNEL
+        # if it should be sent to the selected track channel, or DROP if the message is filtered out.
+        status = message_bytes[0]
+        message_type = status & 0xF0
+        if self.type_filter[status >> 4]:
+            self.n_messages_dropped += 1
+            return DROP
+        channel = self.channel_table[status & 0x0F]
+        if message_type == NOTE_ON or message_type == NOTE_OFF or message_type == POLYTOUCH:
+            note = message_bytes[1]
+            new_note = self.note_table[note]
+            if new_note == DROP:
+                self.n_messages_dropped += 1
+                return DROP
+            message_bytes[1] = new_note
+            note_channel = self.note_channel_table[note]
+            if note_channel is not None:
+                channel = note_channel
+            if message_type == NOTE_ON:
+                message_bytes[2] = self.velocity_table[message_bytes[2]]
+        self.n_messages_transformed += 1
+        return channel
+
+    def get_stats(self):
+        return {
+            'enabled': self.enabled,
+            'messages_transformed': self.n_messages_transformed,
+            'messages_dropped': self.n_messages_dropped,
+        }
+
+
+class MIDIInputWorker(object):
+    """Thread that handles the messages received from the MIDI in device, so mido's callback thread only has to
+    queue them (put). Messages are kept in a bounded deque (if it is full, new messages are dropped and counted, except
+    note on/off messages, which are always queued so notes never get stuck on the MIDI out) and passed to
+    handle_message(msg, arrival_time) in the worker thread, which forwards them to the MIDI out right away.
+    State used by the UI (e.g. notes being played) must not be changed from handle_message, PyshaApp collects the
+    messages for the modes and passes them to the modes in its main loop once per frame.
+    """
+
+    def __init__(self, handle_message, max_queue_size=4096):
+        self.handle_message = handle_message
+        self.max_queue_size = max_queue_size
+        self.queue = collections.deque()
+        self.message_available = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.handling = False
+        self.n_messages_received = 0
+        self.n_messages_dropped = 0
+        self.n_messages_handled = 0
+        self.max_depth = 0
+
+    def put(self, msg):
+        # Called from mido's callback thread
+        depth = len(self.queue)
+        if depth >= self.max_queue_size and msg.type != 'note_on' and msg.type != 'note_off':
+            self.n_messages_dropped += 1
+            return False
+        self.queue.append((msg, time.perf_counter()))
+        self.n_messages_received += 1
+        if depth + 1 > self.max_depth:
+            self.max_depth = depth + 1
+        self.message_available.set()
+        return True
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.message_available.wait(0.5)
+            self.message_available.clear()
+            self.process()
+
+    def process(self):
+        # Handles all queued messages, returns the number of messages handled
+        n_handled = 0
+        self.handling = True
+        try:
+            while True:
+                try:
+                    msg, arrival_time = self.queue.popleft()
+                except IndexError:
+                    break
+                try:
+                    self.handle_message(msg, arrival_time)
+                except Exception as e:
+                    print('Error handling MIDI in message {0}: {1}'.format(msg, str(e)))
+                    traceback.print_exc()
+                n_handled += 1
+        finally:
+            self.handling = False
+        self.n_messages_handled += n_handled
+        return n_handled
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='PyshaMIDIIn', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.message_available.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def is_worker_thread(self):
+        return self.thread is not None and threading.current_thread() is self.thread
+
+    def is_idle(self):
+        return not self.queue and not self.handling
+
+    def wait_until_idle(self, timeout=1.0):
+        # Waits until all queued messages have been handled (if the worker is not running, handles them here)
+        if self.thread is None:
+            self.process()
+            return True
+        end_time = time.monotonic() + timeout
+        while not self.is_idle():
+            if time.monotonic() > end_time:
+                return False
+            time.sleep(0.0005)
+        return True
+
+    def get_stats(self):
+        return {
+            'queue_depth': len(self.queue),
+            'queue_max_depth': self.max_depth,
+            'messages_received': self.n_messages_received,
+            'messages_dropped': self.n_messages_dropped,
+            'messages_handled': self.n_messages_handled,
+        }
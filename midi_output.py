@@ -0,0 +1,600 @@
+import collections
+import threading
+import time
+
+import mido
+
+
+# Status bytes of channel messages (for channel 0, channel number goes in the lower 4 bits)
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+POLYTOUCH = 0xA0
+CONTROL_CHANGE = 0xB0
+PROGRAM_CHANGE = 0xC0
+AFTERTOUCH = 0xD0
+PITCHWHEEL = 0xE0
+
+
+class ChannelStatusBytes(object):
+    """Precomputed status bytes of the channel messages for one MIDI channel (0-15)"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.note_off = NOTE_OFF | channel
+        self.note_on = NOTE_ON | channel
+        self.polytouch = POLYTOUCH | channel
+        self.control_change = CONTROL_CHANGE | channel
+        self.program_change = PROGRAM_CHANGE | channel
+        self.aftertouch = AFTERTOUCH | channel
+        self.pitchwheel = PITCHWHEEL | channel
+
+
+CHANNEL_STATUS_BYTES = [ChannelStatusBytes(channel) for channel in range(0, 16)]
+
+
+def pitchwheel_data_bytes(pitch):
+    # Returns (lsb, msb) data bytes for a pitch value in range [-8192, 8191] (same range as mido)
+    value = max(0, min(16383, pitch + 8192))
+    return value & 0x7F, value >> 7
+
+
+def get_n_data_bytes(status):
+    # Number of data bytes of a message given its status byte (None for sysex, which ends with 0xF7)
+    if status < 0xF0:
+        return 1 if status & 0xF0 in (PROGRAM_CHANGE, AFTERTOUCH) else 2
+    elif status == 0xF0:
+        return None
+    elif status in (0xF1, 0xF3):
+        return 1
+    elif status == 0xF2:
+        return 2
+    return 0
+
+
+class MIDIOutput(object):
+    """Wraps a mido output port to send MIDI messages as raw bytes (lists of ints, e.g. [status, data1, data2]).
+    When the port uses mido's rtmidi backend, bytes are written directly to the underlying rtmidi port, skipping
+    mido.Message creation, validation and copying. Other backends get the bytes converted to mido.Message objects.
+
+    Messages the port rejects as invalid (ValueError) are skipped and counted, errors from the device itself (IOError,
+    OSError) are raised.
+
+    Messages can be batched (see MIDIBatch): while a batch is open, messages are collected and then written back to
+    back when the batch ends. Each message is still a separate write, as rtmidi (and mido) ports only take one
+    complete message per call.
+
+    Each output can have its own MIDIOutputShaper and MIDIOutputSerializer, which are used by PyshaApp when sending
+    messages to it. Messages are sent from Pysha's main loop and from the MIDI in worker thread, PyshaApp holds lock
+    while sending to the output (or while a batch is open) so writes and shaper/serializer state are not mixed up.
+    """
+
+    def __init__(self, port, shaper=None, serializer=None):
+        self.port = port
+        self.name = port.name
+        self.shaper = shaper
+        self.serializer = serializer
+        rt_port = getattr(port, '_rt', None)
+        if rt_port is not None and hasattr(rt_port, 'send_message'):
+            self.write = rt_port.send_message
+        else:
+            self.write = self.write_message
+        self.lock = threading.RLock()
+        self.batch = None  # List of messages to write when batching
+        self.batch_depth = 0
+        self.n_messages_sent = 0
+        self.n_bytes_sent = 0
+        self.n_writes = 0
+        self.n_invalid_messages = 0
+
+    @property
+    def closed(self):
+        return self.port.closed
+
+    def write_message(self, message_bytes):
+        self.port.send(mido.Message.from_bytes(message_bytes))
+
+    def send_bytes(self, message_bytes):
+        self.n_messages_sent += 1
+        if self.batch is not None:
+            self.batch.append(message_bytes)
+            return
+        if self.write_checked(message_bytes):
+            self.n_bytes_sent += len(message_bytes)
+
+    def write_checked(self, message_bytes):
+        # Writes a message, returns False if the port rejected it as invalid
+        try:
+            self.write(message_bytes)
+        except ValueError as e:
+            self.n_invalid_messages += 1
+            print('Invalid MIDI message {0} not sent to "{1}": {2}'.format(list(message_bytes), self.name, e))
+            return False
+        self.n_writes += 1
+        return True
+
+    def begin_batch(self):
+        # Batches can be nested, messages are written when the outermost batch ends
+        self.batch_depth += 1
+        if self.batch is None:
+            self.batch = []
+
+    def end_batch(self):
+        # Writes the batched messages one by one, returns the total size of the messages written (0 if the batch is
+        # nested or empty)
+        self.batch_depth -= 1
+        if self.batch_depth > 0:
+            return 0
+        batch = self.batch
+        self.batch = None
+        n_bytes = 0
+        for message_bytes in batch:
+            if self.write_checked(message_bytes):
+                n_bytes += len(message_bytes)
+        self.n_bytes_sent += n_bytes
+        return n_bytes
+
+    def get_stats(self):
+        return {
+            'messages_sent': self.n_messages_sent,
+            'bytes_sent': self.n_bytes_sent,
+            'writes': self.n_writes,
+            'invalid_messages': self.n_invalid_messages,
+        }
+
+    def send(self, msg):
+        # Compatibility with mido output ports
+        self.send_bytes(msg.bytes())
+
+    def close(self):
+        self.port.close()
+
+
+class MIDIBatch(object):
+    """Context manager which defers the messages sent to a MIDIOutput while it is open (output can be None, then it
+    does nothing). When the batch ends, the deferred messages are written back to back while holding the output lock,
+    with one send_message call per message (bytes are written as sent, without running status), so the batch saves
+    no bytes or writes but keeps messages from other threads from being interleaved with it. After the batch ends,
+    n_bytes has the total size of the messages written (0 for nested batches, whose messages are written when the
+    outermost batch ends). If on_error is given, device errors raised while writing the batch are passed to
+    on_error(output, error) instead of being raised.
+
+        with MIDIBatch(midi_out) as batch:
+            ...
+        print(batch.n_bytes)
+    """
+
+    def __init__(self, output, on_error=None):
+        self.output = output
+        self.on_error = on_error
+        self.n_bytes = 0
+
+    def __enter__(self):
+        if self.output is not None:
+            self.output.lock.acquire()  # Other threads can't send to the output while the batch is open
+            self.output.begin_batch()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.output is not None:
+            try:
+                self.n_bytes = self.output.end_batch()
+            except (IOError, OSError) as e:
+                if self.on_error is None:
+                    raise
+                self.on_error(self.output, e)
+            finally:
+                self.output.lock.release()
+        return False
+
+
+class MIDIOutputShaper(object):
+    """Thins continuous controller messages (CCs, poly/channel aftertouch and pitch bend) before they are sent to
+    the MIDI out. Messages that repeat the last value sent for the same controller (same channel, message type and
+    CC/note number) are dropped, and controllers are limited to a maximum rate (messages per second): messages
+    arriving faster are held and replaced by newer ones, and the last held value is always sent once the controller
+    can send again (see pop_due_messages). Other messages (notes, program changes...) and CCs which are not
+    continuous data (bank select, data entry and increment, RPN/NRPN and channel mode messages, where every message
+    counts) are never shaped, but pending messages of the same channel are flushed before notes so notes are sent with
+    up-to-date controller values. Aftertouch values sent for a note are forgotten when a note starts or ends (for
+    the whole channel with channel aftertouch), so the first aftertouch value of a new note is never dropped as a
+    repeat.
+
+    max_rate applies to all message types, max_rates can override it per message type (e.g. {'pitchwheel': 100}).
+    A rate of 0 disables rate limiting.
+    """
+
+    shaped_message_types = {
+        CONTROL_CHANGE: 'control_change',
+        POLYTOUCH: 'polytouch',
+        AFTERTOUCH: 'aftertouch',
+        PITCHWHEEL: 'pitchwheel',
+    }
+
+    unshaped_controls = frozenset([0, 32, 6, 38, 96, 97, 98, 99, 100, 101] + list(range(120, 128)))
+
+    def __init__(self, max_rate=200, max_rates=None, drop_repeats=True):
+        self.max_rate = max_rate
+        self.max_rates = dict(max_rates) if max_rates is not None else {}
+        self.drop_repeats = drop_repeats
+        self.min_intervals = {}  # Message type -> min time between messages of the same controller
+        for message_type, message_type_name in self.shaped_message_types.items():
+            rate = self.max_rates.get(message_type_name, max_rate)
+            self.min_intervals[message_type] = 1.0 / rate if rate else 0.0
+        self.last_sent = {}  # key -> [time, message bytes]
+        self.pending = collections.OrderedDict()  # key -> [flush time, message bytes]
+        self.n_messages_sent = 0
+        self.n_repeats_dropped = 0
+        self.n_rate_limited_dropped = 0
+
+    def get_key(self, message_bytes):
+        status = message_bytes[0]
+        message_type = status & 0xF0
+        if message_type == CONTROL_CHANGE:
+            if message_bytes[1] in self.unshaped_controls:
+                return None
+            return status, message_bytes[1]
+        elif message_type == POLYTOUCH:
+            return status, message_bytes[1]
+        elif message_type == AFTERTOUCH or message_type == PITCHWHEEL:
+            return status, None
+        return None
+
+    def mark_sent(self, key, message_bytes, now):
+        self.last_sent[key] = [now, message_bytes]
+        self.n_messages_sent += 1
+
+    def add(self, message_bytes, now):
+        # Returns True if the message was dropped or is kept pending, False if it should be sent now
+        key = self.get_key(message_bytes)
+        if key is None:
+            return False
+        last_sent = self.last_sent.get(key, None)
+        pending = self.pending.get(key, None)
+        if self.drop_repeats and last_sent is not None and last_sent[1] == message_bytes:
+            if pending is not None:
+                # Controller went back to the value last sent, pending value is no longer needed
+                del self.pending[key]
+                self.n_rate_limited_dropped += 1
+            self.n_repeats_dropped += 1
+            return True
+        min_interval = self.min_intervals[message_bytes[0] & 0xF0]
+        if last_sent is not None and now - last_sent[0] < min_interval:
+            if pending is None:
+                self.pending[key] = [last_sent[0] + min_interval, message_bytes]
+            else:
+                pending[1] = message_bytes
+                self.n_rate_limited_dropped += 1
+            return True
+        if pending is not None:
+            del self.pending[key]  # Replaced by this message, which can be sent now
+            self.n_rate_limited_dropped += 1
+        self.mark_sent(key, message_bytes, now)
+        return False
+
+    def pop_messages_to_flush_before(self, message_bytes, now):
+        # Returns pending messages that need to be sent before the given (not shaped) message
+        if message_bytes[0] & 0xF0 not in (NOTE_ON, NOTE_OFF):
+            return []
+        channel = message_bytes[0] & 0x0F
+        messages = []
+        if self.pending:
+            keys = [key for key in self.pending if key[0] & 0x0F == channel]
+            messages = [self.pop_message(key, now) for key in keys]
+        self.last_sent.pop((AFTERTOUCH | channel, None), None)
+        self.last_sent.pop((POLYTOUCH | channel, message_bytes[1]), None)
+        return messages
+
+    def pop_message(self, key, now):
+        message_bytes = self.pending.pop(key)[1]
+        self.mark_sent(key, message_bytes, now)
+        return message_bytes
+
+    def pop_due_messages(self, now, flush=False):
+        # Returns pending messages that can be sent now (or all pending messages if flush is True), in the order
+        # they were first held
+        due_keys = [key for key, (flush_time, _) in self.pending.items() if flush or flush_time <= now]
+        return [self.pop_message(key, now) for key in due_keys]
+
+    def get_next_flush_time(self):
+        if not self.pending:
+            return None
+        return min(flush_time for flush_time, _ in self.pending.values())
+
+    def reset(self):
+        # Forget last values sent (e.g. when the MIDI out device changes), pending messages are discarded
+        self.last_sent = {}
+        self.pending.clear()
+
+    def get_stats(self):
+        return {
+            'sent': self.n_messages_sent,
+            'repeats_dropped': self.n_repeats_dropped,
+            'rate_limited_dropped': self.n_rate_limited_dropped,
+            'pending': len(self.pending),
+        }
+
+
+class MIDIOutputSerializer(object):
+    """Schedules the messages sent to a MIDI out connected to a DIN MIDI link, whose bandwidth is fixed (31250 baud,
+    3125 bytes per second). The serializer keeps an estimate of when the link will have sent all bytes written so
+    far, counting running status (a channel message with the same status byte as the previous one takes one byte
+    less, as DIN interfaces usually apply it). While the backlog of the link is below congestion_threshold seconds,
+    messages are written right away. When the link is congested, messages are queued and released as the link has
+    room.
+
+    Queued messages are kept in one FIFO per channel, and are written in the order they were sent except for note
+    on/off messages, which go ahead of the mergeable CCs queued before them in their channel (so a burst of knob
+    moves does not delay notes). When choosing the next channel to release, channels with a note (or any other
+    non-controller message) ready to be written go ahead of channels whose next message is a continuous controller
+    (CC, aftertouch or pitch bend). A queued controller value is replaced by a newer value of the same controller if only
+    other mergeable controllers were queued after it in that channel, so merged values are still written in the
+    order they were sent among themselves. Messages added with mergeable=False (e.g. messages that trigger actions,
+    where every message counts) and bank select messages (CC0/CC32) are never replaced or overtaken, and stop earlier
+    values from being replaced.
+
+    The serializer does not write messages itself: if add returns False the message must be written now, queued
+    messages are returned by pop_due_messages once they can be written.
+    """
+
+    unmergeable_controls = (0, 32)  # Bank select MSB/LSB
+
+    def __init__(self, bytes_per_second=3125, congestion_threshold=0.003, utilization_window=1.0):
+        self.bytes_per_second = bytes_per_second
+        self.congestion_threshold = congestion_threshold
+        self.utilization_window = utilization_window
+        self.busy_until = 0.0  # Estimated time at which the link will have sent all bytes written
+        self.last_status = None  # For running status
+        self.channel_queues = collections.OrderedDict()  # channel (None for system messages) -> deque of [order, message bytes, merge key]
+        self.mergeable_entries = {}  # channel -> {merge key: queued entry which newer values can replace}
+        self.n_queued = 0
+        self.next_order = 0
+        self.recent_bytes = collections.deque()  # (time, n bytes) of the bytes written in the utilization window
+        self.recent_bytes_sum = 0
+        self.n_bytes_written = 0
+        self.n_messages_queued = 0
+        self.n_notes_prioritized = 0
+        self.n_controllers_replaced = 0
+        self.max_backlog = 0.0
+
+    def is_controller(self, status):
+        message_type = status & 0xF0
+        return message_type == CONTROL_CHANGE or message_type == POLYTOUCH or message_type == AFTERTOUCH or message_type == PITCHWHEEL
+
+    def account(self, message_bytes, now):
+        # Updates link estimates for a message that is written
+        if self.busy_until < now:
+            # Link is idle (assume interfaces only use running status for bytes sent back to back)
+            self.busy_until = now
+            self.last_status = None
+        n_bytes = len(message_bytes)
+        status = message_bytes[0]
+        if status < 0xF0:
+            if status == self.last_status:
+                n_bytes -= 1
+            self.last_status = status
+        elif status < 0xF8:
+            self.last_status = None  # System common messages cancel running status
+        self.busy_until += n_bytes / self.bytes_per_second
+        self.max_backlog = max(self.max_backlog, self.busy_until - now)
+        self.n_bytes_written += n_bytes
+        self.recent_bytes.append((now, n_bytes))
+        self.recent_bytes_sum += n_bytes
+
+    def is_congested(self, now):
+        return self.busy_until - now > self.congestion_threshold
+
+    def get_merge_key(self, message_bytes):
+        # Returns the key of the controller of a message whose queued value can be replaced by newer values, or None
+        status = message_bytes[0]
+        message_type = status & 0xF0
+        if message_type == CONTROL_CHANGE:
+            if message_bytes[1] in self.unmergeable_controls:
+                return None
+            return status, message_bytes[1]
+        elif message_type == POLYTOUCH:
+            return status, message_bytes[1]
+        elif message_type == AFTERTOUCH or message_type == PITCHWHEEL:
+            return status, None
+        return None
+
+    def add(self, message_bytes, now, mergeable=True):
+        # Returns True if the message was queued, False if it should be written now
+        if not self.n_queued and not self.is_congested(now):
+            self.account(message_bytes, now)
+            return False
+        status = message_bytes[0]
+        channel = status & 0x0F if status < 0xF0 else None
+        merge_key = self.get_merge_key(message_bytes) if mergeable else None
+        channel_mergeable_entries = self.mergeable_entries.setdefault(channel, {})
+        if merge_key is not None:
+            entry = channel_mergeable_entries.get(merge_key, None)
+            if entry is not None:
+                entry[1] = message_bytes
+                self.n_controllers_replaced += 1
+                return True
+        else:
+            # Messages queued before this one must be written before it
+            channel_mergeable_entries.clear()
+        entry = [self.next_order, message_bytes, merge_key]
+        self.next_order += 1
+        queue = self.channel_queues.get(channel, None)
+        if queue is None:
+            queue = collections.deque()
+            self.channel_queues[channel] = queue
+        queue.append(entry)
+        if merge_key is not None:
+            channel_mergeable_entries[merge_key] = entry
+        self.n_queued += 1
+        self.n_messages_queued += 1
+        return True
+
+    def get_next_entry_index(self, queue):
+        # Returns the index of the message of a channel queue to write next: the first note on/off if only mergeable
+        # CCs are queued before it, else the first message
+        for i, entry in enumerate(queue):
+            message_type = entry[1][0] & 0xF0
+            if message_type == NOTE_ON or message_type == NOTE_OFF:
+                return i
+            if entry[2] is None or message_type != CONTROL_CHANGE:
+                break
+        return 0
+
+    def pop_next_message(self):
+        # Returns the next queued message to write: the oldest message ready to go of a channel queue (see
+        # get_next_entry_index), preferring channels whose message is not a controller
+        next_channel = None
+        next_index = None
+        next_entry = None
+        next_is_controller = None
+        oldest_order = None
+        for channel, queue in self.channel_queues.items():
+            index = self.get_next_entry_index(queue)
+            entry = queue[index]
+            is_controller = self.is_controller(entry[1][0])
+            if oldest_order is None or queue[0][0] < oldest_order:
+                oldest_order = queue[0][0]
+            if next_entry is None or (next_is_controller and not is_controller) \
+                    or (is_controller == next_is_controller and entry[0] < next_entry[0]):
+                next_channel, next_index, next_entry, next_is_controller = channel, index, entry, is_controller
+        queue = self.channel_queues[next_channel]
+        del queue[next_index]
+        if not queue:
+            del self.channel_queues[next_channel]
+        if next_entry[2] is not None:
+            channel_mergeable_entries = self.mergeable_entries.get(next_channel, {})
+            if channel_mergeable_entries.get(next_entry[2], None) is next_entry:
+                del channel_mergeable_entries[next_entry[2]]
+        if next_entry[0] > oldest_order:
+            self.n_notes_prioritized += 1
+        self.n_queued -= 1
+        return next_entry[1]
+
+    def pop_due_messages(self, now):
+        # Returns queued messages that can be written now
+        messages = []
+        while self.n_queued and not self.is_congested(now):
+            message_bytes = self.pop_next_message()
+            self.account(message_bytes, now)
+            messages.append(message_bytes)
+        return messages
+
+    def pop_all_messages(self, now):
+        # Returns all queued messages, e.g. to write them before the MIDI out is closed
+        messages = []
+        while self.n_queued:
+            message_bytes = self.pop_next_message()
+            self.account(message_bytes, now)
+            messages.append(message_bytes)
+        return messages
+
+    def get_next_flush_time(self):
+        if not self.n_queued:
+            return None
+        return self.busy_until - self.congestion_threshold
+
+    def get_utilization(self, now):
+        # Fraction of the link bandwidth used during the last utilization_window seconds
+        while self.recent_bytes and self.recent_bytes[0][0] < now - self.utilization_window:
+            self.recent_bytes_sum -= self.recent_bytes.popleft()[1]
+        return self.recent_bytes_sum / (self.bytes_per_second * self.utilization_window)
+
+    def get_stats(self, now):
+        return {
+            'utilization': self.get_utilization(now),
+            'backlog_ms': max(0.0, self.busy_until - now) * 1000,
+            'max_backlog_ms': self.max_backlog * 1000,
+            'queued': self.n_queued,
+            'bytes_written': self.n_bytes_written,
+            'messages_queued': self.n_messages_queued,
+            'notes_prioritized': self.n_notes_prioritized,
+            'controllers_replaced': self.n_controllers_replaced,
+        }
+
+
+class MIDIOutputPool(object):
+    """Keeps MIDI output ports open by device name so they can be shared (e.g. by tracks routed to the same device)
+    and reused without paying the cost of opening them again. Outputs are opened lazily by get (using the
+    create_output function, which gets a device name and returns a MIDIOutput or raises IOError). If a device went
+    away, discard it and the next get will reopen it. Devices that could not be opened are not retried until
+    retry_interval seconds have passed, so sending to a missing device does not block. Can be used from several
+    threads.
+    """
+
+    def __init__(self, create_output, retry_interval=2.0):
+        self.create_output = create_output
+        self.retry_interval = retry_interval
+        self.lock = threading.RLock()
+        self.outputs = collections.OrderedDict()  # device name -> MIDIOutput
+        self.last_failed_open_time = {}  # device name -> time
+        self.discarded_names = set()
+        self.n_opened = 0
+        self.n_reopened = 0
+        self.n_reused = 0
+        self.n_failed_opens = 0
+
+    def get(self, device_name, retry_now=False):
+        # Returns the MIDIOutput for device_name, or None if it could not be opened. Use retry_now to try to open a
+        # device which failed recently (e.g. because it is known to be back).
+        with self.lock:
+            output = self.outputs.get(device_name, None)
+            if output is not None and not output.closed:
+                self.n_reused += 1
+                return output
+            now = time.monotonic()
+            last_failed_open_time = self.last_failed_open_time.get(device_name, None)
+            if not retry_now and last_failed_open_time is not None and now - last_failed_open_time < self.retry_interval:
+                return None
+            try:
+                output = self.create_output(device_name)
+            except (IOError, OSError) as e:
+                self.n_failed_opens += 1
+                self.last_failed_open_time[device_name] = now
+                print('Could not open MIDI output port "{0}": {1}'.format(device_name, e))
+                return None
+            self.last_failed_open_time.pop(device_name, None)
+            self.outputs[device_name] = output
+            if device_name in self.discarded_names:
+                self.discarded_names.remove(device_name)
+                self.n_reopened += 1
+            else:
+                self.n_opened += 1
+            return output
+
+    def get_open(self, device_name):
+        # Returns the MIDIOutput for device_name if it is open, never opens it
+        with self.lock:
+            output = self.outputs.get(device_name, None)
+            if output is not None and not output.closed:
+                self.n_reused += 1
+                return output
+            return None
+
+    def discard(self, device_name):
+        # Closes and forgets the output of a device that went away (it will be reopened on next get)
+        with self.lock:
+            output = self.outputs.pop(device_name, None)
+            if output is not None:
+                self.discarded_names.add(device_name)
+                try:
+                    output.close()
+                except Exception:
+                    pass
+
+    def get_outputs(self):
+        with self.lock:
+            return list(self.outputs.values())
+
+    def close_all(self):
+        with self.lock:
+            for output in self.outputs.values():
+                output.close()
+            self.outputs.clear()
+
+    def get_stats(self):
+        return {
+            'open': len(self.outputs),
+            'opened': self.n_opened,
+            'reopened': self.n_reopened,
+            'reused': self.n_reused,
+            'failed_opens': self.n_failed_opens,
+        }
@@ -0,0 +1,133 @@
+import threading
+import time
+import traceback
+
+import mido
+
+from stats_utils import RollingStats
+
+
+class MIDIPortWatcher(object):
+    """Thread that polls the lists of MIDI input and output port names every poll_interval seconds and calls
+    on_ports_changed(added_input_names, removed_input_names, added_output_names, removed_output_names) when they
+    change (e.g. a USB MIDI interface was unplugged or plugged back in). on_ports_changed is called from the watcher
+    thread so reconnecting devices never blocks the main loop or the display thread, and returns the names of the
+    devices it reconnected. Port names containing any of ignored_names (e.g. Push2 ports) are not watched.
+
+    Other threads can ask the watcher to reconnect devices right away with request_reconnect (e.g. after a write
+    error), then on_ports_changed gets all present ports as added. If the watcher thread is not running,
+    request_reconnect polls in the calling thread (at most every retry_interval seconds).
+
+    Reconnects are counted, and the time it took to reconnect (from the watcher noticing the ports changed until
+    on_ports_changed returns) and the time devices were offline (from the watcher noticing they went away until they
+    were reconnected) are measured.
+    """
+
+    def __init__(self, on_ports_changed, poll_interval=1.0, ignored_names=None, retry_interval=2.0):
+        self.on_ports_changed = on_ports_changed
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.ignored_names = ignored_names if ignored_names is not None else []
+        self.input_names = None  # Port names found in the last poll (None until first poll)
+        self.output_names = None
+        self.removed_times = {}  # device name -> (monotonic) time at which the watcher noticed it went away
+        self.stop_event = threading.Event()
+        self.reconnect_requested = threading.Event()
+        self.last_inline_poll_time = None
+        self.thread = None
+        self.n_polls = 0
+        self.n_changes = 0
+        self.n_reconnects = 0
+        self.last_reconnected_name = None
+        self.poll_times = RollingStats(window_size=60)
+        self.reconnect_times = RollingStats(window_size=60)
+        self.offline_times = RollingStats(window_size=60)
+
+    def get_port_names(self, get_names):
+        return set(name for name in get_names() if not any(ignored in name for ignored in self.ignored_names))
+
+    def poll(self, reconnect=False):
+        # Returns True if port lists changed since last poll (or reconnect is True)
+        poll_start_time = time.monotonic()
+        input_names = self.get_port_names(mido.get_input_names)
+        output_names = self.get_port_names(mido.get_output_names)
+        self.n_polls += 1
+        self.poll_times.add(time.monotonic() - poll_start_time)
+        if self.input_names is None:
+            # First poll, nothing to compare with
+            self.input_names, self.output_names = input_names, output_names
+        if input_names == self.input_names and output_names == self.output_names and not reconnect:
+            return False
+
+        added_input_names = input_names - self.input_names if not reconnect else set(input_names)
+        removed_input_names = self.input_names - input_names
+        added_output_names = output_names - self.output_names if not reconnect else set(output_names)
+        removed_output_names = self.output_names - output_names
+        if removed_input_names or removed_output_names or input_names != self.input_names or output_names != self.output_names:
+            self.n_changes += 1
+        self.input_names, self.output_names = input_names, output_names
+        now = time.monotonic()
+        for name in removed_input_names | removed_output_names:
+            self.removed_times.setdefault(name, now)
+
+        reconnected_names = self.on_ports_changed(added_input_names, removed_input_names, added_output_names, removed_output_names)
+        reconnect_time = time.monotonic() - now
+        for name in reconnected_names or []:
+            self.n_reconnects += 1
+            self.last_reconnected_name = name
+            self.reconnect_times.add(reconnect_time)
+            removed_time = self.removed_times.pop(name, None)
+            if removed_time is not None:
+                self.offline_times.add(now - removed_time)
+            print('Reconnected MIDI device "{0}" in {1:.1f} ms'.format(name, reconnect_time * 1000))
+        return True
+
+    def request_reconnect(self):
+        # Can be called from any thread
+        if self.thread is not None:
+            self.reconnect_requested.set()  # Wakes up the watcher thread
+            return
+        now = time.monotonic()
+        if self.last_inline_poll_time is not None and now - self.last_inline_poll_time < self.retry_interval:
+            return
+        self.last_inline_poll_time = now
+        self.poll(reconnect=True)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            reconnect = self.reconnect_requested.is_set()
+            self.reconnect_requested.clear()
+            try:
+                self.poll(reconnect=reconnect)
+            except Exception as e:
+                print('Error polling MIDI ports: {0}'.format(str(e)))
+                traceback.print_exc()
+            self.reconnect_requested.wait(self.poll_interval)
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='PyshaMIDIPortWatcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.reconnect_requested.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def get_stats(self):
+        # Times in milliseconds
+        poll_p50, = self.poll_times.get_percentiles((50, ))
+        reconnect_p50, reconnect_max = self.reconnect_times.get_percentiles((50, 100))
+        offline_p50, = self.offline_times.get_percentiles((50, ))
+        return {
+            'polls': self.n_polls,
+            'port_changes': self.n_changes,
+            'reconnects': self.n_reconnects,
+            'last_reconnected_device': self.last_reconnected_name,
+            'poll_p50_ms': poll_p50 * 1000 if poll_p50 is not None else None,
+            'reconnect_p50_ms': reconnect_p50 * 1000 if reconnect_p50 is not None else None,
+            'reconnect_max_ms': reconnect_max * 1000 if reconnect_max is not None else None,
+            'offline_p50_ms': offline_p50 * 1000 if offline_p50 is not None else None,
+        }
@@ -17,6 +17,7 @@ class PresetSelectionMode(definitions.PyshaMode):
     pad_pressing_states = {}
     pad_quick_press_time = 0.400
     current_page = 0
+    handled_button_names = {push2_python.constants.BUTTON_LEFT, push2_python.constants.BUTTON_RIGHT}
 
     def initialize(self, settings=None):
         if os.path.exists(self.favourtie_presets_filename):
@@ -118,7 +119,7 @@ class PresetSelectionMode(definitions.PyshaMode):
         # If synth only has 1 bank, don't send bank change messages
         if self.get_num_banks() > 1:
             msg = mido.Message('control_change', control=0, value=bank_num)  # Should this be 1-indexed?
-            self.app.send_midi(msg)
+            self.app.send_midi(msg, shape=False)
 
     def notify_status_in_display(self):
         bank_number = self.get_current_page() // 2 + 1
@@ -205,7 +206,7 @@ class PresetSelectionMode(definitions.PyshaMode):
         return True  # Prevent other modes to get this event
 
     def on_button_pressed(self, button_name):
-       if button_name in [push2_python.constants.BUTTON_LEFT, push2_python.constants.BUTTON_RIGHT]:
+       if button_name in self.handled_button_names:
             show_prev, show_next = self.has_prev_next_pages()
             if button_name == push2_python.constants.BUTTON_LEFT and show_prev:
                 self.prev_page()
@@ -6,6 +6,8 @@ import math
 import os
 import json
 
+from midi_output import CHANNEL_STATUS_BYTES
+
 
 class PyramidTrackState(object):
 
@@ -33,6 +35,7 @@ class PyramidTrackTriggeringMode(definitions.PyshaMode):
     ]
 
     pyramidi_channel = 15
+    pyramidi_status = CHANNEL_STATUS_BYTES[15]  # Status bytes for pyramidi_channel
     
     track_states = []
     
@@ -41,9 +44,11 @@ class PyramidTrackTriggeringMode(definitions.PyshaMode):
 
     track_selection_modifier_button_being_pressed = False
     track_selection_modifier_button = push2_python.constants.BUTTON_MASTER
+    scene_trigger_button_rows = {button_name: row for row, button_name in enumerate(scene_trigger_buttons)}
+    handled_button_names = set(scene_trigger_buttons + [track_selection_modifier_button])
 
     def initialize(self, settings=None):
-        self.pyramidi_channel = self.app.track_selection_mode.pyramidi_channel  # Note TrackSelectionMode needs to have been initialized before PyramidTrackTriggeringMode
+        self.set_pyramidi_channel(self.app.track_selection_mode.pyramidi_channel)  # Note TrackSelectionMode needs to have been initialized before PyramidTrackTriggeringMode
         self.create_tracks()
 
     def create_tracks(self):
@@ -73,19 +78,18 @@ class PyramidTrackTriggeringMode(definitions.PyshaMode):
             self.pyramidi_channel = 0 if not wrap else 15
         elif self.pyramidi_channel > 15:
             self.pyramidi_channel = 15 if not wrap else 0
+        self.pyramidi_status = CHANNEL_STATUS_BYTES[self.pyramidi_channel]
 
     def pad_ij_to_track_num(self, pad_ij):
         return pad_ij[0] * 8 + pad_ij[1]
 
     def send_mute_track_to_pyramid(self, track_num):
         # Follows pyramidi specification (Pyramid configured to receive on ch 16)
-        msg = mido.Message('control_change', control=track_num + 1, value=0)
-        self.app.send_midi(msg, force_channel=self.pyramidi_channel)
+        self.app.send_midi_raw(self.pyramidi_status.control_change, track_num + 1, 0, shape=False, output=self.app.midi_out)
 
     def send_unmute_track_to_pyramid(self, track_num):
         # Follows pyramidi specification (Pyramid configured to receive on ch 16)
-        msg = mido.Message('control_change', control=track_num + 1, value=1)
-        self.app.send_midi(msg, force_channel=self.pyramidi_channel)
+        self.app.send_midi_raw(self.pyramidi_status.control_change, track_num + 1, 1, shape=False, output=self.app.midi_out)
 
     def activate(self):
         self.pad_pressing_states = {}
@@ -132,20 +136,22 @@ class PyramidTrackTriggeringMode(definitions.PyshaMode):
         self.push.pads.set_pads_color(color_matrix)
 
     def on_button_pressed(self, button_name):
-        if button_name in self.scene_trigger_buttons:
-            triggered_scene_row = self.scene_trigger_buttons.index(button_name)
+        triggered_scene_row = self.scene_trigger_button_rows.get(button_name, None)
+        if triggered_scene_row is not None:
             # Unmute all tracks in that row, mute all tracks from other rows (only tracks that have content)
-            for i in range(0, 8):
-                for j in range(0, 8):
-                    track_num = self.pad_ij_to_track_num((i, j))
-                    # If track in selected row  
-                    # # TODO: check that indexing is correct
-                    if i == triggered_scene_row:
-                        if self.track_has_content(track_num):
-                            self.set_track_is_playing(track_num, True)
-                    else:
-                        if self.track_has_content(track_num):
-                            self.set_track_is_playing(track_num, False)
+            # All mute/unmute messages are written back to back once they have all been generated
+            with self.app.midi_batch(output=self.app.midi_out):
+                for i in range(0, 8):
+                    for j in range(0, 8):
+                        track_num = self.pad_ij_to_track_num((i, j))
+                        # If track in selected row  
+                        # # TODO: check that indexing is correct
+                        if i == triggered_scene_row:
+                            if self.track_has_content(track_num):
+                                self.set_track_is_playing(track_num, True)
+                        else:
+                            if self.track_has_content(track_num):
+                                self.set_track_is_playing(track_num, False)
             self.app.pads_need_update = True
 
             return True  # Prevent other modes to get this event
@@ -16,6 +16,7 @@ class RhythmicMode(MelodicMode):
         [40, 41, 42, 43, 72, 73, 74, 75],
         [36, 37, 38, 39, 68, 69, 70, 71]
     ]
+    handled_button_names = {push2_python.constants.BUTTON_ACCENT}
 
     def get_settings_to_save(self):
         return {}
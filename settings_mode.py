@@ -7,7 +7,7 @@ import psutil
 import threading
 import subprocess
 
-from display_utils import show_title, show_value, draw_text_at
+from display_widgets import WidgetLayout, Label, Curve, Bar
 
 
 class SettingsMode(definitions.PyshaMode):
@@ -25,19 +25,51 @@ class SettingsMode(definitions.PyshaMode):
     # - Midi channel OUT
     # - Pyramidi channel
     # - Rerun MIDI initial configuration
+    # - MIDI out link utilization
 
     # About panel
     # - definitions.VERSION info
     # - Save current settings
     #  - FPS
 
+    # Latency panel
+    # - Export latency stats
+    # - Reset latency stats
+    # - Latency percentiles per event type
+    # - Event queue and MIDI in queue depth and drops
+    # - MIDI port watcher reconnects and reconnect times
+
     current_page = 0
-    n_pages = 3
+    n_pages = 4
     encoders_state = {}
     is_running_sw_update = False
+    last_live_display_values = None
+    n_activations = 0
+    last_drawn_layout_key = None  # (page, n_activations) last drawn by the display thread
+    retains_display_layer = True
+    handled_button_names = {
+        push2_python.constants.BUTTON_UPPER_ROW_1,
+        push2_python.constants.BUTTON_UPPER_ROW_2,
+        push2_python.constants.BUTTON_UPPER_ROW_3,
+        push2_python.constants.BUTTON_UPPER_ROW_4,
+        push2_python.constants.BUTTON_UPPER_ROW_5,
+        push2_python.constants.BUTTON_UPPER_ROW_6,
+    }
+    page_layouts = []
+    page_titles = []
+    page_values = []
+    latency_event_types = [  # (event type, title) for columns 3 to 8 of the latency page
+        ('on_pad_pressed', 'PAD ON'),
+        ('on_pad_released', 'PAD OFF'),
+        ('on_pad_aftertouch', 'PAD AT'),
+        ('on_encoder_rotated', 'ENCODER'),
+        ('on_button_pressed', 'BUTTON'),
+        ('midi_in', 'MIDI IN'),
+    ]
 
     def move_to_next_page(self):
         self.app.buttons_need_update = True
+        self.invalidate_display()
         self.current_page += 1
         if self.current_page >= self.n_pages:
             self.current_page = 0
@@ -50,9 +82,12 @@ class SettingsMode(definitions.PyshaMode):
             self.encoders_state[encoder_name] = {
                 'last_message_received': current_time,
             }
+        self.create_widgets()
 
     def activate(self):
         self.current_page = 0
+        self.n_activations += 1  # Page layout is fully redrawn when the mode is activated again
+        self.invalidate_display()
         self.update_buttons()
 
     def deactivate(self):
@@ -65,11 +100,43 @@ class SettingsMode(definitions.PyshaMode):
             if current_time - self.encoders_state[push2_python.constants.ENCODER_TRACK1_ENCODER]['last_message_received'] > definitions.DELAYED_ACTIONS_APPLY_TIME:
                 self.app.set_midi_in_device_by_index(self.app.midi_in_tmp_device_idx)
                 self.app.midi_in_tmp_device_idx = None
+                self.invalidate_display()
         if self.app.midi_out_tmp_device_idx is not None:
             # Means we are in the process of changing the MIDI in device
             if current_time - self.encoders_state[push2_python.constants.ENCODER_TRACK3_ENCODER]['last_message_received'] > definitions.DELAYED_ACTIONS_APPLY_TIME:
                 self.app.set_midi_out_device_by_index(self.app.midi_out_tmp_device_idx)
                 self.app.midi_out_tmp_device_idx = None
+                self.invalidate_display()
+
+        # Some of the values shown in the display change without interacting with the settings mode (e.g. latest
+        # aftertouch values, octave changes in melodic mode or FPS), only redraw the display layer if these changed
+        live_display_values = self.get_live_display_values(current_time)
+        if live_display_values != self.last_live_display_values:
+            self.last_live_display_values = live_display_values
+            self.invalidate_display()
+
+    def get_live_display_values(self, current_time):
+        if self.current_page == 0:  # Performance settings
+            melodic_mode = self.app.melodic_mode
+            return (
+                self.app.is_mode_active(melodic_mode), melodic_mode.root_midi_note, melodic_mode.use_poly_at,
+                melodic_mode.channel_at_range_start, melodic_mode.channel_at_range_end, melodic_mode.poly_at_max_range,
+                melodic_mode.poly_at_curve_bending, melodic_mode.last_time_at_params_edited is not None,
+                current_time - melodic_mode.latest_channel_at_value[0] < 3, melodic_mode.latest_channel_at_value[1],
+                current_time - melodic_mode.latest_poly_at_value[0] < 3, melodic_mode.latest_poly_at_value[1],
+                current_time - melodic_mode.latest_velocity_value[0] < 3, melodic_mode.latest_velocity_value[1],
+            )
+        elif self.current_page == 1:  # MIDI settings
+            return (
+                self.app.midi_in.name if self.app.midi_in is not None else None, self.app.midi_in_channel,
+                self.app.midi_out.name if self.app.midi_out is not None else None, self.app.midi_out_channel,
+                self.app.track_selection_mode.pyramidi_channel, self.get_midi_out_link_utilization_percentage(),
+            )
+        elif self.current_page == 2:  # About
+            return self.app.actual_frame_rate, self.app.display_timing_stats
+        elif self.current_page == 3:  # Latency (refreshed once per second)
+            return int(current_time)
+        return None
 
     def set_all_upper_row_buttons_off(self):
         self.push.buttons.set_button_color(push2_python.constants.BUTTON_UPPER_ROW_1, definitions.OFF_BTN_COLOR)
@@ -113,164 +180,291 @@ class SettingsMode(definitions.PyshaMode):
             self.push.buttons.set_button_color(push2_python.constants.BUTTON_UPPER_ROW_6, definitions.OFF_BTN_COLOR)
             self.push.buttons.set_button_color(push2_python.constants.BUTTON_UPPER_ROW_7, definitions.OFF_BTN_COLOR)
             self.push.buttons.set_button_color(push2_python.constants.BUTTON_UPPER_ROW_8, definitions.OFF_BTN_COLOR)
+
+        elif self.current_page == 3:  # Latency
+            self.push.buttons.set_button_color(push2_python.constants.BUTTON_UPPER_ROW_1, definitions.GREEN)
+            self.push.buttons.set_button_color(push2_python.constants.BUTTON_UPPER_ROW_2, definitions.WHITE)
+            self.push.buttons.set_button_color(push2_python.constants.BUTTON_UPPER_ROW_3, definitions.OFF_BTN_COLOR)
+            self.push.buttons.set_button_color(push2_python.constants.BUTTON_UPPER_ROW_4, definitions.OFF_BTN_COLOR)
+            self.push.buttons.set_button_color(push2_python.constants.BUTTON_UPPER_ROW_5, definitions.OFF_BTN_COLOR)
+            self.push.buttons.set_button_color(push2_python.constants.BUTTON_UPPER_ROW_6, definitions.OFF_BTN_COLOR)
+            self.push.buttons.set_button_color(push2_python.constants.BUTTON_UPPER_ROW_7, definitions.OFF_BTN_COLOR)
+            self.push.buttons.set_button_color(push2_python.constants.BUTTON_UPPER_ROW_8, definitions.OFF_BTN_COLOR)
         
-    def update_display(self, ctx, w, h):
-
-        # Divide display in 8 parts to show different settings
-        part_w = w // 8
-        part_h = h
-
-        # Draw labels and values
-        for i in range(0, 8):
-            part_x = i * part_w
-            part_y = 0
-
-            ctx.set_source_rgb(0, 0, 0)  # Draw black background
-            ctx.rectangle(part_x - 3, part_y, w, h)  # do x -3 to add some margin between parts
-            ctx.fill()
-
-            color = [1.0, 1.0, 1.0]
-
-            if self.current_page == 0:  # Performance settings
-                if i == 0:  # Root note
-                    if not self.app.is_mode_active(self.app.melodic_mode):
-                        color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DISABLED)
-                    show_title(ctx, part_x, h, 'ROOT NOTE')
-                    show_value(ctx, part_x, h, "{0} ({1})".format(self.app.melodic_mode.note_number_to_name(
-                        self.app.melodic_mode.root_midi_note), self.app.melodic_mode.root_midi_note), color)
-
-                elif i == 1:  # Poly AT/channel AT
-                    show_title(ctx, part_x, h, 'AFTERTOUCH')
-                    show_value(ctx, part_x, h, 'polyAT' if self.app.melodic_mode.use_poly_at else 'channel', color)
-
-                elif i == 2:  # Channel AT range start
-                    if self.app.melodic_mode.last_time_at_params_edited is not None:
-                        color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DELAYED_ACTIONS)
-                    show_title(ctx, part_x, h, 'cAT START')
-                    show_value(ctx, part_x, h, self.app.melodic_mode.channel_at_range_start, color)
-
-                elif i == 3:  # Channel AT range end
-                    if self.app.melodic_mode.last_time_at_params_edited is not None:
-                        color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DELAYED_ACTIONS)
-                    show_title(ctx, part_x, h, 'cAT END')
-                    show_value(ctx, part_x, h, self.app.melodic_mode.channel_at_range_end, color)
-
-                elif i == 4:  # Poly AT range
-                    if self.app.melodic_mode.last_time_at_params_edited is not None:
-                        color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DELAYED_ACTIONS)
-                    show_title(ctx, part_x, h, 'pAT RANGE')
-                    show_value(ctx, part_x, h, self.app.melodic_mode.poly_at_max_range, color)
-
-                elif i == 5:  # Poly AT curve
-                    if self.app.melodic_mode.last_time_at_params_edited is not None:
-                        color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DELAYED_ACTIONS)
-                    show_title(ctx, part_x, h, 'pAT CURVE')
-                    show_value(ctx, part_x, h, self.app.melodic_mode.poly_at_curve_bending, color)
-
-            elif self.current_page == 1:  # MIDI settings
-                if i == 0:  # MIDI in device
-                    if self.app.midi_in_tmp_device_idx is not None:
-                        color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DELAYED_ACTIONS)
-                        if self.app.midi_in_tmp_device_idx < 0:
-                            name = "None"
-                        else:
-                            name = "{0} {1}".format(self.app.midi_in_tmp_device_idx + 1, self.app.available_midi_in_device_names[self.app.midi_in_tmp_device_idx])
-                    else:
-                        if self.app.midi_in is not None:
-                            name = "{0} {1}".format(self.app.available_midi_in_device_names.index(self.app.midi_in.name) + 1, self.app.midi_in.name)
-                        else:
-                            color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DISABLED)
-                            name = "None"
-                    show_title(ctx, part_x, h, 'IN DEVICE')
-                    show_value(ctx, part_x, h, name, color)
-
-                elif i == 1:  # MIDI in channel
-                    if self.app.midi_in is None:
-                        color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DISABLED)
-                    show_title(ctx, part_x, h, 'IN CH')
-                    show_value(ctx, part_x, h, self.app.midi_in_channel + 1 if self.app.midi_in_channel > -1 else "All", color)
-
-                elif i == 2:  # MIDI out device
-                    if self.app.midi_out_tmp_device_idx is not None:
-                        color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DELAYED_ACTIONS)
-                        if self.app.midi_out_tmp_device_idx < 0:
-                            name = "None"
-                        else:
-                            name = "{0} {1}".format(self.app.midi_out_tmp_device_idx + 1, self.app.available_midi_out_device_names[self.app.midi_out_tmp_device_idx])
-                    else:
-                        if self.app.midi_out is not None:
-                            name = "{0} {1}".format(self.app.available_midi_out_device_names.index(self.app.midi_out.name) + 1, self.app.midi_out.name)
-                        else:
-                            color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DISABLED)
-                            name = "None"
-                    show_title(ctx, part_x, h, 'OUT DEVICE')
-                    show_value(ctx, part_x, h, name, color)
-
-                elif i == 3:  # MIDI out channel
-                    if self.app.midi_out is None:
-                        color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DISABLED)
-                    show_title(ctx, part_x, h, 'OUT CH')
-                    show_value(ctx, part_x, h, self.app.midi_out_channel + 1, color)
-
-                elif i == 4:  # Pyramidi out channel
-                    show_title(ctx, part_x, h, 'PYRAMIDI CH')
-                    show_value(ctx, part_x, h, self.app.track_selection_mode.pyramidi_channel + 1, color)
-                
-                elif i == 5:  # Re-send MIDI connection established (to push, not MIDI in/out device)
-                    show_title(ctx, part_x, h, 'RESET MIDI')
+    def create_widgets(self):
+        # One layout per page. Settings pages cover the whole display, so layouts have an opaque black background
+        self.page_layouts = []
+        self.page_titles = []
+        self.page_values = []
+        for page in range(0, self.n_pages):
+            layout = WidgetLayout(background_color=definitions.BLACK)
+            self.page_layouts.append(layout)
+            self.page_titles.append([layout.add_title(i) for i in range(0, 8)])
+            self.page_values.append([layout.add_value(i) for i in range(0, 8)])
+
+        # Performance settings page
+        layout = self.page_layouts[0]
+        self.poly_at_curve = layout.add(Curve(*layout.column_rect(4, layout.h - 62, 54, n_columns=4)))
+        self.latest_velocity_label = layout.add(Label(*layout.column_rect(0, layout.h - 44, 22, n_columns=4), font_size=20, text_y=18))
+        self.latest_at_label = layout.add(Label(*layout.column_rect(0, layout.h - 21, 21, n_columns=4), font_size=20, text_y=18))
+
+        # About page (frame timing stats below FPS value)
+        layout = self.page_layouts[2]
+        self.frame_stats_labels = [layout.add(Label(*layout.column_rect(3, 53 + 15 * i, 15), font_size=12, text_y=12)) for i in range(0, 5)]
+        self.frame_rate_bar = layout.add(Bar(*layout.column_rect(3, 132, 6)))
+
+        # Latency page (percentiles below the p95 value of each event type)
+        layout = self.page_layouts[3]
+        self.latency_stats_labels = [[layout.add(Label(*layout.column_rect(2 + i, 58 + 15 * j, 15), font_size=12, text_y=12)) for j in range(0, 4)]
+                                     for i in range(0, len(self.latency_event_types))]
+        # Event queue and MIDI in queue stats below the export/reset buttons
+        self.queue_stats_labels = [[layout.add(Label(*layout.column_rect(i, 58 + 15 * j, 15), font_size=12, text_y=12)) for j in range(0, 4)]
+                                   for i in range(0, 2)]
+        # MIDI port watcher stats at the bottom
+        self.port_watcher_stats_label = layout.add(Label(*layout.column_rect(0, 133, 15, n_columns=8), font_size=12, text_y=12))
+
+    def get_midi_out_link_utilization_percentage(self):
+        utilization = self.app.get_midi_out_link_utilization()
+        return int(round(utilization * 100)) if utilization is not None else None
+
+    def get_latency_summary(self, event_type):
+        # Returns the stage used to show latency of event_type (MIDI out if the event sent MIDI, else end of dispatch)
+        # and the histogram for that stage
+        for stage in ('midi_out', 'dispatched'):
+            histogram = self.app.latency_stats.get(event_type, stage)
+            if histogram is not None and histogram.count:
+                return stage, histogram
+        return None, None
+
+    def get_display_state(self):
+        # Returns (layout key, parts, page extras), layout key changes when the page layout needs a full redraw
+
+        # Get title, value and value color for each of the 8 parts of the display
+        white = [1.0, 1.0, 1.0]
+        parts = [['', '', white] for _ in range(0, 8)]
 
-            elif self.current_page == 2:  # About
-                if i == 0:  # Save button
-                    show_title(ctx, part_x, h, 'SAVE')
+        if self.current_page == 0:  # Performance settings
+            melodic_mode = self.app.melodic_mode
+            delayed_actions_color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DELAYED_ACTIONS) if melodic_mode.last_time_at_params_edited is not None else white
 
-                elif i ==1: # definitions.VERSION info
-                    show_title(ctx, part_x, h, 'VERSION')
-                    show_value(ctx, part_x, h, 'Pysha ' + definitions.VERSION, color)
+            # Root note
+            color = white if self.app.is_mode_active(melodic_mode) else definitions.get_color_rgb_float(definitions.FONT_COLOR_DISABLED)
+            parts[0] = ['ROOT NOTE', "{0} ({1})".format(melodic_mode.note_number_to_name(melodic_mode.root_midi_note), melodic_mode.root_midi_note), color]
 
-                elif i == 2:  # Software update
-                    show_title(ctx, part_x, h, 'SW UPDATE')
-                    if self.is_running_sw_update:
-                        show_value(ctx, part_x, h, 'Running... ', color)
-                
-                elif i == 3:  # FPS indicator
-                    show_title(ctx, part_x, h, 'FPS')
-                    show_value(ctx, part_x, h, self.app.actual_frame_rate, color)
+            # Poly AT/channel AT
+            parts[1] = ['AFTERTOUCH', 'polyAT' if melodic_mode.use_poly_at else 'channel', white]
+
+            # Channel AT range start, channel AT range end, poly AT range and poly AT curve
+            parts[2] = ['cAT START', melodic_mode.channel_at_range_start, delayed_actions_color]
+            parts[3] = ['cAT END', melodic_mode.channel_at_range_end, delayed_actions_color]
+            parts[4] = ['pAT RANGE', melodic_mode.poly_at_max_range, delayed_actions_color]
+            parts[5] = ['pAT CURVE', melodic_mode.poly_at_curve_bending, delayed_actions_color]
+
+        elif self.current_page == 1:  # MIDI settings
 
-        # After drawing all labels and values, draw other stuff if required
+            # MIDI in device
+            color = white
+            if self.app.midi_in_tmp_device_idx is not None:
+                color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DELAYED_ACTIONS)
+                if self.app.midi_in_tmp_device_idx < 0:
+                    name = "None"
+                else:
+                    device_names = self.app.available_midi_in_device_names  # List can be updated by the MIDI port watcher
+                    device_idx = min(self.app.midi_in_tmp_device_idx, len(device_names) - 1)
+                    name = "{0} {1}".format(device_idx + 1, device_names[device_idx]) if device_idx >= 0 else "None"
+            else:
+                if self.app.midi_in is not None:
+                    device_idx = self.app.get_midi_in_device_idx()
+                    name = "{0} {1}".format(device_idx + 1, self.app.midi_in.name) if device_idx >= 0 else self.app.midi_in.name
+                else:
+                    color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DISABLED)
+                    name = "None"
+            parts[0] = ['IN DEVICE', name, color]
+
+            # MIDI in channel
+            color = white if self.app.midi_in is not None else definitions.get_color_rgb_float(definitions.FONT_COLOR_DISABLED)
+            parts[1] = ['IN CH', self.app.midi_in_channel + 1 if self.app.midi_in_channel > -1 else "All", color]
+
+            # MIDI out device
+            color = white
+            if self.app.midi_out_tmp_device_idx is not None:
+                color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DELAYED_ACTIONS)
+                if self.app.midi_out_tmp_device_idx < 0:
+                    name = "None"
+                else:
+                    device_names = self.app.available_midi_out_device_names
+                    device_idx = min(self.app.midi_out_tmp_device_idx, len(device_names) - 1)
+                    name = "{0} {1}".format(device_idx + 1, device_names[device_idx]) if device_idx >= 0 else "None"
+            else:
+                if self.app.midi_out is not None:
+                    device_idx = self.app.get_midi_out_device_idx()
+                    name = "{0} {1}".format(device_idx + 1, self.app.midi_out.name) if device_idx >= 0 else self.app.midi_out.name
+                else:
+                    color = definitions.get_color_rgb_float(definitions.FONT_COLOR_DISABLED)
+                    name = "None"
+            parts[2] = ['OUT DEVICE', name, color]
+
+            # MIDI out channel
+            color = white if self.app.midi_out is not None else definitions.get_color_rgb_float(definitions.FONT_COLOR_DISABLED)
+            parts[3] = ['OUT CH', self.app.midi_out_channel + 1, color]
+
+            # Pyramidi out channel
+            parts[4] = ['PYRAMIDI CH', self.app.track_selection_mode.pyramidi_channel + 1, white]
+
+            # Re-send MIDI connection established (to push, not MIDI in/out device)
+            parts[5] = ['RESET MIDI', '', white]
+
+            # MIDI out link utilization (estimated by the output serializer)
+            utilization = self.get_midi_out_link_utilization_percentage()
+            if utilization is not None:
+                color = white if utilization < 80 else definitions.get_color_rgb_float(definitions.RED)
+                parts[6] = ['OUT LOAD', '{0}%'.format(utilization), color]
+            else:
+                parts[6] = ['OUT LOAD', '-', definitions.get_color_rgb_float(definitions.FONT_COLOR_DISABLED)]
+
+        elif self.current_page == 2:  # About
+            parts[0] = ['SAVE', '', white]
+            parts[1] = ['VERSION', 'Pysha ' + definitions.VERSION, white]
+            parts[2] = ['SW UPDATE', 'Running... ' if self.is_running_sw_update else '', white]
+            parts[3] = ['FPS', self.app.actual_frame_rate, white]
+
+        elif self.current_page == 3:  # Latency
+            parts[0] = ['EXPORT', '', white]
+            parts[1] = ['RESET', '', white]
+            for i, (event_type, title) in enumerate(self.latency_event_types):
+                stage, histogram = self.get_latency_summary(event_type)
+                value = '{0:.1f}ms'.format(histogram.get_percentiles((95, ))[0] * 1000) if histogram is not None else '-'
+                parts[2 + i] = [title, value, white]
+
+        parts = tuple((title, str(value), tuple(color)) for title, value, color in parts)
+
+        # Other stuff shown in some pages
+        extras = None
         if self.current_page == 0:  # Performance settings
 
-            # Draw polyAT velocity curve
-            ctx.set_source_rgb(0.6, 0.6, 0.6)
-            ctx.set_line_width(1)
-            data = self.app.melodic_mode.get_poly_at_curve()
-            n = len(data)
-            curve_x = 4 * part_w + 3  # Start x point of curve
-            curve_y = part_h - 10  # Start y point of curve
-            curve_height = 50
-            curve_length = part_w * 4 - 6
-            ctx.move_to(curve_x, curve_y)
-            for i, value in enumerate(data):
-                x = curve_x + i * curve_length/n
-                y = curve_y - curve_height * value/127
-                ctx.line_to(x, y)
-            ctx.line_to(x, curve_y)
-            ctx.fill()
+            # PolyAT velocity curve
+            poly_at_curve = tuple(self.app.melodic_mode.get_poly_at_curve())
 
+            # Lastest AT and velocity values if received less than 3 seconds ago
+            melodic_mode = self.app.melodic_mode
             current_time = time.time()
-            if current_time - self.app.melodic_mode.latest_channel_at_value[0] < 3 and not self.app.melodic_mode.use_poly_at:
-                # Lastest channel AT value received less than 3 seconds ago
-                draw_text_at(ctx, 3, part_h - 3, f'Latest cAT: {self.app.melodic_mode.latest_channel_at_value[1]}', font_size=20)
-            if current_time - self.app.melodic_mode.latest_poly_at_value[0] < 3 and self.app.melodic_mode.use_poly_at:
-                # Lastest channel AT value received less than 3 seconds ago
-                draw_text_at(ctx, 3, part_h - 3, f'Latest pAT: {self.app.melodic_mode.latest_poly_at_value[1]}', font_size=20)
-            if current_time - self.app.melodic_mode.latest_velocity_value[0] < 3:
-                # Lastest note on velocity value received less than 3 seconds ago
-                draw_text_at(ctx, 3, part_h - 26, f'Latest velocity: {self.app.melodic_mode.latest_velocity_value[1]}', font_size=20)
+            latest_at_text = ''
+            if current_time - melodic_mode.latest_channel_at_value[0] < 3 and not melodic_mode.use_poly_at:
+                latest_at_text = f'Latest cAT: {melodic_mode.latest_channel_at_value[1]}'
+            if current_time - melodic_mode.latest_poly_at_value[0] < 3 and melodic_mode.use_poly_at:
+                latest_at_text = f'Latest pAT: {melodic_mode.latest_poly_at_value[1]}'
+            latest_velocity_text = ''
+            if current_time - melodic_mode.latest_velocity_value[0] < 3:
+                latest_velocity_text = f'Latest velocity: {melodic_mode.latest_velocity_value[1]}'
+            extras = (poly_at_curve, latest_at_text, latest_velocity_text)
 
+        elif self.current_page == 2:  # About
+
+            # Frame timing stats
+            stats = self.app.display_timing_stats
+            lines = ('', ) * len(self.frame_stats_labels)
+            if stats:
+                format_ms = lambda value: '{0:.1f}'.format(value) if value is not None else '-'
+                lines = (
+                    'p50 {0} ms'.format(format_ms(stats['frame_time_p50_ms'])),
+                    'p95 {0} ms'.format(format_ms(stats['frame_time_p95_ms'])),
+                    'p99 {0} ms'.format(format_ms(stats['frame_time_p99_ms'])),
+                    'jitter p95 {0} ms'.format(format_ms(stats['lateness_p95_ms'])),
+                    'missed {0}'.format(stats['missed_deadlines']),
+                )
+            target_frame_rate = stats.get('target_frame_rate', self.app.target_frame_rate) if stats else self.app.target_frame_rate
+            extras = (lines, self.app.actual_frame_rate / target_frame_rate if target_frame_rate else 0.0)
+
+        elif self.current_page == 3:  # Latency
+
+            # Value shows p95, lines below show other percentiles, number of events and the measured stage
+            extras = []
+            for event_type, _ in self.latency_event_types:
+                stage, histogram = self.get_latency_summary(event_type)
+                lines = ('', '', '', '')
+                if histogram is not None:
+                    p50, p99 = histogram.get_percentiles((50, 99))
+                    lines = (
+                        'p50 {0:.1f} ms'.format(p50 * 1000),
+                        'p99 {0:.1f} ms'.format(p99 * 1000),
+                        'n {0}'.format(histogram.count),
+                        'to MIDI out' if stage == 'midi_out' else 'to dispatch',
+                    )
+                extras.append(lines)
+
+            # Depth (current/max) and drops of the event queue (fast/ui lanes) and of the MIDI in queue
+            event_queue_stats = self.app.event_queue.get_stats()
+            midi_in_stats = self.app.get_midi_in_stats()
+            queue_lines = (
+                (
+                    'events q {0}/{1}'.format(event_queue_stats['fast_lane_depth'], event_queue_stats['ui_lane_depth']),
+                    'max {0}/{1}'.format(event_queue_stats['fast_lane_max_depth'], event_queue_stats['ui_lane_max_depth']),
+                    'dropped {0}'.format(sum(event_queue_stats['events_dropped'].values())),
+                    'handled {0}'.format(event_queue_stats['events_handled']),
+                ), (
+                    'MIDI in q {0}'.format(midi_in_stats['queue_depth']),
+                    'max {0}'.format(midi_in_stats['queue_max_depth']),
+                    'dropped {0}'.format(midi_in_stats['messages_dropped'] + midi_in_stats['mode_messages_dropped']),
+                    'received {0}'.format(midi_in_stats['messages_received']),
+                )
+            )
+
+            # Device reconnects done by the MIDI port watcher, and how long they took
+            port_watcher_line = ''
+            if self.app.midi_port_watcher is not None:
+                watcher_stats = self.app.midi_port_watcher.get_stats()
+                format_ms = lambda value: '{0:.1f}'.format(value) if value is not None else '-'
+                port_watcher_line = 'MIDI ports: {0} changes, {1} reconnects{2}, reconnect p50/max {3}/{4} ms, offline p50 {5} ms, poll p50 {6} ms'.format(
+                    watcher_stats['port_changes'], watcher_stats['reconnects'],
+                    ' (last {0})'.format(watcher_stats['last_reconnected_device']) if watcher_stats['last_reconnected_device'] is not None else '',
+                    format_ms(watcher_stats['reconnect_p50_ms']), format_ms(watcher_stats['reconnect_max_ms']),
+                    format_ms(watcher_stats['offline_p50_ms']), format_ms(watcher_stats['poll_p50_ms']))
+            extras = (tuple(extras), queue_lines, port_watcher_line)
+
+        return (self.current_page, self.n_activations), parts, extras
+
+    def update_display(self, ctx, w, h, state):
+        (page, n_activations), parts, extras = state
+        layout = self.page_layouts[page]
+        if (page, n_activations) != self.last_drawn_layout_key:
+            self.last_drawn_layout_key = (page, n_activations)
+            layout.invalidate_all()
+
+        for i, (title, value, color) in enumerate(parts):
+            self.page_titles[page][i].set(text=title)
+            self.page_values[page][i].set(text=value, font_color=color)
+
+        if page == 0:  # Performance settings
+            poly_at_curve, latest_at_text, latest_velocity_text = extras
+            self.poly_at_curve.set(data=poly_at_curve)
+            self.latest_at_label.set(text=latest_at_text)
+            self.latest_velocity_label.set(text=latest_velocity_text)
+
+        elif page == 2:  # About
+            lines, frame_rate_fraction = extras
+            for label, line in zip(self.frame_stats_labels, lines):
+                label.set(text=line)
+            self.frame_rate_bar.set(value_fraction=frame_rate_fraction)
+
+        elif page == 3:  # Latency
+            latency_lines, queue_lines, port_watcher_line = extras
+            for lines, labels in zip(latency_lines + queue_lines, self.latency_stats_labels + self.queue_stats_labels):
+                for label, line in zip(labels, lines):
+                    label.set(text=line)
+            self.port_watcher_stats_label.set(text=port_watcher_line)
+
+        layout.render(ctx)
+
+    def get_uncoalesced_encoder_names(self):
+        if self.current_page == 0:
+            # Poly/channel aftertouch toggle only responds to single "big" increments
+            return (push2_python.constants.ENCODER_TRACK2_ENCODER, )
+        return ()
 
     def on_encoder_rotated(self, encoder_name, increment):
 
         self.encoders_state[encoder_name]['last_message_received'] = time.time()
+        self.invalidate_display()
 
         if self.current_page == 0:  # Performance settings
             if encoder_name == push2_python.constants.ENCODER_TRACK1_ENCODER:
@@ -302,10 +496,7 @@ class SettingsMode(definitions.PyshaMode):
         elif self.current_page == 1:  # MIDI settings
             if encoder_name == push2_python.constants.ENCODER_TRACK1_ENCODER:
                 if self.app.midi_in_tmp_device_idx is None:
-                    if self.app.midi_in is not None:
-                        self.app.midi_in_tmp_device_idx = self.app.available_midi_in_device_names.index(self.app.midi_in.name)
-                    else:
-                        self.app.midi_in_tmp_device_idx = -1
+                    self.app.midi_in_tmp_device_idx = self.app.get_midi_in_device_idx()
                 self.app.midi_in_tmp_device_idx += increment
                 if self.app.midi_in_tmp_device_idx >= len(self.app.available_midi_in_device_names):
                     self.app.midi_in_tmp_device_idx = len(self.app.available_midi_in_device_names) - 1
@@ -317,10 +508,7 @@ class SettingsMode(definitions.PyshaMode):
 
             elif encoder_name == push2_python.constants.ENCODER_TRACK3_ENCODER:
                 if self.app.midi_out_tmp_device_idx is None:
-                    if self.app.midi_out is not None:
-                        self.app.midi_out_tmp_device_idx = self.app.available_midi_out_device_names.index(self.app.midi_out.name)
-                    else:
-                        self.app.midi_out_tmp_device_idx = -1
+                    self.app.midi_out_tmp_device_idx = self.app.get_midi_out_device_idx()
                 self.app.midi_out_tmp_device_idx += increment
                 if self.app.midi_out_tmp_device_idx >= len(self.app.available_midi_out_device_names):
                     self.app.midi_out_tmp_device_idx = len(self.app.available_midi_out_device_names) - 1
@@ -333,13 +521,15 @@ class SettingsMode(definitions.PyshaMode):
             elif encoder_name == push2_python.constants.ENCODER_TRACK5_ENCODER:
                 self.app.track_selection_mode.set_pyramidi_channel(self.app.track_selection_mode.pyramidi_channel + increment, wrap=False)
 
-        elif self.current_page == 2:  # About
+        elif self.current_page in (2, 3):  # About, Latency
             pass
 
         return True  # Always return True because encoder should not be used in any other mode if this is first active
 
     def on_button_pressed(self, button_name):
 
+        self.invalidate_display()
+
         if self.current_page == 0:  # Performance settings
             if button_name == push2_python.constants.BUTTON_UPPER_ROW_1:
                 self.app.melodic_mode.set_root_midi_note(self.app.melodic_mode.root_midi_note + 1)
@@ -357,10 +547,7 @@ class SettingsMode(definitions.PyshaMode):
         elif self.current_page == 1:  # MIDI settings
             if button_name == push2_python.constants.BUTTON_UPPER_ROW_1:
                 if self.app.midi_in_tmp_device_idx is None:
-                    if self.app.midi_in is not None:
-                        self.app.midi_in_tmp_device_idx = self.app.available_midi_in_device_names.index(self.app.midi_in.name)
-                    else:
-                        self.app.midi_in_tmp_device_idx = -1
+                    self.app.midi_in_tmp_device_idx = self.app.get_midi_in_device_idx()
                 self.app.midi_in_tmp_device_idx += 1
                 # Make index position wrap
                 if self.app.midi_in_tmp_device_idx >= len(self.app.available_midi_in_device_names):
@@ -375,10 +562,7 @@ class SettingsMode(definitions.PyshaMode):
 
             elif button_name == push2_python.constants.BUTTON_UPPER_ROW_3:
                 if self.app.midi_out_tmp_device_idx is None:
-                    if self.app.midi_out is not None:
-                        self.app.midi_out_tmp_device_idx = self.app.available_midi_out_device_names.index(self.app.midi_out.name)
-                    else:
-                        self.app.midi_out_tmp_device_idx = -1
+                    self.app.midi_out_tmp_device_idx = self.app.get_midi_out_device_idx()
                 self.app.midi_out_tmp_device_idx += 1
                 # Make index position wrap
                 if self.app.midi_out_tmp_device_idx >= len(self.app.available_midi_out_device_names):
@@ -412,6 +596,22 @@ class SettingsMode(definitions.PyshaMode):
                 run_sw_update()
                 return True
 
+        elif self.current_page == 3:  # Latency
+            if button_name == push2_python.constants.BUTTON_UPPER_ROW_1:
+                # Export latency stats
+                try:
+                    self.app.latency_stats.export(definitions.LATENCY_STATS_EXPORT_PATH)
+                    self.app.add_display_notification("Latency stats exported to {0}".format(definitions.LATENCY_STATS_EXPORT_PATH))
+                except Exception as e:
+                    print('Error exporting latency stats: {0}'.format(e))
+                    self.app.add_display_notification("Error exporting latency stats")
+                return True
+
+            elif button_name == push2_python.constants.BUTTON_UPPER_ROW_2:
+                # Reset latency stats
+                self.app.latency_stats.clear()
+                return True
+
 
 def restart_program():
     """Restarts the current program, with file objects and descriptors cleanup
@@ -0,0 +1,162 @@
+import bisect
+import collections
+import json
+import math
+import threading
+import time
+
+
+class RollingStats(object):
+    """Keeps the last N values of a measurement (e.g. frame times) and computes summary statistics over them."""
+
+    def __init__(self, window_size=600):
+        self.values = collections.deque(maxlen=window_size)
+        self.total_count = 0
+
+    def add(self, value):
+        self.values.append(value)
+        self.total_count += 1
+
+    def clear(self):
+        self.values.clear()
+        self.total_count = 0
+
+    def get_percentiles(self, percentiles=(50, 95, 99)):
+        # Nearest-rank percentiles over the values currently in the window. Returns None values if window is empty.
+        values = sorted(self.values)
+        n = len(values)
+        if n == 0:
+            return [None for _ in percentiles]
+        return [values[min(n - 1, max(0, int(round(p / 100.0 * n)) - 1))] for p in percentiles]
+
+    def get_summary(self, percentiles=(50, 95, 99)):
+        summary = {'count': self.total_count}
+        values = list(self.values)
+        summary['mean'] = sum(values) / len(values) if values else None
+        summary['max'] = max(values) if values else None
+        for p, value in zip(percentiles, self.get_percentiles(percentiles)):
+            summary['p{0}'.format(p)] = value
+        return summary
+
+
+class Histogram(object):
+    """Histogram with log-spaced buckets, used for latencies. Memory and cost of adding values are fixed no matter how
+    many values are added, so it can be used to keep statistics over long sessions. Percentiles are approximated by
+    the upper edge of the bucket where they fall (buckets_per_decade=20 gives ~12% resolution).
+    """
+
+    def __init__(self, min_value=0.00001, max_value=10.0, buckets_per_decade=20):
+        n_buckets = int(math.ceil(math.log10(max_value / min_value) * buckets_per_decade))
+        self.edges = [min_value * 10 ** (i / buckets_per_decade) for i in range(0, n_buckets + 1)]
+        self.counts = [0 for _ in range(0, len(self.edges) + 1)]  # First bucket is underflow, last is overflow
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.edges, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def clear(self):
+        self.counts = [0 for _ in self.counts]
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+
+    def copy(self):
+        histogram = Histogram.__new__(Histogram)
+        histogram.edges = self.edges  # Never changed once created
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.sum = self.sum
+        histogram.max = self.max
+        return histogram
+
+    def get_percentiles(self, percentiles=(50, 95, 99)):
+        if self.count == 0:
+            return [None for _ in percentiles]
+        results = []
+        for p in percentiles:
+            rank = max(1, int(math.ceil(p / 100.0 * self.count)))
+            cumulative = 0
+            for i, bucket_count in enumerate(self.counts):
+                cumulative += bucket_count
+                if cumulative >= rank:
+                    break
+            results.append(min(self.edges[i], self.max) if i < len(self.edges) else self.max)
+        return results
+
+    def get_summary(self, percentiles=(50, 95, 99)):
+        summary = {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'max': self.max,
+        }
+        for p, value in zip(percentiles, self.get_percentiles(percentiles)):
+            summary['p{0}'.format(p)] = value
+        return summary
+
+
+class LatencyStats(object):
+    """Latency histograms per event type (e.g. 'on_pad_pressed') and stage (e.g. 'midi_out'). Latencies are in seconds
+    and measured from the time the event arrived.
+
+    Latencies are added from the main loop and from the MIDI in worker thread, and read from the main loop, so
+    histograms are only changed or read while holding lock. get returns a copy of the histogram.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def add(self, event_type, stage, latency):
+        with self.lock:
+            histogram = self.histograms.get((event_type, stage), None)
+            if histogram is None:
+                histogram = Histogram()
+                self.histograms[(event_type, stage)] = histogram
+            histogram.add(latency)
+
+    def get(self, event_type, stage):
+        with self.lock:
+            histogram = self.histograms.get((event_type, stage), None)
+            return histogram.copy() if histogram is not None else None
+
+    def clear(self):
+        with self.lock:
+            self.histograms = {}
+
+    def get_histograms(self):
+        # Returns a sorted list of ((event_type, stage), histogram) with copies of the histograms
+        with self.lock:
+            return [(key, histogram.copy()) for key, histogram in sorted(self.histograms.items())]
+
+    def get_summary(self):
+        # Returns {event_type: {stage: summary}}, with summary times in milliseconds
+        return self.get_summary_from_histograms(self.get_histograms())
+
+    def get_summary_from_histograms(self, histograms):
+        summary = {}
+        for (event_type, stage), histogram in histograms:
+            stage_summary = histogram.get_summary()
+            summary.setdefault(event_type, {})[stage] = {key: value * 1000 if value is not None and key != 'count' else value
+                                                         for key, value in stage_summary.items()}
+        return summary
+
+    def export(self, path):
+        # Writes summaries and raw histogram counts (bucket upper edges in seconds) to a JSON file
+        histograms = self.get_histograms()
+        data = {
+            'time': time.time(),
+            'summary_ms': self.get_summary_from_histograms(histograms),
+            'histograms': [{
+                'event_type': event_type,
+                'stage': stage,
+                'bucket_edges': histogram.edges,
+                'counts': histogram.counts,
+            } for (event_type, stage), histogram in histograms],
+        }
+        json.dump(data, open(path, 'w'), indent=2)
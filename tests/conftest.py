@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+# Pysha modules live in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+class FakeRtMidiOut(object):
+    """Stand-in for rtmidi.MidiOut which, like python-rtmidi, only accepts one complete message per send_message call"""
+
+    def __init__(self, fail=False):
+        self.messages = []
+        self.fail = fail
+
+    def send_message(self, message):
+        if len(message) == 0:
+            raise ValueError("'message' must not be empty.")
+        if len(message) > 3 and message[0] != 0xF0:
+            raise ValueError("'message' longer than 3 bytes but does not start with 0xF0.")
+        if self.fail:
+            raise OSError('device went away')
+        self.messages.append(list(message))
+
+
+class FakeRtMidoPort(object):
+    """Stand-in for a mido output port of the rtmidi backend"""
+
+    def __init__(self, name='Fake Out', fail=False):
+        self.name = name
+        self.closed = False
+        self._rt = FakeRtMidiOut(fail=fail)
+
+    @property
+    def messages(self):
+        return self._rt.messages
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def rt_port():
+    return FakeRtMidoPort()
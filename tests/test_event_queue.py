@@ -0,0 +1,78 @@
+from event_queue import EventQueue, EventCoalescer
+
+
+def test_fast_lane_handled_before_ui_lane():
+    queue = EventQueue()
+    queue.put('on_button_pressed', ('Play', ))
+    queue.put('on_pad_pressed', (36, 100), fast=True)
+    handled = []
+    assert queue.process(lambda event_name, args, arrival_time: handled.append(event_name)) == 2
+    assert handled == ['on_pad_pressed', 'on_button_pressed']
+
+
+def test_full_lane_drops_new_events():
+    queue = EventQueue(ui_lane_max_size=1)
+    assert queue.put('on_button_pressed', ('Play', ))
+    assert not queue.put('on_button_pressed', ('Stop', ))
+    assert queue.get_stats()['events_dropped'] == {'ui': 1}
+
+
+def test_encoder_increments_added_together():
+    coalescer = EventCoalescer(window=0.01)
+    assert not coalescer.add('on_encoder_rotated', ('Track1', 1), 0.0, 0.0)  # First event is handled right away
+    assert coalescer.add('on_encoder_rotated', ('Track1', 2), 0.004, 0.004)
+    assert coalescer.add('on_encoder_rotated', ('Track1', 3), 0.005, 0.005)
+    assert coalescer.pop_due_events(0.005) == []
+    assert coalescer.pop_due_events(0.01) == [['on_encoder_rotated', ('Track1', 5), 0.004]]
+    assert coalescer.n_events_coalesced == 1
+
+
+def test_flushing_merged_events_opens_a_new_window():
+    coalescer = EventCoalescer(window=0.01)
+    coalescer.add('on_encoder_rotated', ('Track1', 1), 0.0, 0.0)
+    coalescer.add('on_encoder_rotated', ('Track1', 1), 0.005, 0.005)
+    assert len(coalescer.pop_due_events(0.01)) == 1
+    assert coalescer.add('on_encoder_rotated', ('Track1', 1), 0.015, 0.015)
+    assert coalescer.get_next_flush_time() == 0.02
+    assert len(coalescer.pop_due_events(0.02)) == 1
+    # Burst is over once a window ends without events
+    assert coalescer.pop_due_events(0.05) == []
+    assert not coalescer.add('on_encoder_rotated', ('Track1', 1), 0.05, 0.05)
+
+
+def test_exempt_encoder_not_coalesced():
+    coalescer = EventCoalescer(window=0.01, exempt=['Track2'])
+    assert not coalescer.add('on_encoder_rotated', ('Track2', 1), 0.0, 0.0)
+    assert not coalescer.add('on_encoder_rotated', ('Track2', 1), 0.0, 0.001)
+    assert not coalescer.add('on_encoder_rotated', ('Track1', 1), 0.0, 0.0)
+    assert coalescer.add('on_encoder_rotated', ('Track1', 1), 0.0, 0.001)
+
+
+def test_pending_encoder_events_flushed_before_other_encoder_and_buttons():
+    coalescer = EventCoalescer(window=0.01)
+    coalescer.add('on_encoder_rotated', ('Track1', 1), 0.0, 0.0)
+    coalescer.add('on_encoder_rotated', ('Track1', 1), 0.0, 0.001)
+    assert coalescer.pop_events_to_flush_before('on_encoder_rotated', ('Track2', 3)) == \
+        [['on_encoder_rotated', ('Track1', 1), 0.0]]
+    coalescer.add('on_encoder_rotated', ('Track1', 1), 0.0, 0.002)
+    assert len(coalescer.pop_events_to_flush_before('on_button_pressed', ('Play', ))) == 1
+
+
+def test_latest_aftertouch_kept_and_flushed_before_release():
+    coalescer = EventCoalescer(window=0.01)
+    assert not coalescer.add('on_pad_aftertouch', (36, 60, 40), 0.0, 0.0)
+    coalescer.add('on_pad_aftertouch', (36, 60, 50), 0.001, 0.001)
+    coalescer.add('on_pad_aftertouch', (36, 60, 70), 0.002, 0.002)
+    assert coalescer.pop_events_to_flush_before('on_pad_released', (36, 60, 0)) == \
+        [['on_pad_aftertouch', (36, 60, 70), 0.001]]
+    assert coalescer.get_next_flush_time() is None
+
+
+def test_full_fast_lane_never_drops_pad_presses_and_releases():
+    queue = EventQueue(fast_lane_max_size=1)
+    assert queue.put('on_pad_aftertouch', (36, (7, 0), 50), fast=True)
+    assert not queue.put('on_pad_aftertouch', (36, (7, 0), 60), fast=True)
+    assert queue.put('on_pad_pressed', (37, (7, 1), 100), fast=True)
+    assert queue.put('on_pad_released', (37, (7, 1), 0), fast=True)
+    assert queue.get_stats()['events_dropped'] == {'fast': 1}
+    assert queue.get_depth() == 3
@@ -0,0 +1,59 @@
+import mido
+
+from event_recorder import EventRecorder, read_event_log
+
+
+def record_session(path):
+    recorder = EventRecorder(path)
+    recorder.record('on_pad_pressed', (36, (7, 0), 100))
+    recorder.record('on_pad_aftertouch', (None, None, 60))
+    recorder.record('on_encoder_rotated', ('Track1', 300))
+    recorder.record('on_encoder_rotated', ('Track1', -2))
+    recorder.record('on_button_pressed', ('Play', ))
+    recorder.record('on_sustain_pedal', (True, ))
+    recorder.record('on_touchstrip', (-8192, ))
+    recorder.record('on_unknown_event', ())
+    recorder.record_midi_in(mido.Message('note_on', channel=2, note=60, velocity=90))
+    recorder.close()
+    return recorder
+
+
+def test_recorded_events_are_read_back(tmp_path):
+    path = str(tmp_path / 'session.pyshalog')
+    recorder = record_session(path)
+    assert recorder.n_events_recorded == 8
+    events = [(event_name, args) for _, event_name, args in read_event_log(path)]
+    assert events[:7] == [
+        ('on_pad_pressed', (36, (7, 0), 100)),
+        ('on_pad_aftertouch', (None, None, 60)),
+        ('on_encoder_rotated', ('Track1', 127)),  # Increments are clamped to one signed byte
+        ('on_encoder_rotated', ('Track1', -2)),
+        ('on_button_pressed', ('Play', )),
+        ('on_sustain_pedal', (True, )),
+        ('on_touchstrip', (-8192, )),
+    ]
+    assert events[7][0] == 'midi_in'
+    assert events[7][1][0].bytes() == [0x92, 60, 90]
+
+
+def test_event_times_increase(tmp_path):
+    path = str(tmp_path / 'session.pyshalog')
+    record_session(path)
+    times = [event_time for event_time, _, _ in read_event_log(path)]
+    assert times == sorted(times)
+
+
+def test_truncated_log_stops_at_last_complete_event(tmp_path):
+    path = str(tmp_path / 'session.pyshalog')
+    record_session(path)
+    data = open(path, 'rb').read()
+    open(path, 'wb').write(data[:-2])
+    events = list(read_event_log(path))
+    assert len(events) == 7
+    assert events[-1][1] == 'on_touchstrip'
+
+
+def test_record_after_close_is_ignored(tmp_path):
+    recorder = record_session(str(tmp_path / 'session.pyshalog'))
+    recorder.record('on_button_pressed', ('Play', ))
+    assert recorder.n_events_recorded == 8
@@ -0,0 +1,48 @@
+import threading
+import time
+
+from frame_scheduler import FrameScheduler
+
+
+def test_wake_event_processes_events_without_scheduler_lock():
+    scheduler = FrameScheduler(target_frame_rate=10, idle_frame_rate=10)
+    wake_event = threading.Event()
+    processed_times = []
+
+    def process_events():
+        processed_times.append(time.monotonic())
+        return None
+
+    def produce():
+        time.sleep(0.02)
+        with scheduler.condition:
+            # Producer sets the wake event while the scheduler lock is taken, the waiting loop must not need it
+            wake_event.set()
+            time.sleep(0.02)
+
+    start = time.monotonic()
+    producer = threading.Thread(target=produce)
+    producer.start()
+    scheduler.wait_until(start + 0.1, scheduler.get_activity_token(), start, process_events=process_events,
+                         wake_event=wake_event)
+    producer.join()
+    assert len(processed_times) == 2  # Once when starting to wait, once when woken up
+    assert processed_times[1] - start < 0.035
+    assert time.monotonic() - start >= 0.1
+
+
+def test_events_arriving_while_processing_are_processed_again():
+    scheduler = FrameScheduler(target_frame_rate=10, idle_frame_rate=10)
+    wake_event = threading.Event()
+    n_calls = []
+
+    def process_events():
+        n_calls.append(1)
+        if len(n_calls) == 1:
+            wake_event.set()  # Event arrived while processing
+        return None
+
+    start = time.monotonic()
+    scheduler.wait_until(start + 0.05, scheduler.get_activity_token(), start, process_events=process_events,
+                         wake_event=wake_event)
+    assert len(n_calls) == 2
@@ -0,0 +1,77 @@
+import mido
+
+from midi_input import MIDIInputTransform, MIDIInputWorker, DROP, KEEP_CHANNEL
+
+
+def test_empty_transform_is_disabled():
+    assert not MIDIInputTransform().enabled
+    assert not MIDIInputTransform({'transpose': 0, 'splits': []}).enabled
+
+
+def test_transpose_and_out_of_range_notes():
+    transform = MIDIInputTransform({'transpose': 12})
+    message_bytes = [0x90, 60, 100]
+    assert transform.apply(message_bytes) == KEEP_CHANNEL
+    assert message_bytes == [0x90, 72, 100]
+    assert transform.apply([0x80, 120, 0]) == DROP
+
+
+def test_splits_set_channel_and_transposition():
+    transform = MIDIInputTransform({'splits': [{'low': 0, 'high': 59, 'channel': 3, 'transpose': -12}]})
+    low_note = [0x90, 48, 100]
+    high_note = [0x90, 60, 100]
+    assert transform.apply(low_note) == 3
+    assert low_note == [0x90, 36, 100]
+    assert transform.apply(high_note) == KEEP_CHANNEL
+    assert high_note == [0x90, 60, 100]
+
+
+def test_channel_map_and_filter():
+    transform = MIDIInputTransform({'channel_map': {'1': 9}, 'filter': ['polytouch']})
+    assert transform.apply([0xB1, 1, 64]) == 9
+    assert transform.apply([0xB0, 1, 64]) == KEEP_CHANNEL
+    assert transform.apply([0xA0, 60, 10]) == DROP
+
+
+def test_velocity_curve_keeps_note_off_velocity_zero():
+    transform = MIDIInputTransform({'velocity_curve': 0.5})
+    soft_note = [0x90, 60, 32]
+    note_off = [0x90, 60, 0]
+    transform.apply(soft_note)
+    transform.apply(note_off)
+    assert soft_note[2] > 32
+    assert note_off[2] == 0
+
+
+def test_velocity_curve_table():
+    curve = [min(127, velocity * 2) for velocity in range(0, 128)]
+    transform = MIDIInputTransform({'velocity_curve': curve})
+    message_bytes = [0x90, 60, 40]
+    transform.apply(message_bytes)
+    assert message_bytes[2] == 80
+
+
+def test_worker_drops_controllers_but_not_notes_when_full():
+    handled = []
+    worker = MIDIInputWorker(lambda msg, arrival_time: handled.append(msg), max_queue_size=2)
+    assert worker.put(mido.Message('control_change', control=1, value=1))
+    assert worker.put(mido.Message('control_change', control=1, value=2))
+    assert not worker.put(mido.Message('control_change', control=1, value=3))
+    assert worker.put(mido.Message('note_off', note=60))
+    assert worker.wait_until_idle()  # Worker thread not started, handles messages here
+    assert [msg.type for msg in handled] == ['control_change', 'control_change', 'note_off']
+    stats = worker.get_stats()
+    assert stats['messages_dropped'] == 1
+    assert stats['queue_max_depth'] == 3
+
+
+def test_worker_thread_handles_messages():
+    handled = []
+    worker = MIDIInputWorker(lambda msg, arrival_time: handled.append(msg))
+    worker.start()
+    try:
+        worker.put(mido.Message('note_on', note=60, velocity=100))
+        assert worker.wait_until_idle()
+    finally:
+        worker.stop()
+    assert len(handled) == 1
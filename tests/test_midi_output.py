@@ -0,0 +1,128 @@
+import mido
+
+from midi_output import MIDIOutput, MIDIBatch, CHANNEL_STATUS_BYTES, pitchwheel_data_bytes
+
+from conftest import FakeRtMidoPort
+
+
+class FakeMidoPort(object):
+    # Output port without rtmidi (messages are sent as mido.Message objects)
+
+    def __init__(self):
+        self.name = 'Fake mido Out'
+        self.closed = False
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+    def close(self):
+        self.closed = True
+
+
+def test_send_bytes_writes_to_rtmidi_port(rt_port):
+    output = MIDIOutput(rt_port)
+    output.send_bytes([0x90, 60, 100])
+    output.send_bytes([0xC0, 5])
+    assert rt_port.messages == [[0x90, 60, 100], [0xC0, 5]]
+    assert output.get_stats()['bytes_sent'] == 5
+
+
+def test_send_bytes_without_rtmidi_sends_mido_messages():
+    port = FakeMidoPort()
+    output = MIDIOutput(port)
+    output.send_bytes([0x91, 60, 100])
+    assert port.sent == [mido.Message('note_on', channel=1, note=60, velocity=100)]
+
+
+def test_batch_writes_one_message_per_call(rt_port):
+    output = MIDIOutput(rt_port)
+    cc = CHANNEL_STATUS_BYTES[15].control_change
+    with MIDIBatch(output) as batch:
+        for control in range(0, 3):
+            output.send_bytes([cc, control, 127])
+        assert rt_port.messages == []  # Nothing written until the batch ends
+    assert rt_port.messages == [[cc, 0, 127], [cc, 1, 127], [cc, 2, 127]]
+    assert batch.n_bytes == 9
+    assert output.get_stats()['writes'] == 3
+
+
+def test_large_batch_is_not_lost(rt_port):
+    output = MIDIOutput(rt_port)
+    cc = CHANNEL_STATUS_BYTES[15].control_change
+    with MIDIBatch(output):
+        for control in range(0, 64):
+            output.send_bytes([cc, control, control % 2])
+    assert len(rt_port.messages) == 64
+    assert rt_port.messages[-1] == [cc, 63, 1]
+
+
+def test_nested_batches_write_when_outermost_ends(rt_port):
+    output = MIDIOutput(rt_port)
+    with MIDIBatch(output):
+        with MIDIBatch(output) as inner_batch:
+            output.send_bytes([0x90, 60, 100])
+        assert inner_batch.n_bytes == 0
+        assert rt_port.messages == []
+        output.send_bytes([0x80, 60, 0])
+    assert rt_port.messages == [[0x90, 60, 100], [0x80, 60, 0]]
+
+
+def test_batch_without_rtmidi_sends_mido_messages():
+    port = FakeMidoPort()
+    output = MIDIOutput(port)
+    with MIDIBatch(output):
+        output.send_bytes([0xB0, 1, 10])
+        output.send_bytes([0xB0, 2, 20])
+    assert [msg.control for msg in port.sent] == [1, 2]
+
+
+def test_batch_releases_lock_if_write_fails():
+    output = MIDIOutput(FakeRtMidoPort(fail=True))
+    try:
+        with MIDIBatch(output):
+            output.send_bytes([0x90, 60, 100])
+    except OSError:
+        pass
+    assert output.lock.acquire(blocking=False)
+    output.lock.release()
+    assert output.batch is None
+
+
+def test_batch_with_no_output_does_nothing():
+    with MIDIBatch(None) as batch:
+        pass
+    assert batch.n_bytes == 0
+
+
+def test_pitchwheel_data_bytes():
+    assert pitchwheel_data_bytes(0) == (0, 64)
+    assert pitchwheel_data_bytes(-8192) == (0, 0)
+    assert pitchwheel_data_bytes(8191) == (127, 127)
+    assert pitchwheel_data_bytes(10000) == (127, 127)
+
+
+def test_invalid_message_is_skipped_and_port_kept(rt_port):
+    output = MIDIOutput(rt_port)
+    output.send_bytes([0x90, 60, 100, 1])  # Rejected by rtmidi
+    output.send_bytes([0x90, 61, 100])
+    assert rt_port.messages == [[0x90, 61, 100]]
+    assert output.get_stats()['invalid_messages'] == 1
+    assert not output.closed
+
+
+def test_invalid_message_in_batch_does_not_lose_batch(rt_port):
+    output = MIDIOutput(rt_port)
+    with MIDIBatch(output):
+        output.send_bytes([0xB0, 1, 10])
+        output.send_bytes([0xB0, 2, 20, 0])
+        output.send_bytes([0xB0, 3, 30])
+    assert rt_port.messages == [[0xB0, 1, 10], [0xB0, 3, 30]]
+
+
+def test_batch_device_error_goes_to_on_error():
+    output = MIDIOutput(FakeRtMidoPort(fail=True))
+    errors = []
+    with MIDIBatch(output, on_error=lambda output, error: errors.append((output, error))):
+        output.send_bytes([0x90, 60, 100])
+    assert len(errors) == 1 and errors[0][0] is output
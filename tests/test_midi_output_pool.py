@@ -0,0 +1,74 @@
+import pytest
+
+from conftest import FakeRtMidoPort
+from midi_output import MIDIOutput, MIDIOutputPool
+
+
+class FakeDevices(object):
+
+    def __init__(self, names):
+        self.names = set(names)
+        self.n_opens = 0
+
+    def create_output(self, device_name):
+        self.n_opens += 1
+        if device_name not in self.names:
+            raise IOError('Unknown port "{0}"'.format(device_name))
+        return MIDIOutput(FakeRtMidoPort(name=device_name))
+
+
+@pytest.fixture
+def devices():
+    return FakeDevices(['Synth', 'Drums'])
+
+
+def test_outputs_are_opened_once_and_shared(devices):
+    pool = MIDIOutputPool(devices.create_output)
+    output = pool.get('Synth')
+    assert pool.get('Synth') is output
+    assert pool.get_open('Synth') is output
+    assert devices.n_opens == 1
+    assert pool.get_stats()['opened'] == 1
+    assert pool.get_stats()['reused'] == 2
+
+
+def test_get_open_never_opens(devices):
+    pool = MIDIOutputPool(devices.create_output)
+    assert pool.get_open('Synth') is None
+    assert devices.n_opens == 0
+
+
+def test_failed_open_not_retried_until_retry_interval(devices):
+    pool = MIDIOutputPool(devices.create_output, retry_interval=60)
+    assert pool.get('Keys') is None
+    assert pool.get('Keys') is None
+    assert devices.n_opens == 1
+    devices.names.add('Keys')
+    assert pool.get('Keys', retry_now=True) is not None
+    assert pool.get_stats()['failed_opens'] == 1
+
+
+def test_discarded_output_is_reopened(devices):
+    pool = MIDIOutputPool(devices.create_output)
+    output = pool.get('Drums')
+    pool.discard('Drums')
+    assert output.closed
+    assert pool.get_open('Drums') is None
+    reopened = pool.get('Drums')
+    assert reopened is not None and reopened is not output
+    assert pool.get_stats()['reopened'] == 1
+
+
+def test_closed_port_is_reopened(devices):
+    pool = MIDIOutputPool(devices.create_output)
+    output = pool.get('Synth')
+    output.close()
+    assert pool.get('Synth') is not output
+
+
+def test_close_all(devices):
+    pool = MIDIOutputPool(devices.create_output)
+    outputs = [pool.get('Synth'), pool.get('Drums')]
+    pool.close_all()
+    assert all(output.closed for output in outputs)
+    assert pool.get_outputs() == []
@@ -0,0 +1,111 @@
+from midi_output import MIDIOutputSerializer
+
+
+def make_congested_serializer(now=0.0):
+    # 1000 bytes per second, congested as soon as anything is pending on the link
+    serializer = MIDIOutputSerializer(bytes_per_second=1000, congestion_threshold=0.001)
+    assert not serializer.add([0x90, 60, 100], now)  # Written right away, link is now busy for 3 ms
+    return serializer
+
+
+def test_messages_written_right_away_when_link_is_idle():
+    serializer = MIDIOutputSerializer(bytes_per_second=1000, congestion_threshold=0.01)
+    assert not serializer.add([0x90, 60, 100], 0.0)
+    assert not serializer.add([0x80, 60, 0], 0.0)
+    assert serializer.get_next_flush_time() is None
+
+
+def test_running_status_is_accounted():
+    serializer = MIDIOutputSerializer(bytes_per_second=1000, congestion_threshold=1.0)
+    serializer.add([0xB0, 1, 1], 0.0)
+    serializer.add([0xB0, 1, 2], 0.0)
+    assert serializer.n_bytes_written == 5
+
+
+def test_messages_queued_when_congested_and_released_later():
+    serializer = make_congested_serializer()
+    assert serializer.add([0x91, 62, 100], 0.0)
+    assert serializer.pop_due_messages(0.0) == []
+    flush_time = serializer.get_next_flush_time()
+    assert flush_time is not None and flush_time > 0
+    assert serializer.pop_due_messages(flush_time) == [[0x91, 62, 100]]
+    assert serializer.get_next_flush_time() is None
+
+
+def test_messages_of_a_channel_keep_their_order():
+    serializer = make_congested_serializer()
+    messages = [[0xB0, 0, 1], [0xB0, 32, 2], [0xC0, 5], [0x90, 64, 100], [0xB0, 7, 100]]
+    for message_bytes in messages:
+        assert serializer.add(message_bytes, 0.0)
+    assert serializer.pop_all_messages(0.0) == messages
+
+
+def test_bank_select_is_never_merged():
+    serializer = make_congested_serializer()
+    messages = [[0xB0, 0, 1], [0xC0, 5], [0xB0, 0, 2], [0xC0, 6]]
+    for message_bytes in messages:
+        serializer.add(message_bytes, 0.0)
+    assert serializer.pop_all_messages(0.0) == messages
+
+
+def test_unmergeable_messages_are_all_written_in_order():
+    serializer = make_congested_serializer()
+    messages = [[0xBF, 0, value] for value in (1, 2, 3)] + [[0xBF, 64, 127], [0xBF, 0, 4]]
+    for message_bytes in messages:
+        serializer.add(message_bytes, 0.0, mergeable=False)
+    assert serializer.pop_all_messages(0.0) == messages
+
+
+def test_queued_controller_values_are_merged():
+    serializer = make_congested_serializer()
+    serializer.add([0xB0, 1, 10], 0.0)
+    serializer.add([0xB0, 2, 10], 0.0)
+    serializer.add([0xB0, 1, 20], 0.0)
+    assert serializer.pop_all_messages(0.0) == [[0xB0, 1, 20], [0xB0, 2, 10]]
+    assert serializer.get_stats(0.0)['controllers_replaced'] == 1
+
+
+def test_controllers_are_not_merged_across_notes():
+    serializer = make_congested_serializer()
+    messages = [[0xB0, 1, 10], [0x90, 60, 100], [0xB0, 1, 20]]
+    for message_bytes in messages:
+        serializer.add(message_bytes, 0.0)
+    # Note goes ahead of the CC queued before it, CC values keep their order
+    assert serializer.pop_all_messages(0.0) == [[0x90, 60, 100], [0xB0, 1, 10], [0xB0, 1, 20]]
+
+
+def test_notes_go_ahead_of_mergeable_controllers_of_same_channel():
+    serializer = make_congested_serializer()
+    messages = [[0xB0, 1, 10], [0xB0, 2, 10], [0xB0, 1, 20], [0x80, 60, 0], [0x90, 62, 100], [0xB0, 2, 20]]
+    for message_bytes in messages:
+        serializer.add(message_bytes, 0.0)
+    assert serializer.pop_all_messages(0.0) == [[0x80, 60, 0], [0x90, 62, 100], [0xB0, 1, 20], [0xB0, 2, 10], [0xB0, 2, 20]]
+    assert serializer.get_stats(0.0)['notes_prioritized'] == 2
+
+
+def test_notes_never_go_ahead_of_unmergeable_messages_or_pitch_bend():
+    serializer = make_congested_serializer()
+    serializer.add([0xB0, 1, 10], 0.0)
+    serializer.add([0xB0, 0, 1], 0.0)  # Bank select
+    serializer.add([0xB0, 5, 1], 0.0, mergeable=False)
+    serializer.add([0xE0, 0, 64], 0.0)
+    serializer.add([0x90, 60, 100], 0.0)
+    assert serializer.pop_all_messages(0.0) == [[0xB0, 1, 10], [0xB0, 0, 1], [0xB0, 5, 1], [0xE0, 0, 64], [0x90, 60, 100]]
+
+
+def test_controllers_are_not_merged_across_unmergeable_messages():
+    serializer = make_congested_serializer()
+    messages = [[0xB0, 1, 10], [0xB0, 5, 1], [0xB0, 1, 20]]
+    serializer.add(messages[0], 0.0)
+    serializer.add(messages[1], 0.0, mergeable=False)
+    serializer.add(messages[2], 0.0)
+    assert serializer.pop_all_messages(0.0) == messages
+
+
+def test_notes_of_other_channels_go_ahead_of_controllers():
+    serializer = make_congested_serializer()
+    serializer.add([0xB0, 1, 10], 0.0)
+    serializer.add([0xE0, 0, 64], 0.0)
+    serializer.add([0x91, 60, 100], 0.0)
+    assert serializer.pop_all_messages(0.0) == [[0x91, 60, 100], [0xB0, 1, 10], [0xE0, 0, 64]]
+    assert serializer.get_stats(0.0)['notes_prioritized'] == 1
@@ -0,0 +1,72 @@
+from midi_output import MIDIOutputShaper
+
+
+def test_repeated_cc_is_dropped():
+    shaper = MIDIOutputShaper(max_rate=0)
+    assert not shaper.add([0xB0, 74, 10], 0.0)
+    assert shaper.add([0xB0, 74, 10], 1.0)
+    assert not shaper.add([0xB0, 74, 11], 2.0)
+    assert shaper.n_repeats_dropped == 1
+
+
+def test_non_continuous_ccs_are_never_shaped():
+    shaper = MIDIOutputShaper(max_rate=100)
+    for control in (0, 32, 6, 96, 99, 123):
+        assert not shaper.add([0xB0, control, 1], 0.0)
+        assert not shaper.add([0xB0, control, 1], 0.0)
+    assert shaper.n_repeats_dropped == 0
+    assert not shaper.pending
+
+
+def test_channel_aftertouch_repeat_state_reset_by_notes():
+    shaper = MIDIOutputShaper(max_rate=0)
+    assert not shaper.add([0xD0, 90], 0.0)
+    assert shaper.pop_messages_to_flush_before([0x80, 60, 0], 1.0) == []
+    assert shaper.pop_messages_to_flush_before([0x90, 62, 100], 1.0) == []
+    # First aftertouch of the new note is sent even if it has the same value as the last one of the previous note
+    assert not shaper.add([0xD0, 90], 1.1)
+    assert shaper.add([0xD0, 90], 1.2)
+
+
+def test_aftertouch_of_other_channel_is_not_reset():
+    shaper = MIDIOutputShaper(max_rate=0)
+    shaper.add([0xD1, 90], 0.0)
+    shaper.pop_messages_to_flush_before([0x90, 62, 100], 1.0)
+    assert shaper.add([0xD1, 90], 1.1)
+
+
+def test_poly_aftertouch_repeat_state_reset_per_note():
+    shaper = MIDIOutputShaper(max_rate=0)
+    shaper.add([0xA0, 60, 50], 0.0)
+    shaper.add([0xA0, 64, 50], 0.0)
+    shaper.pop_messages_to_flush_before([0x90, 60, 100], 1.0)
+    assert not shaper.add([0xA0, 60, 50], 1.1)
+    assert shaper.add([0xA0, 64, 50], 1.1)
+
+
+def test_pending_aftertouch_flushed_before_note_and_first_value_of_next_note_sent():
+    shaper = MIDIOutputShaper(max_rate=100)
+    assert not shaper.add([0xD0, 80], 0.0)
+    assert shaper.add([0xD0, 90], 0.001)  # Rate limited, held
+    assert shaper.pop_messages_to_flush_before([0x80, 60, 0], 0.002) == [[0xD0, 90]]
+    assert not shaper.add([0xD0, 90], 0.003)
+
+
+def test_rate_limited_cc_sends_last_value():
+    shaper = MIDIOutputShaper(max_rate=100)
+    assert not shaper.add([0xB0, 74, 1], 0.0)
+    assert shaper.add([0xB0, 74, 2], 0.001)
+    assert shaper.add([0xB0, 74, 3], 0.002)
+    assert shaper.get_next_flush_time() == 0.01
+    assert shaper.pop_due_messages(0.005) == []
+    assert shaper.pop_due_messages(0.01) == [[0xB0, 74, 3]]
+    assert shaper.n_rate_limited_dropped == 1
+
+
+def test_reset_sends_value_equal_to_last_one_again():
+    # Tracks sharing device and channel (e.g. Pyramid tracks) reset the shaper when the selected track changes
+    shaper = MIDIOutputShaper(max_rate=0)
+    assert not shaper.add([0xB0, 74, 10], 0.0)
+    assert shaper.add([0xB0, 74, 10], 1.0)
+    shaper.reset()
+    assert not shaper.add([0xB0, 74, 10], 2.0)
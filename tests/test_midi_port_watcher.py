@@ -0,0 +1,57 @@
+import mido
+
+from midi_port_watcher import MIDIPortWatcher
+
+
+class PortLists(object):
+
+    def __init__(self, input_names, output_names):
+        self.input_names = list(input_names)
+        self.output_names = list(output_names)
+
+
+def make_watcher(monkeypatch, port_lists, reconnect=None):
+    calls = []
+
+    def on_ports_changed(added_inputs, removed_inputs, added_outputs, removed_outputs):
+        calls.append((added_inputs, removed_inputs, added_outputs, removed_outputs))
+        return [name for name in added_inputs | added_outputs if reconnect is not None and name in reconnect]
+
+    monkeypatch.setattr(mido, 'get_input_names', lambda: list(port_lists.input_names))
+    monkeypatch.setattr(mido, 'get_output_names', lambda: list(port_lists.output_names))
+    watcher = MIDIPortWatcher(on_ports_changed, ignored_names=['Ableton Push'])
+    return watcher, calls
+
+
+def test_first_poll_only_takes_baseline(monkeypatch):
+    watcher, calls = make_watcher(monkeypatch, PortLists(['Keys'], ['Synth', 'Ableton Push 2 Live Port']))
+    assert not watcher.poll()
+    assert calls == []
+    assert watcher.output_names == {'Synth'}
+
+
+def test_unplug_and_replug_is_reported(monkeypatch):
+    port_lists = PortLists(['Keys'], ['Synth'])
+    watcher, calls = make_watcher(monkeypatch, port_lists, reconnect={'Synth'})
+    watcher.poll()
+    port_lists.output_names = []
+    assert watcher.poll()
+    assert calls[-1] == (set(), set(), set(), {'Synth'})
+    assert not watcher.poll()  # Nothing changed
+    port_lists.output_names = ['Synth']
+    assert watcher.poll()
+    assert calls[-1] == (set(), set(), {'Synth'}, set())
+    stats = watcher.get_stats()
+    assert stats['reconnects'] == 1
+    assert stats['last_reconnected_device'] == 'Synth'
+    assert stats['offline_p50_ms'] is not None
+
+
+def test_request_reconnect_passes_all_ports_as_added(monkeypatch):
+    port_lists = PortLists(['Keys'], ['Synth'])
+    watcher, calls = make_watcher(monkeypatch, port_lists)
+    watcher.poll()
+    watcher.request_reconnect()  # Watcher thread not running, polls here
+    assert calls[-1] == ({'Keys'}, set(), {'Synth'}, set())
+    watcher.request_reconnect()  # Within retry interval, ignored
+    assert len(calls) == 1
@@ -0,0 +1,58 @@
+import json
+import threading
+
+from stats_utils import Histogram, LatencyStats, RollingStats
+
+
+def test_rolling_stats_percentiles():
+    stats = RollingStats(window_size=4)
+    assert stats.get_percentiles((50, )) == [None]
+    for value in (5, 1, 2, 3, 4):
+        stats.add(value)
+    assert stats.get_percentiles((50, 100)) == [2, 4]
+    assert stats.total_count == 5
+
+
+def test_histogram_percentiles_within_bucket_resolution():
+    histogram = Histogram()
+    for i in range(1, 101):
+        histogram.add(i / 1000.0)
+    p50, p99 = histogram.get_percentiles((50, 99))
+    assert 0.05 <= p50 <= 0.05 * 1.13
+    assert 0.099 <= p99 <= 0.1
+    assert histogram.get_summary()['max'] == 0.1
+
+
+def test_latency_stats_get_returns_copy():
+    stats = LatencyStats()
+    stats.add('on_pad_pressed', 'midi_out', 0.001)
+    histogram = stats.get('on_pad_pressed', 'midi_out')
+    stats.add('on_pad_pressed', 'midi_out', 0.002)
+    assert histogram.count == 1
+    assert stats.get('on_pad_pressed', 'midi_out').count == 2
+    assert stats.get('on_pad_pressed', 'queued') is None
+
+
+def test_latency_stats_summary_and_export_while_adding_from_another_thread(tmp_path):
+    stats = LatencyStats()
+    stop = threading.Event()
+
+    def add_latencies():
+        i = 0
+        while not stop.is_set():
+            stats.add('midi_in', 'midi_out', 0.0001 * (i % 100 + 1))
+            stats.add('event_{0}'.format(i % 50), 'dispatched', 0.001)
+            i += 1
+
+    thread = threading.Thread(target=add_latencies)
+    thread.start()
+    try:
+        for _ in range(20):
+            stats.get_summary()
+            stats.export(str(tmp_path / 'latency_stats.json'))
+    finally:
+        stop.set()
+        thread.join()
+    data = json.load(open(str(tmp_path / 'latency_stats.json')))
+    for entry in data['histograms']:
+        assert sum(entry['counts']) == data['summary_ms'][entry['event_type']][entry['stage']]['count']
@@ -6,7 +6,8 @@ import math
 import os
 import json
 
-from display_utils import show_text
+from display_widgets import WidgetLayout
+from midi_output import CHANNEL_STATUS_BYTES
 
 
 class TrackSelectionMode(definitions.PyshaMode):
@@ -37,24 +38,46 @@ class TrackSelectionMode(definitions.PyshaMode):
     selected_track = 0
     track_selection_quick_press_time = 0.400
     pyramidi_channel = 15
+    pyramidi_status = CHANNEL_STATUS_BYTES[15]  # Status bytes for pyramidi_channel
+    track_button_a_columns = {button_name: column for column, button_name in enumerate(track_button_names_a)}
+    track_button_b_rows = {button_name: row for row, button_name in enumerate(track_button_names_b)}
+    handled_button_names = set(track_button_names_a + track_button_names_b)
+    retains_display_layer = True
+    widgets = None
+    track_labels = []
 
     def initialize(self, settings=None):
         if settings is not None:
-            self.pyramidi_channel = settings.get('pyramidi_channel', self.pyramidi_channel)
+            self.set_pyramidi_channel(settings.get('pyramidi_channel', self.pyramidi_channel))
         
         self.create_tracks()
+        self.create_widgets()
+
+    def create_widgets(self):
+        self.widgets = WidgetLayout()
+        height = 20
+        self.track_labels = [self.widgets.add_text(i, self.widgets.h - height, height=height) for i in range(0, 8)]
 
     def create_tracks(self):
         """This method creates 64 tracks corresponding to the Pyramid tracks that I use in my live setup.
         Instrument names are assigned according to the way I have them configured in the 64 tracks of Pyramid.
         Instrument names per track are loaded from "track_listing.json" file, and should correspond to instrument
-        definition filenames from "instrument_definitions" folder.
+        definition filenames from "instrument_definitions" folder. Track listing entries can also be objects with
+        the instrument name and the MIDI output device/channel (0-15) to route the track to, e.g.
+        {"instrument": "DDRM", "midi_device_out": "USB MIDI Interface", "midi_channel_out": 2}. Tracks without output
+        device or channel use the MIDI out device and channel from settings (the instrument definition file can
+        also set "midi_device_out" and "midi_channel_out").
         """
         tmp_instruments_data = {}
 
         if os.path.exists(definitions.TRACK_LISTING_PATH):
             track_instruments = json.load(open(definitions.TRACK_LISTING_PATH))
-            for i, instrument_short_name in enumerate(track_instruments):
+            for i, track_entry in enumerate(track_instruments):
+                if isinstance(track_entry, dict):
+                    instrument_short_name = track_entry.get('instrument', '-')
+                else:
+                    instrument_short_name = track_entry
+                    track_entry = {}
                 if instrument_short_name not in tmp_instruments_data:
                     try:
                         instrument_data = json.load(open(os.path.join(definitions.INSTRUMENT_DEFINITION_FOLDER, '{}.json'.format(instrument_short_name))))
@@ -78,6 +101,8 @@ class TrackSelectionMode(definitions.PyshaMode):
                     'n_banks': instrument_data.get('n_banks', 1),
                     'bank_names': instrument_data.get('bank_names', None),
                     'default_layout': instrument_data.get('default_layout', definitions.LAYOUT_MELODIC),
+                    'midi_device_out': track_entry.get('midi_device_out', instrument_data.get('midi_device_out', None)),
+                    'midi_channel_out': track_entry.get('midi_channel_out', instrument_data.get('midi_channel_out', None)),
                 })
             print('Created {0} tracks!'.format(len(self.tracks_info)))
         else:
@@ -102,6 +127,7 @@ class TrackSelectionMode(definitions.PyshaMode):
             self.pyramidi_channel = 0 if not wrap else 15
         elif self.pyramidi_channel > 15:
             self.pyramidi_channel = 15 if not wrap else 0
+        self.pyramidi_status = CHANNEL_STATUS_BYTES[self.pyramidi_channel]
 
     def get_all_distinct_instrument_short_names(self):
         return list(set([track['instrument_short_name'] for track in self.tracks_info]))
@@ -135,14 +161,15 @@ class TrackSelectionMode(definitions.PyshaMode):
 
     def send_select_track_to_pyramid(self, track_idx):
         # Follows pyramidi specification (Pyramid configured to receive on ch 16)
-        msg = mido.Message('control_change', control=0, value=track_idx + 1)
-        self.app.send_midi(msg, force_channel=self.pyramidi_channel)
+        self.app.send_midi_raw(self.pyramidi_status.control_change, 0, track_idx + 1, shape=False, output=self.app.midi_out)
 
     def select_track(self, track_idx):
         # Selects a track and activates its melodic/rhythmic layout
         # Note that if this is called from a mode form the same xor group with melodic/rhythmic modes,
         # that other mode will be deactivated.
         self.selected_track = track_idx
+        self.invalidate_display()
+        self.app.update_track_midi_out()  # Before selecting the track in Pyramid so pending values go to the previous track
         self.send_select_track_to_pyramid(self.selected_track)
         self.load_current_default_layout()
         self.clean_currently_notes_being_played()
@@ -169,8 +196,8 @@ class TrackSelectionMode(definitions.PyshaMode):
 
         for count, name in enumerate(self.track_button_names_b):
             if self.track_selection_button_a:
-                color = self.tracks_info[self.track_button_names_a.index(self.track_selection_button_a)]['color']
-                equivalent_track_num = self.track_button_names_a.index(self.track_selection_button_a) + count * 8
+                color = self.tracks_info[self.track_button_a_columns[self.track_selection_button_a]]['color']
+                equivalent_track_num = self.track_button_a_columns[self.track_selection_button_a] + count * 8
                 if self.selected_track == equivalent_track_num:
                     self.push.buttons.set_button_color(name, definitions.WHITE)
                     self.push.buttons.set_button_color(name, color, animation=definitions.DEFAULT_ANIMATION)
@@ -185,34 +212,36 @@ class TrackSelectionMode(definitions.PyshaMode):
                 else:
                     self.push.buttons.set_button_color(name, color)
 
-    def update_display(self, ctx, w, h):
+    def get_display_state(self):
+        # Selected column and (instrument short name, color) of the tracks of the first row
+        return self.selected_track % 8, tuple((track_info['instrument_short_name'], track_info['color'])
+                                              for track_info in self.tracks_info[0:8])
 
-        # Draw track selector labels
-        height = 20
-        for i in range(0, 8):
-            track_color = self.tracks_info[i]['color']
-            if self.selected_track % 8 == i:
+    def update_display(self, ctx, w, h, state):
+
+        # Update track selector labels
+        selected_column, tracks = state
+        for i, (label, (instrument_short_name, track_color)) in enumerate(zip(self.track_labels, tracks)):
+            if selected_column == i:
                 background_color = track_color
                 font_color = definitions.BLACK
             else:
                 background_color = definitions.BLACK
                 font_color = track_color
-            instrument_short_name = self.tracks_info[i]['instrument_short_name']
-            show_text(ctx, i, h - height, instrument_short_name, height=height,
-                      font_color=font_color, background_color=background_color)
+            label.set(text=instrument_short_name, font_color=font_color, background_color=background_color)
+        self.widgets.render(ctx)
  
     def on_button_pressed(self, button_name):
-        if button_name in self.track_button_names_a:
+        if button_name in self.track_button_a_columns:
             self.track_selection_button_a = button_name
             self.track_selection_button_a_pressing_time = time.time()
             self.app.buttons_need_update = True
             return True
 
-        elif button_name in self.track_button_names_b:
+        elif button_name in self.track_button_b_rows:
             if self.track_selection_button_a:
                 # While pressing one of the track selection a buttons
-                self.select_track(self.track_button_names_a.index(
-                    self.track_selection_button_a) + self.track_button_names_b.index(button_name) * 8)
+                self.select_track(self.track_button_a_columns[self.track_selection_button_a] + self.track_button_b_rows[button_name] * 8)
                 self.app.buttons_need_update = True
                 self.app.pads_need_update = True
                 self.track_selection_button_a = False
@@ -220,17 +249,17 @@ class TrackSelectionMode(definitions.PyshaMode):
                 return True
             else:
                 # No track selection a button being pressed...
-                self.select_track(self.selected_track % 8 + 8 * self.track_button_names_b.index(button_name))
+                self.select_track(self.selected_track % 8 + 8 * self.track_button_b_rows[button_name])
                 self.app.buttons_need_update = True
                 self.app.pads_need_update = True
                 return True
 
     def on_button_released(self, button_name):
-        if button_name in self.track_button_names_a:
+        if button_name in self.track_button_a_columns:
             if self.track_selection_button_a:
                 if time.time() - self.track_selection_button_a_pressing_time < self.track_selection_quick_press_time:
                     # Only switch to track if it was a quick press
-                    self.select_track(self.track_button_names_a.index(button_name))
+                    self.select_track(self.track_button_a_columns[button_name])
                 self.track_selection_button_a = False
                 self.track_selection_button_a_pressing_time = 0
                 self.app.buttons_need_update = True